@@ -1,6 +1,5 @@
 import os
 import sys
-import logging
 import contextlib
 from dotenv import load_dotenv
 
@@ -8,8 +7,6 @@ sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
 VERSION = __version__ = "1.3.2"
 
-LOGGER = logging.basicConfig(filename='idml2docbook.log', encoding='utf-8', level=logging.DEBUG)
-
 load_dotenv()
 
 def getEnvOrDefault(envConst, default=False):
@@ -17,15 +14,37 @@ def getEnvOrDefault(envConst, default=False):
 
 IDML2HUBXML_SCRIPT_FOLDER = os.getenv("IDML2HUBXML_SCRIPT_FOLDER")
 
+# Logging is only configured by the command line, see logs.py
+LOG_LEVEL = getEnvOrDefault("LOG_LEVEL", "warning")
+LOG_FILE = getEnvOrDefault("LOG_FILE", None)
+LOG_JSON = getEnvOrDefault("LOG_JSON")
+
+CACHE_FOLDER = os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "idml2docbook")
+IDML2HUBXML_CACHE = getEnvOrDefault("IDML2HUBXML_CACHE", os.path.join(CACHE_FOLDER, "idml2hubxml"))
+# Checkpoints cost a hash, two serializations and two gzips per conversion: off unless asked for
+CHECKPOINTS_FOLDER = os.path.join(CACHE_FOLDER, "checkpoints")
+CHECKPOINTS = getEnvOrDefault("CHECKPOINTS")
+
 DEFAULT_OPTIONS = {
     'idml2hubxml_file': False,
     'typography': getEnvOrDefault("TYPOGRAPHY"),
     'ignore_overrides': getEnvOrDefault("IGNORE_OVERRIDES"),
     'thin_spaces': getEnvOrDefault("THIN_SPACES"),
     'linebreaks': getEnvOrDefault("LINEBREAKS"),
+    'merge_identical_phrases': getEnvOrDefault("MERGE_IDENTICAL_PHRASES"),
     'media': getEnvOrDefault("MEDIA", "Links"),
     'raster': getEnvOrDefault("RASTER", None),
     'vector': getEnvOrDefault("VECTOR", None),
     'idml2hubxml_output': getEnvOrDefault("IDML2HUBXML_OUTPUT_FOLDER", "idml2hubxml"),
+    'keep_idml2hubxml_output': getEnvOrDefault("KEEP_IDML2HUBXML_OUTPUT"),
     'idml2hubxml_script': IDML2HUBXML_SCRIPT_FOLDER,
+    'idml2hubxml_cache': False if IDML2HUBXML_CACHE == "False" else IDML2HUBXML_CACHE,
+    'idml2hubxml_cache_size': getEnvOrDefault("IDML2HUBXML_CACHE_SIZE", 1024),
+    'engine': getEnvOrDefault("ENGINE", "bs4"),
+    'streaming': getEnvOrDefault("STREAMING"),
+    'checkpoints': CHECKPOINTS_FOLDER if CHECKPOINTS == "True" else (False if CHECKPOINTS == "False" else CHECKPOINTS),
+    'checkpoints_size': getEnvOrDefault("CHECKPOINTS_SIZE", 1024),
+    'incremental': getEnvOrDefault("INCREMENTAL"),
+    'profile': getEnvOrDefault("PROFILE"),
+    'profile_stage': getEnvOrDefault("PROFILE_STAGE", None),
 }
\ No newline at end of file
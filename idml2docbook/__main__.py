@@ -3,9 +3,14 @@
 import argparse
 import logging
 import os
+import sys
+import time
+from pathlib import Path
 
-from . import __version__, LOGGER, DEFAULT_OPTIONS
-from .core import idml2docbook
+from . import __version__, DEFAULT_OPTIONS, CACHE_FOLDER, CHECKPOINTS_FOLDER, LOG_LEVEL, LOG_FILE, LOG_JSON
+from .core import idml2docbook_to
+from .batch import convert_many, format_summary
+from .logs import LEVELS, configure_logging
 
 # This file structure is inspired from weasyprint:
 # https://github.com/Kozea/WeasyPrint/blob/main/weasyprint/__main__.py
@@ -44,7 +49,15 @@ def load_env(argv):
         description='Convert IDML files to DocBook.',
         usage='%(prog)s [options]')
     PARSER.add_argument(
-        'input', help='filename of the IDML input')
+        'input', nargs='?', help='filename of the IDML input, - to read it from stdin')
+    PARSER.add_argument(
+        '--batch', type=str, metavar='DIR',
+        help='convert every IDML file of a folder and of its subfolders '
+        '(or every hubxml file with --idml2hubxml-file) into the folder given by --output')
+    PARSER.add_argument(
+        '-j', '--jobs', type=int,
+        help='number of files converted in parallel in batch mode, '
+        'defaults to the number of CPUs')
     PARSER.add_argument(
         '-x', '--idml2hubxml-file', action='store_true',
         help='consider this file as a hubxml file, '
@@ -52,7 +65,9 @@ def load_env(argv):
         'have already performed idml2xml on your IDML source file')
     PARSER.add_argument(
         '-o', '--output', type=str,
-        help='filename where output is written, defaults to stdout')
+        help='filename where output is written, defaults to stdout, '
+        'gzip-compressed if it ends with ".gz" '
+        '(folder where the files are written in batch mode)')
     PARSER.add_argument(
         '-g', '--ignore-overrides', action='store_true',
         help='ignore the style overrides (direct formatting)')
@@ -67,6 +82,10 @@ def load_env(argv):
     PARSER.add_argument(
         '-b', '--linebreaks', action='store_true',
         help='do not replace <br> tags with spaces')
+    PARSER.add_argument(
+        '-m', '--merge-identical-phrases', action='store_true',
+        help='merge adjacent phrases that have the same attributes, '
+        'not only the ones that only have the same role')
     PARSER.add_argument(
         '-f', '--media', type=str,
         help='path to the media folder, defaults to "Links"')
@@ -81,23 +100,105 @@ def load_env(argv):
     PARSER.add_argument(
         '-i', '--idml2hubxml-output', type=str,
         help='path to the output of Transpect’s idml2hubxml converter, '
-        'defaults to "idml2hubxml"')
+        'when it is kept, defaults to "idml2hubxml"')
+    PARSER.add_argument(
+        '-k', '--keep-idml2hubxml-output', action='store_true',
+        help='keep the Hub XML written by idml2xml (and its log) in the '
+        '--idml2hubxml-output folder, instead of a temporary folder removed once it is read')
     PARSER.add_argument(
         '-s', '--idml2hubxml-script', type=str,
         help='path to the script of Transpect’s idml2xml converter, '
         'defaults to "idml2xml-frontend"')
+    PARSER.add_argument(
+        '--idml2hubxml-cache', type=str, metavar='FOLDER',
+        help='folder where the outputs of idml2xml are cached, by hash of the IDML file, '
+        'defaults to "~/.cache/idml2docbook/idml2hubxml"')
+    PARSER.add_argument(
+        '--no-idml2hubxml-cache', dest='idml2hubxml_cache', action='store_false',
+        help='always run idml2xml, without looking for its output in the cache')
+    PARSER.add_argument(
+        '--purge-idml2hubxml-cache', action='store_true',
+        help='empty the cache of idml2xml outputs and exit')
+    PARSER.add_argument(
+        '-e', '--engine', type=str, choices=['bs4', 'lxml'],
+        help='conversion engine, "lxml" is much faster on large files, '
+        'defaults to "bs4"')
+    PARSER.add_argument(
+        '--checkpoints', action='store_const',
+        const=DEFAULT_OPTIONS['checkpoints'] or CHECKPOINTS_FOLDER,
+        help='save the trees after the passes that do not depend '
+        'on most options, so that converting the same file again with other options '
+        'resumes from there')
+    PARSER.add_argument(
+        '--checkpoints-folder', dest='checkpoints', type=str, metavar='FOLDER',
+        help='save the checkpoints in FOLDER (implies --checkpoints), '
+        'defaults to "~/.cache/idml2docbook/checkpoints"')
+    PARSER.add_argument(
+        '--no-checkpoints', dest='checkpoints', action='store_false',
+        help='neither use nor save checkpoints')
+    PARSER.add_argument(
+        '--purge-checkpoints', action='store_true',
+        help='remove all the checkpoints and exit')
+    PARSER.add_argument(
+        '--incremental', action='store_const',
+        const=DEFAULT_OPTIONS['incremental'] or os.path.join(CACHE_FOLDER, 'fragments'),
+        help='cache the DocBook of every top-level child of <hub>, '
+        'so that converting the document again after a few changes only converts the children '
+        'that changed (implies --streaming); idml2xml still converts the whole IDML package, '
+        'and a document with inline elements or text directly in <hub> is converted as a whole')
+    PARSER.add_argument(
+        '--incremental-folder', dest='incremental', type=str, metavar='FOLDER',
+        help='cache the parts of --incremental in FOLDER (implies --incremental), '
+        'defaults to "~/.cache/idml2docbook/fragments"')
+    PARSER.add_argument(
+        '-S', '--streaming', action='store_true',
+        help='convert the hubxml file part by part and write the output '
+        'as it goes, this keeps memory use low on very large files '
+        '(always uses the lxml engine)')
+    PARSER.add_argument(
+        '--profile', action='store_const',
+        const=DEFAULT_OPTIONS['profile'] or 'idml2docbook-profile.json',
+        help='record the wall time, CPU time, peak memory and number of nodes of '
+        'every stage of the conversion, and write them to a JSON file and '
+        'to the same file with a .txt extension (table)')
+    PARSER.add_argument(
+        '--profile-file', dest='profile', type=str, metavar='FILE',
+        help='write the report of --profile to FILE (implies --profile), '
+        'defaults to "idml2docbook-profile.json"')
+    PARSER.add_argument(
+        '--profile-stage', type=str, metavar='STAGE',
+        help='with --profile, also run the given stage under cProfile, '
+        'e.g. "fix_role_names" or "cleanup", and write its statistics to '
+        'FILE with a .prof extension')
+    PARSER.add_argument(
+        '--log-level', type=str.lower, choices=LEVELS, default=LOG_LEVEL,
+        help='level of the messages to log, "off" to log nothing, defaults to "warning"')
+    PARSER.add_argument(
+        '--log-file', type=str, metavar='FILE', default=LOG_FILE,
+        help='file where the messages are logged, "{pid}" in its name is replaced by '
+        'the id of the process (one file per process with --batch), defaults to stderr')
+    PARSER.add_argument(
+        '--log-json', action='store_true', default=LOG_JSON,
+        help='log the messages as JSON lines')
     PARSER.add_argument(
         '--version', action='version',
         version=f'idml2docbook version {__version__}',
         help='print idml2docbook’s version number and exit')
 
     args = PARSER.parse_args(argv)
+    configure_logging(args.log_level, args.log_file, args.log_json)
+    if not args.input and not args.batch and not args.purge_idml2hubxml_cache and not args.purge_checkpoints:
+        PARSER.error("an input file or --batch DIR is required")
+    if args.batch and not args.output:
+        PARSER.error("--batch needs an output folder (--output)")
+    if args.batch and args.profile:
+        PARSER.error("--profile cannot be used with --batch")
 
     default_options = DEFAULT_OPTIONS
 
     PARSER.set_defaults(**default_options)
 
-    logging.debug("Parsed command-line arguments: " + str(args))
+    logging.debug("Parsed command-line arguments: %s", args)
     return PARSER.parse_args(argv), default_options
 
 def main(argv=None, stdout=None, stdin=None):
@@ -108,6 +209,17 @@ def main(argv=None, stdout=None, stdin=None):
         key: value for key, value in vars(args).items() if key in default_options
     }
 
+    if args.purge_idml2hubxml_cache or args.purge_checkpoints:
+        from .cache import GzipCache
+        if args.purge_idml2hubxml_cache and options["idml2hubxml_cache"]:
+            GzipCache(options["idml2hubxml_cache"]).purge()
+            print("Emptied " + options["idml2hubxml_cache"])
+        if args.purge_checkpoints:
+            folder = options["checkpoints"] or CHECKPOINTS_FOLDER
+            GzipCache(folder, suffix=".checkpoint.gz").purge()
+            print("Emptied " + folder)
+        return
+
     if not options["idml2hubxml_script"]:
         raise RuntimeError(
             "Missing IDML2HUBXML_SCRIPT_FOLDER in .env file.\n"
@@ -116,13 +228,24 @@ def main(argv=None, stdout=None, stdin=None):
             "idml2docbook-install-dependencies"
         )
 
-    docbook = idml2docbook(args.input, **options)
+    if args.batch:
+        start = time.perf_counter()
+        results = convert_many(args.batch, args.output, args.jobs, **options)
+        print(format_summary(results, time.perf_counter() - start))
+        if any(result["error"] for result in results): sys.exit(1)
+        return
 
-    if(args.output):
+    input = sys.stdin.buffer if args.input == "-" else args.input
+    if args.output:
         logging.info("Writing file: " + args.output)
-        with open(args.output, "w") as file:
-            file.write(docbook)
-    else: print(docbook)
+        idml2docbook_to(input, args.output, **options)
+    else:
+        idml2docbook_to(input, sys.stdout, **options)
+        print()
+
+    if options["profile"]:
+        with open(Path(options["profile"]).with_suffix(".txt")) as f:
+            print(f.read(), end="", file=sys.stderr)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""Conversion of many files at once, on a pool of processes.
+
+Every worker process imports idml2docbook once and converts files one after
+the other, so the interpreter startup and the imports are only paid once per
+worker. The largest files are converted first, so that a big file does not
+start last and keep the whole batch waiting. A failing file does not stop the
+batch: its error is reported in the summary."""
+
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from idml2docbook import DEFAULT_OPTIONS
+from idml2docbook.core import idml2docbook_to
+from idml2docbook.logs import pool_logging
+
+def find_inputs(folder, hubxml=False):
+    """Lists the IDML files of a folder and of its subfolders
+    (or the Hub XML files if hubxml is set)."""
+    extension = ".xml" if hubxml else ".idml"
+    return sorted(str(path) for path in Path(folder).rglob("*")
+        if path.is_file() and path.suffix.lower() == extension)
+
+def output_path_of(input, output_folder, root=None):
+    """Where the DocBook file of an input goes, keeping the subfolders
+    the input is in relatively to root."""
+    input = Path(input)
+    relative = input.relative_to(root) if root else Path(input.name)
+    return str(Path(output_folder) / relative.with_suffix(".dbk"))
+
+def check_collisions(outputs):
+    """Raises a ValueError if several inputs would be written to the same output,
+    which happens with files of the same name given as a list."""
+    inputs_of = {}
+    for input, output in outputs.items():
+        inputs_of.setdefault(output, []).append(input)
+    collisions = [output + " <- " + ", ".join(inputs)
+        for output, inputs in inputs_of.items() if len(inputs) > 1]
+    if collisions:
+        raise ValueError("Several inputs would be converted to the same file:\n  "
+            + "\n  ".join(collisions))
+
+def convert_one(input, output, **options):
+    """Converts a single file and returns a result dict,
+    the exceptions are caught and reported in the result."""
+    result = {"input": input, "output": output, "error": None}
+    start = time.perf_counter()
+    try:
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        idml2docbook_to(input, output, **options)
+    except Exception as e:
+        logging.error("Conversion of " + input + " failed:\n" + traceback.format_exc())
+        result["error"] = type(e).__name__ + ": " + str(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def convert_many(inputs, output_folder, jobs=None, **options):
+    """Converts a folder (or a list of files) into output_folder,
+    with jobs worker processes (defaults to the number of CPUs).
+    Returns one result dict per input, with the keys input, output,
+    seconds and error (None when the conversion succeeded).
+    A list of files with the same name raises a ValueError before anything
+    is converted, since their outputs would overwrite one another."""
+    options = DEFAULT_OPTIONS | options
+
+    root = None
+    if isinstance(inputs, (str, Path)):
+        root = inputs
+        inputs = find_inputs(inputs, hubxml=options["idml2hubxml_file"])
+
+    # Largest files first
+    inputs = sorted(inputs, key=file_size, reverse=True)
+    outputs = {input: output_path_of(input, output_folder, root) for input in inputs}
+    check_collisions(outputs)
+    logging.info(f"Converting {len(inputs)} files with {jobs or os.cpu_count()} jobs...")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs, **pool_logging()) as executor:
+        futures = []
+        for input in inputs:
+            output = outputs[input]
+            file_options = dict(options)
+            if root and not options["idml2hubxml_file"]:
+                # Files with the same name in different subfolders must not share their idml2xml output
+                file_options["idml2hubxml_output"] = str(
+                    Path(options["idml2hubxml_output"]) / Path(input).parent.relative_to(root))
+            futures.append(executor.submit(convert_one, input, output, **file_options))
+        for future in as_completed(futures):
+            result = future.result()
+            logging.info(f"{result['input']} converted in {result['seconds']:.2f} s"
+                + (" with error: " + result["error"] if result["error"] else ""))
+            results.append(result)
+
+    order = {input: i for i, input in enumerate(inputs)}
+    return sorted(results, key=lambda result: order[result["input"]])
+
+def format_summary(results, seconds=None):
+    """A human readable report of a batch, slowest files first."""
+    failed = [result for result in results if result["error"]]
+    lines = [f"Converted {len(results) - len(failed)}/{len(results)} files"
+        + (f" in {seconds:.2f} s" if seconds is not None else "") + "."]
+    for result in sorted(results, key=lambda result: result["seconds"], reverse=True):
+        status = "FAILED" if result["error"] else "ok"
+        lines.append(f"{result['seconds']:8.2f} s  {status:6}  {result['input']} -> {result['output']}")
+    if failed:
+        lines.append("")
+        lines.append("Errors:")
+        for result in failed:
+            lines.append(f"  {result['input']}: {result['error']}")
+    return "\n".join(lines)
@@ -0,0 +1,198 @@
+"""Benchmarks of the conversion (idml2docbook-bench).
+
+Every input is converted with every engine a few times, and the best time
+of the whole conversion and of each of its stages (see profiling.py) is
+kept. Larger inputs are made by repeating the content of the fixtures
+(--scale) or generated (--generate, see generate.py). The results are
+written as JSON and can be compared with a baseline saved by a previous
+run: the run fails when the conversion or one of its stages got slower
+than the baseline by more than a given factor.
+
+    idml2docbook-bench -o results.json
+    idml2docbook-bench --baseline results.json --threshold 1.5
+
+Stages shorter than --min-seconds in the baseline are not compared, their
+times are mostly noise."""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+from pathlib import Path
+
+from lxml import etree
+
+from idml2docbook import __version__, DEFAULT_OPTIONS
+from idml2docbook.core import idml2docbook
+from profiling import Profiler
+from generate import generate_hubxml
+
+FIXTURES = [
+    "tests/hello_world/hello_world.xml",
+    "tests/css_transform_direction/css_transform_direction.xml",
+    "tests/bollo/bollo.xml",
+]
+
+ENGINES = ["bs4", "lxml"]
+
+ID_ATTRIBUTES = ["{http://www.w3.org/XML/1998/namespace}id", "linkend", "linkends"]
+
+def scaled_hubxml(path, factor, folder):
+    """Writes a Hub XML file whose content is the one of path repeated factor
+    times (the ids of each copy are suffixed to stay unique) and returns its path."""
+    tree = etree.parse(str(path), etree.XMLParser(huge_tree=True))
+    root = tree.getroot()
+    content = [node for node in root if etree.QName(node).localname != "info"]
+    for copy_index in range(1, factor):
+        for node in content:
+            node = copy.deepcopy(node)
+            for element in node.iter("*"):
+                for attribute in ID_ATTRIBUTES:
+                    if element.get(attribute):
+                        element.set(attribute, " ".join(
+                            value + "-" + str(copy_index) for value in element.get(attribute).split()))
+            root.append(node)
+    output = Path(folder) / (Path(path).stem + "-x" + str(factor) + ".xml")
+    tree.write(str(output), encoding="utf-8", xml_declaration=True)
+    return output
+
+def run_case(input, engine, repeat, **options):
+    """The best time of the conversion and of each stage over repeat runs."""
+    options = DEFAULT_OPTIONS | options | {
+        "idml2hubxml_file": True,
+        "engine": engine,
+        "checkpoints": False,
+        "incremental": False,
+        "profile": False,
+    }
+    best = None
+    for _ in range(repeat):
+        profiler = Profiler(memory=False)
+        idml2docbook(str(input), **(options | {"profiler": profiler}))
+        report = profiler.report()
+        times = {"total": report["wall"], "stages": {stage["name"]: stage["wall"] for stage in report["stages"]}}
+        if best is None:
+            best = times
+        else:
+            best["total"] = min(best["total"], times["total"])
+            for name, seconds in times["stages"].items():
+                best["stages"][name] = min(best["stages"].get(name, seconds), seconds)
+    return best
+
+def run_benchmarks(inputs, engines=ENGINES, repeat=3, scales=(), sizes=(), **options):
+    """sizes are the sizes in MB of synthetic documents to benchmark as well."""
+    results = {
+        "idml2docbook": __version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeat": repeat,
+        "cases": {},
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        files = [Path(input) for input in inputs]
+        for factor in scales:
+            files += [scaled_hubxml(input, factor, folder) for input in inputs]
+        for size in sizes:
+            file = Path(folder) / f"synthetic-{size:g}MB.xml"
+            generate_hubxml(file, size=size)
+            files.append(file)
+        for file in files:
+            for engine in engines:
+                name = file.name + " [" + engine + "]"
+                logging.info("Benchmarking " + name + "...")
+                times = run_case(file, engine, repeat, **options)
+                results["cases"][name] = {"size": os.path.getsize(file), "engine": engine} | times
+                print(f"{name:<48} {times['total']:9.3f} s", file=sys.stderr)
+    return results
+
+def compare(results, baseline, threshold=1.25, min_seconds=0.01):
+    """Lists the regressions of results against baseline: the conversions and
+    stages that got more than threshold times slower."""
+    regressions = []
+    for name, case in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        before = baseline["cases"][name]
+        timings = [("total", case["total"], before["total"])] + [
+            (stage, seconds, before["stages"][stage])
+            for stage, seconds in case["stages"].items() if stage in before["stages"]
+        ]
+        for stage, seconds, seconds_before in timings:
+            if seconds_before >= min_seconds and seconds > seconds_before * threshold:
+                regressions.append(f"{name} {stage}: {seconds_before:.3f} s -> {seconds:.3f} s "
+                    f"(x{seconds / seconds_before:.2f})")
+    return regressions
+
+def format_results(results, baseline=None):
+    lines = [f"{'case':<48} {'size (kB)':>10} {'time (s)':>9} {'baseline':>9}"]
+    for name, case in results["cases"].items():
+        before = (baseline or {}).get("cases", {}).get(name)
+        lines.append(f"{name:<48} {case['size'] / 1024:10.0f} {case['total']:9.3f} "
+            + (f"{before['total']:9.3f}" if before else f"{'':>9}"))
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='idml2docbook-bench',
+        description='Benchmark the conversion of Hub XML files to DocBook.')
+    parser.add_argument(
+        'inputs', nargs='*',
+        help='Hub XML files to convert, defaults to the fixtures of the tests')
+    parser.add_argument(
+        '-e', '--engine', action='append', choices=ENGINES,
+        help='engine to benchmark (can be repeated), defaults to both')
+    parser.add_argument(
+        '-n', '--repeat', type=int, default=3,
+        help='number of runs of each case, the best one is kept, defaults to 3')
+    parser.add_argument(
+        '--scale', type=int, nargs='+', default=[], metavar='FACTOR',
+        help='also benchmark the inputs with their content repeated FACTOR times')
+    parser.add_argument(
+        '--generate', type=float, nargs='+', default=[], metavar='MB',
+        help='also benchmark synthetic documents of the given sizes, in MB')
+    parser.add_argument(
+        '-o', '--output', type=str,
+        help='file where the results are written (JSON)')
+    parser.add_argument(
+        '--baseline', type=str,
+        help='results of a previous run (JSON) to compare with')
+    parser.add_argument(
+        '--threshold', type=float, default=1.25,
+        help='slowdown factor over the baseline above which the run fails, defaults to 1.25')
+    parser.add_argument(
+        '--min-seconds', type=float, default=0.01,
+        help='stages faster than that in the baseline are not compared, defaults to 0.01')
+    args = parser.parse_args(argv)
+
+    inputs = args.inputs or [fixture for fixture in FIXTURES if os.path.exists(fixture)]
+    if not inputs and not args.generate:
+        parser.error("no input given, and the fixtures of the tests are not in the current folder")
+
+    results = run_benchmarks(inputs, args.engine or ENGINES, args.repeat, args.scale, args.generate)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(format_results(results, baseline))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            print(f"\n{len(regressions)} regressions over x{args.threshold}:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print(f"\nNo regression over x{args.threshold}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Content-addressed cache of idml2xml's output.
+
+The Hub XML file produced for an IDML file is stored gzipped under a key
+made of the fingerprint of the IDML package and of the revision of
+idml2xml-frontend, so that converting the same IDML file again (e.g. with
+other options) skips the Java stage, whatever the name or the location of
+the file. The fingerprint is a hash of the files of the package, not of the
+zip file itself, so that a package zipped again without changes is still found.
+GzipCache is also used for the checkpoints of hubxml2docbook (checkpoints.py).
+
+The least recently used entries are evicted when the cache grows over its
+maximum size. Entries are written to a temporary file then renamed, and
+entries evicted by another process are simply considered missing, so that
+several processes can use the same cache folder at once."""
+
+import gzip
+import hashlib
+import io
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import zipfile
+from pathlib import Path
+
+REVISIONS = {}
+
+def frontend_revision(script_folder):
+    """The git commit idml2xml-frontend is at, or the modification time
+    of its script when it is not a git repository."""
+    if not script_folder:
+        return "unknown"
+    if script_folder not in REVISIONS:
+        revision = None
+        try:
+            result = subprocess.run(["git", "-C", script_folder, "rev-parse", "HEAD"],
+                capture_output=True, text=True)
+            if result.returncode == 0:
+                revision = result.stdout.strip()
+        except OSError:
+            pass
+        if revision is None:
+            try:
+                stat = os.stat(os.path.join(script_folder, "idml2xml.sh"))
+                revision = f"{stat.st_mtime_ns}-{stat.st_size}"
+            except OSError:
+                revision = "unknown"
+        REVISIONS[script_folder] = revision
+    return REVISIONS[script_folder]
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hash_package(path):
+    """A single hash of the names and of the contents of the files of an IDML
+    package, in the order of their names: it does not depend on the way the
+    package was zipped. idml2xml converts whole packages only, so the files
+    are not hashed one by one."""
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(path) as package:
+        for info in sorted(package.infolist(), key=lambda info: info.filename):
+            if info.is_dir():
+                continue
+            digest.update(info.filename.encode() + b"\0" + str(info.file_size).encode() + b"\0")
+            with package.open(info) as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+    return digest.hexdigest()
+
+def hash_idml(path):
+    try:
+        return hash_package(path)
+    except zipfile.BadZipFile:
+        return hash_file(path)
+
+def cache_key(input, revision):
+    return hashlib.sha256((hash_idml(input) + "\n" + revision).encode()).hexdigest()
+
+class GzipCache:
+    def __init__(self, folder, max_size=1024, suffix=".xml.gz"):
+        """max_size is in MB."""
+        self.folder = Path(folder)
+        self.max_size = int(float(max_size) * 1024 * 1024)
+        self.suffix = suffix
+
+    def path_of(self, key):
+        return self.folder / key[:2] / (key + self.suffix)
+
+    def get(self, key):
+        """Returns the cached content as bytes, or None."""
+        path = self.path_of(key)
+        try:
+            with gzip.open(path, "rb") as f:
+                hubxml = f.read()
+            os.utime(path) # the modification time tells when the entry was last used
+        except (FileNotFoundError, EOFError, gzip.BadGzipFile):
+            return None
+        return hubxml
+
+    def put(self, key, file):
+        """Stores a copy of file."""
+        with open(file, "rb") as source:
+            self.put_from(key, source)
+
+    def put_bytes(self, key, data, evict=True):
+        self.put_from(key, io.BytesIO(data), evict)
+
+    def put_from(self, key, source, evict=True):
+        path = self.path_of(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                shutil.copyfileobj(source, f)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+        if evict: self.evict()
+
+    def entries(self):
+        """(mtime, size, path) of the entries, the least recently used first."""
+        entries = []
+        for path in self.folder.glob("*/*" + self.suffix):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                path.unlink()
+                logging.debug("Evicted from the cache %s: %s", self.folder, path.name)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def purge(self):
+        for _, _, path in self.entries():
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,80 @@
+"""Checkpoints of the tree hubxml2docbook works on.
+
+The first passes of hubxml2docbook do not depend on most of the options:
+when a file is converted again with another --typography, --linebreaks,
+--media... the conversion resumes from the tree saved after these passes
+instead of parsing the file again. Each stage lists the options its passes
+consumed, a checkpoint is only used by a run with the same values:
+
+* roles: the file is parsed, the roles are renamed, <hub> is an <article>;
+* notes: the overrides are turned into roles, the cleanup is done,
+  the endnotes and the footnotes are processed.
+
+Checkpoints are the serialized trees, gzipped, keyed by the hash of the input
+file, the engine, the stage, the options it consumed and the source code of
+idml2docbook. They are stored in a GzipCache (see cache.py), only when
+asked for (--checkpoints): saving them slows down a first conversion."""
+
+import hashlib
+import json
+import logging
+import os
+
+from cache import GzipCache, hash_file
+
+STAGES = {
+    "roles": [],
+    "notes": ["ignore_overrides"],
+}
+
+CODE_REVISION = None
+
+def code_revision():
+    """Hash of the sources of idml2docbook: checkpoints made by another version are ignored."""
+    global CODE_REVISION
+    if CODE_REVISION is None:
+        digest = hashlib.sha256()
+        folder = os.path.dirname(os.path.realpath(__file__))
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(".py"):
+                with open(os.path.join(folder, name), "rb") as f:
+                    digest.update(name.encode() + b"\0" + f.read())
+        CODE_REVISION = digest.hexdigest()
+    return CODE_REVISION
+
+class Checkpoints:
+    def __init__(self, file, engine, folder, max_size=1024):
+        self.cache = GzipCache(folder, max_size, suffix=".checkpoint.gz")
+        if isinstance(file, (str, os.PathLike)):
+            self.input_hash = hash_file(file)
+        else:
+            self.input_hash = hashlib.sha256(file).hexdigest()
+        self.engine = engine
+
+    @classmethod
+    def of(cls, file, engine, options):
+        """The checkpoints of file (a path or bytes), or None if they are
+        disabled or if file is a file-like object, which cannot be hashed
+        without being consumed."""
+        if not options.get("checkpoints") or hasattr(file, "read"):
+            return None
+        return cls(file, engine, options["checkpoints"], options.get("checkpoints_size") or 1024)
+
+    def key(self, stage, options):
+        consumed = {name: options[name] for name in STAGES[stage]}
+        description = [code_revision(), self.engine, self.input_hash, stage, consumed]
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def latest(self, options):
+        """Returns (stage, data) for the most advanced checkpoint matching options,
+        or (None, None)."""
+        for stage in reversed(list(STAGES)):
+            data = self.cache.get(self.key(stage, options))
+            if data is not None:
+                logging.info("Resuming from the \"" + stage + "\" checkpoint...")
+                return stage, data
+        return None, None
+
+    def save(self, stage, options, data):
+        self.cache.put_bytes(self.key(stage, options), data)
+        logging.info("Checkpoint \"" + stage + "\" saved.")
@@ -1,14 +1,21 @@
 import subprocess
-from bs4 import BeautifulSoup, NavigableString
+from bs4 import BeautifulSoup, NavigableString, Tag
 from idml2docbook import DEFAULT_OPTIONS
 import copy
+import io
 import os
 import re
 import logging
+from collections import Counter
 
 from idml2hubxml import *
 from utils import *
 from map import *
+from dispatch import Dispatcher
+from checkpoints import Checkpoints
+from profiling import profiled, profiler_of
+from typography import locale_typography, strip_typography
+from output import open_output
 
 RASTER_EXTS = [".tif", ".tiff", ".png", ".jpg", ".jpeg", ".psd"]
 VECTOR_EXTS = [".svg", ".eps", ".ai", ".pdf"]
@@ -32,6 +39,11 @@ LAYERS_TO_REMOVE = [
     # "Ants"
 ]
 
+IDML2XML_NS = "http://transpect.io/idml2xml"
+
+# The namespaces of the attributes removed by remove_ns_attributes
+NAMESPACES_TO_REMOVE = [CSS_NS, IDML2XML_NS]
+
 ATTRIBUTES_TO_REMOVE = [
     # "idml2xml:layer", # means that it must be after the previous removals
     # "xmlns:idml2xml",
@@ -47,23 +59,50 @@ def remove_unnecessary_nodes(soup):
     for el in soup.find_all(attrs={"remap": "idml2xml:control"}):
         el.decompose()
 
-def remove_unnecessary_attributes(soup):
+def remove_unnecessary_attributes_of(tag):
     for attr in ATTRIBUTES_TO_REMOVE:
-        for el in soup.find_all(attrs={attr: True}): del el[attr]
+        if attr in tag.attrs: del tag[attr]
+
+def remove_unnecessary_attributes(soup):
+    for el in soup.find_all(True): remove_unnecessary_attributes_of(el)
 
 def unwrap_unnecessary_nodes(soup):
     for tag in NODES_TO_UNWRAP:
         for el in soup.find_all(tag):
-            logging.debug("Unwrapping " + tag)
+            logging.debug("Unwrapping %s", tag)
             el.unwrap()
 
+def fill_empty_element_with_br(el):
+    if el.is_empty_element:
+        el.append(Tag(name="br", can_be_empty_element=True))
+
 def fill_empty_elements_with_br(soup):
     """Adds a <br> tag in every empty para element.
     """
     logging.info("Removing empty elements...")
-    for el in soup.find_all("para"):
-        if el.is_empty_element:
-            el.append(soup.new_tag("br"))
+    for el in soup.find_all("para"): fill_empty_element_with_br(el)
+
+def convert_media_fileref(fileref, rep_raster = None, rep_vector = None, folder = None):
+    """Returns the new fileref of a media: the filename is slugified,
+    its extension replaced if needed, and its folder changed if one is given."""
+    new_fileref = ""
+
+    base, file_ext = os.path.splitext(fileref)
+
+    # Decode the base
+    base = decode_path(base)
+
+    # Slugify the filename
+    filename = base.split("/").pop()
+    filename = custom_slugify(filename, 100)
+    base = "/".join(base.split("/")[:-1]) + "/" + filename
+
+    if rep_raster and (file_ext.lower() in RASTER_EXTS): new_fileref = base + "." + rep_raster
+    elif rep_vector and (file_ext.lower() in VECTOR_EXTS): new_fileref = base + "." + rep_vector
+    else: new_fileref = base + file_ext.lower()
+
+    if folder: return folder + "/" + new_fileref.split("/").pop()
+    return new_fileref
 
 def process_images(soup, rep_raster = None, rep_vector = None, folder = None):
     logging.info("Processing media filenames...")
@@ -71,35 +110,20 @@ def process_images(soup, rep_raster = None, rep_vector = None, folder = None):
     for tag in soup.find_all(["mediaobject", "inlinemediaobject"]):
         imagedata = tag.find_next("imagedata")
         fileref = imagedata["fileref"]
-        new_fileref = ""
-
-        base, file_ext = os.path.splitext(fileref)
-    
-        # Decode the base
-        base = decode_path(base)
-
-        # Slugify the filename
-        filename = base.split("/").pop()
-        filename = custom_slugify(filename, 100)
-        base = "/".join(base.split("/")[:-1]) + "/" + filename
-
-        if rep_raster and (file_ext.lower() in RASTER_EXTS): new_fileref = base + "." + rep_raster
-        elif rep_vector and (file_ext.lower() in VECTOR_EXTS): new_fileref = base + "." + rep_vector
-        else: new_fileref = base + file_ext.lower()
-
-        if folder: imagedata["fileref"] = folder + "/" + new_fileref.split("/").pop()
-        else: imagedata["fileref"] = new_fileref
+        imagedata["fileref"] = convert_media_fileref(fileref, rep_raster, rep_vector, folder)
 
         if (rep_raster or rep_vector or folder):
-            logging.debug("Media was: " + fileref)
-            logging.debug("and is now: " + imagedata["fileref"])
+            logging.debug("Media was: %s", fileref)
+            logging.debug("and is now: %s", imagedata["fileref"])
+
+def process_tab(tab):
+    tab.name = "phrase"
+    if "role" in tab.attrs.keys(): tab["role"] += " converted-tab"
+    else: tab["role"] = "converted-tab"
 
 def process_tabs(soup):
     """<tab> elements are replaced by <phrase role="[existing role] converted-tab">[tag children]</phrase>"""
-    for tab in soup.find_all("tab"):
-        tab.name = "phrase"
-        if "role" in tab.attrs.keys(): tab["role"] += " converted-tab"
-        else: tab["role"] = "converted-tab"
+    for tab in soup.find_all("tab"): process_tab(tab)
 
 def process_endnotes(soup):
     """In DocBook, there is no difference between an endnote and a footnote.
@@ -126,56 +150,99 @@ def process_endnotes(soup):
 
     logging.info("Processing endnotes...")
 
-    # Map of endnote anchors by id for quick lookup
-    endnote_map = {}
-    for anchor in soup.find_all("anchor", attrs={"role": "hub:endnote"}):
-        anchor_id = anchor.get("xml:id")
-        if not anchor_id:
-            continue
-        para = anchor.find_parent("para")
-        if para:
-            endnote_map[anchor_id] = para
+    endnote_map, links = index_endnotes(soup)
+    replace_endnote_links(soup, endnote_map, links)
+
+    # After all replacements, remove original endnote paras
+    decompose_all(endnote_map.values())
+
+    log_endnotes_summary(endnote_map, [link.get("linkend") for link in links])
+    logging.info("Endnotes processed successfully.")
 
-    # Process all in-text endnote references
-    for link in soup.find_all("link", attrs={"remap": "EndnoteRange"}):
+def index_endnotes(soup):
+    """Walks the tree once and returns the endnote paragraphs by anchor id,
+    and the EndnoteRange links in document order."""
+    endnote_map = {}
+    links = []
+    for tag in soup.find_all(["anchor", "link"]):
+        if tag.name == "anchor":
+            anchor_id = tag.get("xml:id")
+            if tag.get("role") != "hub:endnote" or not anchor_id:
+                continue
+            para = tag.find_parent("para")
+            if para:
+                endnote_map[anchor_id] = para
+        elif tag.get("remap") == "EndnoteRange":
+            links.append(tag)
+    return endnote_map, links
+
+def is_endnote_marker(tag):
+    if tag.name == "anchor":
+        return tag.get("role") == "hub:endnote"
+    return tag.name == "link" and tag.get("remap") == "EndnoteMarker"
+
+def endnote_contents(para):
+    """Removes the markers of an endnote paragraph (the anchor and the
+    EndnoteMarker link) and returns what is left of its contents."""
+    for tag in para.find_all(["anchor", "link"]):
+        if is_endnote_marker(tag):
+            tag.decompose()
+    return [child for child in para.contents if not (isinstance(child, NavigableString) and not child.strip())]
+
+def replace_endnote_links(soup, endnote_map, links):
+    """Replaces the links with footnotes holding their endnote. The content of an
+    endnote is moved into the footnote of its last link, it is only copied
+    for the links before, when the endnote is referenced more than once."""
+    remaining = Counter(link.get("linkend") for link in links)
+    for link in links:
         linkend = link.get("linkend")
         if not linkend or linkend not in endnote_map:
-            logging.warning(f"Endnote target not found for linkend={linkend}")
             continue
-
-        # Get the corresponding endnote paragraph
-        endnote_para = endnote_map[linkend]
-
-        # Deep copy the content
-        note_copy = copy.copy(endnote_para)
-
-        # remove the anchor that only marks the note location
-        for el in note_copy.find_all("anchor", attrs={"role": "hub:endnote"}):
-            el.decompose()
-        
-        # remove only the EndnoteMarker link
-        for el in note_copy.find_all("link", attrs={"remap": "EndnoteMarker"}):
-            el.decompose()
-
-        note_text_content = [child for child in note_copy.contents if not (isinstance(child, NavigableString) and not child.strip())]
+        remaining[linkend] -= 1
+        note = endnote_map[linkend]
+        if remaining[linkend]:
+            note = copy.copy(note)
 
         # Create the <footnote> structure
         footnote_tag = soup.new_tag("footnote")
-        footnote_tag["endnote"] = "1" # This acts as a marker to differiate endnotes from footnotes
+        footnote_tag["endnote"] = "1" # This acts as a marker to differiate endnotes from footnotes
         para_tag = soup.new_tag("para")
 
-        for child in note_text_content:
-            para_tag.append(copy.copy(child))
+        for child in endnote_contents(note):
+            para_tag.append(child)
 
         footnote_tag.append(para_tag)
 
         link.replace_with(footnote_tag)
 
-    # After all replacements, remove original endnote paras
-    for para in set(endnote_map.values()):
-        para.decompose()
-
-    logging.info("Endnotes processed successfully.")
+def decompose_all(tags):
+    """Decomposes tags, looking for their positions with one scan of each
+    parent, where decompose() would scan the parent for each of them."""
+    parents = {}
+    for tag in tags:
+        if tag.parent is not None:
+            parents.setdefault(id(tag.parent), (tag.parent, set()))[1].add(id(tag))
+    for parent, ids in parents.values():
+        indexes = [i for i, child in enumerate(parent.contents) if id(child) in ids]
+        for i in reversed(indexes):
+            parent.contents[i].extract(_self_index=i).decompose()
+
+def log_endnotes_summary(anchor_ids, linkends):
+    """Logs in one message the endnotes no link refers to, the links
+    to missing endnotes and the endnotes referenced more than once."""
+    references = Counter(linkends)
+    orphans = [anchor_id for anchor_id in anchor_ids if anchor_id not in references]
+    dangling = [str(linkend) for linkend in references if linkend not in anchor_ids]
+    shared = [anchor_id for anchor_id, count in references.items() if count > 1 and anchor_id in anchor_ids]
+
+    def listed(ids):
+        return ", ".join(ids[:10]) + (f" and {len(ids) - 10} more" if len(ids) > 10 else "")
+
+    summary = f"{len(anchor_ids)} endnotes, {len(linkends)} references."
+    if orphans: summary += f"\n  {len(orphans)} endnotes are not referenced: {listed(orphans)}"
+    if dangling: summary += f"\n  {len(dangling)} references point to no endnote: {listed(dangling)}"
+    if shared: summary += f"\n  {len(shared)} endnotes are referenced more than once: {listed(shared)}"
+    logging.log(logging.WARNING if orphans or dangling else logging.INFO, summary)
 
 def process_notes(soup):
     for footnote_tag in soup.select("footnote"):
@@ -186,25 +253,64 @@ def remove_linebreak_before_and_after_phrase(soup):
     for tag in soup.select("phrase"):
         remove_linebreak_before_and_after(tag)
 
+def is_css_node(tag):
+    return tag.namespace == CSS_NS
+
+def remove_ns_attributes_of(tag):
+    """Removes the CSSa and idml2xml attributes, whatever their prefix,
+    and the declarations of the namespaces (xmlns:*)."""
+    to_remove = []
+    for attr, _ in tag.attrs.items():
+        if getattr(attr, "namespace", None) in NAMESPACES_TO_REMOVE or attr.startswith("xmlns:"):
+            to_remove.append(attr)
+    for attr in to_remove:
+        del tag[attr]
+    unprefix_undeclared_attributes(tag)
+
 def remove_ns_attributes(soup):
     # Remove all css nodes
     for tag in soup.select('css|*'):
         tag.decompose()
     # Remove attributes
-    for tag in soup.select("*"):
-        to_remove = []
-        for attr, _ in tag.attrs.items():
-            if attr.startswith("css:") or attr.startswith("xmlns:") or attr.startswith("idml2xml:"):
-                to_remove.append(attr)
-        for attr in to_remove:
-            del tag[attr]
+    for tag in soup.select("*"): remove_ns_attributes_of(tag)
+
+def unprefix_undeclared_attributes(tag):
+    """Once the xmlns:* declarations are gone, prefixed attributes other than
+    xml:* (e.g. xlink:href) would be left undeclared: they are renamed to their local name."""
+    undeclared = [attr for attr in tag.attrs if getattr(attr, "prefix", None) not in (None, "xml", "xmlns")]
+    for attr in undeclared:
+        tag[attr.name] = tag.attrs.pop(attr)
+
+def unwrap_phrase_without_attribute(tag):
+    # tabs gets protected from this.
+    if tag.get("role") == "converted-tab":
+        return
+    if (tag.attrs == {}): tag.unwrap()
 
 def unwrap_phrase_without_attributes(soup):
-    for tag in soup.find_all("phrase"):
-        # tabs gets protected from this.
-        if tag.get("role") == "converted-tab":
-            continue
-        if (tag.attrs == {}): tag.unwrap()
+    for tag in soup.find_all("phrase"): unwrap_phrase_without_attribute(tag)
+
+# The passes above only look at the element they are given, so they are fused
+# into a few walks of the tree. The handlers run in their registration order.
+
+# Replaces remove_unnecessary_nodes, remove_unnecessary_attributes,
+# remove_ns_attributes and process_tabs
+CLEANUP = Dispatcher("cleanup")
+CLEANUP.register(Tag.decompose, tags=NODES_TO_REMOVE, name="remove_unnecessary_node")
+CLEANUP.register(Tag.decompose, attrs={"remap": "idml2xml:control"}, name="remove_control_node")
+CLEANUP.register(remove_unnecessary_attributes_of)
+CLEANUP.register(Tag.decompose, predicate=is_css_node, name="remove_css_node")
+CLEANUP.register(remove_ns_attributes_of)
+CLEANUP.register(process_tab, tags=["tab"])
+
+# Replaces fill_empty_elements_with_br and unwrap_phrase_without_attributes
+FINISHING = Dispatcher("finishing")
+FINISHING.register(fill_empty_element_with_br, tags=["para"])
+FINISHING.register(unwrap_phrase_without_attribute, tags=["phrase"])
+
+# Replaces remove_linebreak_before_and_after_phrase
+PHRASE_LINEBREAKS = Dispatcher("phrase linebreaks")
+PHRASE_LINEBREAKS.register(remove_linebreak_before_and_after, tags=["phrase"])
 
 def remove_linebreaks(soup):
     """When working with ragged paragraphs, some <br> tags might be added
@@ -217,43 +323,159 @@ def remove_linebreaks(soup):
             tag.string = " "
             tag.unwrap()
 
-def replace_linebreaks(string):
-    return string.replace("<br/>", "<simpara><?asciidoc-br?></simpara>")
+LINEBREAK = "<simpara><?asciidoc-br?></simpara>"
+
+def replace_linebreaks(string, linebreak=LINEBREAK):
+    return string.replace("<br/>", linebreak) if linebreak else string
+
+# URLs are matched with a scanner rather than with a single regular expression:
+# https?://([-A-zÀ-ÿ0-9]+\.)?([-A-zÀ-ÿ0-9@:%._\+~#=]+(<br/>)?)+\.[A-zÀ-ÿ0-9()]{1,6}(\b[-A-zÀ-ÿ0-9()@:%;_\+.~#?&//=]*(<br/>)?)*
+# finds the same URLs, but its nested quantifiers backtrack exponentially
+# on long runs of URL characters that do not end like a URL.
+URL_START = re.compile(r"https?://")
+URL_HOST = re.compile(r"[-A-zÀ-ÿ0-9@:%._\+~#=]+")
+URL_TLD = re.compile(r"[A-zÀ-ÿ0-9()]{1,6}")
+URL_PATH = re.compile(r"[-A-zÀ-ÿ0-9()@:%;_\+.~#?&/=]*")
+WORD_BOUNDARY = re.compile(r"\b")
+BR = "<br/>"
+
+def url_end(s, begin):
+    """End of the URL whose host starts at begin in s, or None if there is no URL there.
+
+    The host is made of runs of host characters, each of them possibly followed
+    by a <br/>, and it ends with the last dot followed by a top-level domain.
+    The path is then made of runs of path characters, each of them possibly
+    followed by a <br/>, that start on a word boundary."""
+    end = begin
+    dot = None
+    while True:
+        run = URL_HOST.match(s, end)
+        if run is None:
+            break
+        i = run.end()
+        while i > run.start():
+            i = s.rfind(".", run.start(), i)
+            if i <= begin:
+                break
+            if URL_TLD.match(s, i + 1):
+                dot = i
+                break
+        end = run.end()
+        if not s.startswith(BR, end):
+            break
+        end += len(BR)
+
+    if dot is None:
+        return None
+
+    end = URL_TLD.match(s, dot + 1).end()
+    while WORD_BOUNDARY.match(s, end):
+        path_end = URL_PATH.match(s, end).end()
+        if s.startswith(BR, path_end):
+            path_end += len(BR)
+        if path_end == end:
+            break
+        end = path_end
+    return end
+
+def find_urls(s):
+    """(start, end) of the URLs of s, a string where line breaks are written <br/>.
+    Every character of s is looked at a bounded number of times."""
+    spans = []
+    pos = 0
+    while True:
+        start = URL_START.search(s, pos)
+        if start is None:
+            return spans
+        end = url_end(s, start.end())
+        if end is None:
+            pos = start.start() + 1
+        else:
+            spans.append((start.start(), end))
+            pos = end
+
+def linebreaks_in_urls(s, offsets):
+    """Indexes of the offsets (sorted positions of <br/> in s) that are inside a URL."""
+    indexes = []
+    i = 0
+    for start, end in find_urls(s):
+        while i < len(offsets) and offsets[i] < start:
+            i += 1
+        while i < len(offsets) and offsets[i] < end:
+            indexes.append(i)
+            i += 1
+    return indexes
+
+def is_plain_br(node):
+    return isinstance(node, Tag) and node.name == "br" and not node.attrs and not node.contents
 
 def clean_urls_from_linebreaks(soup):
     """URLs can have line breaks within to compose correct rags.
     This method removes those line breaks by joining the strings that start with http and
-    that are separated by a <br/> tag. The URL can't end with a line break in the source file."""
-    s = str(soup)
+    that are separated by a <br/> tag. The URL can't end with a line break in the source file.
+
+    URLs are looked for in the serialized form of each run of sibling
+    text nodes and <br/> tags, so that the tree never has to be reparsed."""
+    parents = []
+    for br in soup.find_all("br"):
+        if br.parent is not None and (not parents or parents[-1] is not br.parent):
+            parents.append(br.parent)
+
+    for parent in parents:
+        run = []
+        for child in list(parent.children) + [None]:
+            if type(child) is NavigableString or is_plain_br(child):
+                run.append(child)
+                continue
+            if len(run) > 1:
+                join_url_run(run)
+            run = []
+
+    normalize_strings(soup)
+
+    return soup
 
-    url_regex_with_br = r"https?:\/\/([-A-zÀ-ÿ0-9]+\.)?([-A-zÀ-ÿ0-9@:%._\+~#=]+(<br/>)?)+\.[A-zÀ-ÿ0-9()]{1,6}(\b[-A-zÀ-ÿ0-9()@:%;_\+.~#?&//=]*(<br/>)?)*"
+def join_url_run(run):
+    parts = []
+    length = 0
+    brs = []
+    offsets = []
+    for node in run:
+        if isinstance(node, Tag):
+            brs.append(node)
+            offsets.append(length)
+            part = BR
+        else:
+            part = escape_xml_text(node)
+        parts.append(part)
+        length += len(part)
+
+    for i in linebreaks_in_urls("".join(parts), offsets):
+        brs[i].decompose()
 
-    def replacer(match):
-        return match.group(0).replace(r"<br/>", "")
-    
-    return BeautifulSoup(re.sub(url_regex_with_br, replacer, s), "xml")
+def strip_orthotypography(s):
+    """Removes the non-discretionary hyphens and replaces the special spaces with spaces."""
+    return strip_typography(s)
 
 def remove_orthotypography(soup):
+    """Removes the non-discretionary hyphens and the special spaces of the input.
+    Attribute values are processed as well as text nodes."""
     logging.info("Removing input's orthotypography...")
-    s = str(soup)
-
-    # Remove non-discretionary hyphens
-    non_discretionary_hyphen = u"\u00ad"
-    s = s.replace(non_discretionary_hyphen, "")
 
-    # Replace special spaces with spaces
-    special_spaces = [
-    u"\u00a0", u"\u1680", u"\u180e", u"\u2000", u"\u2001", u"\u2002", u"\u2003", u"\u2004",
-    u"\u2005", u"\u2006", u"\u2007", u"\u2008", u"\u2009", u"\u200a", u"\u200b", u"\u202f",
-    u"\u205f", u"\u3000"
-    ]
+    for tag in soup.find_all(True):
+        for attr, value in tag.attrs.items():
+            if isinstance(value, str):
+                new_value = strip_orthotypography(value)
+                if new_value != value: tag[attr] = new_value
 
-    for space in special_spaces:
-        s = s.replace(space, " ")
+    for node in soup.find_all(string=True):
+        text = str(node)
+        new_text = strip_orthotypography(text)
+        if new_text != text: node.replace_with(type(node)(new_text))
 
-    s = s.replace(r"\s+", " ") # remove double spaces
+    normalize_strings(soup)
 
-    return BeautifulSoup(s, "xml")
+    return soup
 
 def linebreaks_cleanup(soup):
     """idml2hubxml-frontend does not handle perfectly the way inlines
@@ -272,17 +494,29 @@ def linebreaks_cleanup(soup):
     ; blabla...
     """
     logging.info("Cleaning up extra linebreaks...")
-    s = str(soup)
 
-    pattern_leading_char = re.compile(
-        r'\s((<phrase[^>]*>)?([\.,;:!’\?\)\]…]).*?(<\/phrase>)?)'
-    )
-    s = pattern_leading_char.sub(r'\1', s)
+    pattern_leading_char = re.compile(r'\s([\.,;:!’\?\)\]…])')
+    pattern_trailing_apostrophe = re.compile(r'([’\(\[])\s')
+
+    for node in list(soup.find_all(string=True)):
+        if type(node) is not NavigableString:
+            continue
+        text = pattern_leading_char.sub(r'\1', str(node))
+        text = pattern_trailing_apostrophe.sub(r'\1', text)
+
+        # Whitespace before a <phrase> that starts with a punctuation mark
+        nxt = node.next_sibling
+        if text[-1:].isspace() and getattr(nxt, "name", None) == "phrase" \
+                and first_char(nxt) and first_char(nxt) in ".,;:!’?)]…":
+            text = text[:-1]
+
+        # Whitespace after a <phrase> that ends with an apostrophe or an opening bracket
+        prev = node.previous_sibling
+        if text[:1].isspace() and getattr(prev, "name", None) == "phrase" \
+                and last_char(prev) and last_char(prev) in "’([":
+            text = text[1:]
 
-    pattern_trailing_apostrophe = re.compile(
-        r'((<phrase[^>]*>)?.*?([’\(\[])(<\/phrase>)?)\s'
-    )
-    s = pattern_trailing_apostrophe.sub(r'\1', s)
+        if text != str(node): node.replace_with(text)
 
     # Now we need to take care about footnotes
     # Dunno why it does not work...
@@ -291,7 +525,9 @@ def linebreaks_cleanup(soup):
     # )
     # s = pattern_footnote.sub(r'\1', s)    
 
-    return BeautifulSoup(s, "xml")
+    normalize_strings(soup)
+
+    return soup
 
 def replace_linebreaks_after_css_attributes(soup):
     logging.info("Replacing linebreaks after <phrase> with typographical heuristics...")
@@ -324,138 +560,215 @@ def replace_linebreaks_after_css_attributes(soup):
 
     return soup
 
-def add_french_orthotypography(soup, thin_spaces):
-    """Applies a series of regex to comply to French orthotypography rules
-    if thin_spaces, it only uses non-breaking thin spaces.
+def french_orthotypography(text, thin_spaces):
+    """Applies the French rules of typography.py to a string to comply to French orthotypography rules.
+    If thin_spaces, it only uses non-breaking thin spaces.
     """
+    return locale_typography("fr", thin_spaces)(text)
+
+def add_french_orthotypography(soup, thin_spaces):
+    """Applies french_orthotypography to every text node of the soup.
+    Only the nodes whose text changes are replaced."""
     logging.info("Adding new french orthotypography...")
 
+    typography = locale_typography("fr", thin_spaces)
     for node in soup.find_all(string=True):
-        if not isinstance(node, NavigableString):
+        if type(node) is not NavigableString:
             continue
-        text = str(node)
-        text = re.sub(r"\s+([!\?;€\$%])", u"\u202f" + r'\1', text) # thin spaces
-        text = re.sub(r"\s+\:", (u"\u202f" if thin_spaces else u"\u00a0") + r':', text) # nbsp, doesn't seem to work...
-        text = re.sub(r"(\d)\s+(\d\d\d)", r'\1' + u"\u202f" + r'\2', text) # numbers
-        text = re.sub(r"«\s*", r'«' + u"\u202f", text) # quotes
-        text = re.sub(r"\s*»", u"\u202f" + r'»', text) # quotes
-        text = re.sub(r"([^0-9])°\s*", r'\1°' + u"\u202f", text) # degrees
-        text = re.sub(r"\.\.\.", r'…', text) # suspension marks
-        node.replace_with(text)
+        text = typography(node)
+        if text != node: node.replace_with(text)
 
     return soup
 
-def merge_adjacent_phrases_with_same_role(soup):
+def merge_adjacent_phrases_with_same_role(soup, same_attributes=False):
     """
     Merge consecutive <phrase> elements that:
     - have only one attribute
     - that attribute is 'role'
     - and the role value is identical
+    or, if same_attributes is set, that have the same attributes.
+    Every parent is scanned once: a run of such phrases is merged into its first phrase.
     """
     logging.info("Merging adjacent phrases with identical role…")
 
+    def mergeable(cur, nxt):
+        if getattr(cur, "name", None) != "phrase" or getattr(nxt, "name", None) != "phrase":
+            return False
+        if same_attributes:
+            return cur.attrs == nxt.attrs
+        return cur.attrs.keys() == {"role"} and nxt.attrs.keys() == {"role"} and cur["role"] == nxt["role"]
+
     for parent in soup.find_all(True):  # iterate through all possible parents
-        children = list(parent.children)
+        children = parent.contents
         i = 0
         while i < len(children) - 1:
-            cur = children[i]
-            nxt = children[i + 1]
-
-            if (
-                getattr(cur, "name", None) == "phrase" and
-                getattr(nxt, "name", None) == "phrase" and
-                cur.attrs.keys() == {"role"} and
-                nxt.attrs.keys() == {"role"} and
-                cur["role"] == nxt["role"]
-            ):
-                # Merge nxt into cur
-                for content in list(nxt.contents):
-                    cur.append(content)
-
-                nxt.decompose()
-                children.pop(i + 1)
-                # do not increment i: there might be another phrase to merge
-                continue
+            first = children[i]
+            end = i + 1
+            while end < len(children) and mergeable(first, children[end]):
+                end += 1
+
+            if end > i + 1:
+                # Their positions are known: extract() would otherwise look for them in the parent
+                run = [children[j].extract(_self_index=j) for j in range(end - 1, i, -1)]
+                for nxt in reversed(run):
+                    for content in list(nxt.contents):
+                        first.append(content)
+                    nxt.decompose()
 
             i += 1
 
     return soup
 
+def serialized(node):
+    return node.decode() if isinstance(node, Tag) else node.output_ready()
+
+def iter_serialized(soup):
+    """Yields str(soup) chunk by chunk, with the <br/> tags replaced (see replace_linebreaks):
+    the children of the root element are serialized one at a time."""
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    for node in soup.contents:
+        if not isinstance(node, Tag) or not node.contents:
+            yield replace_linebreaks(serialized(node))
+            continue
+        name = (node.prefix + ":" if node.prefix else "") + node.name
+        attributes = "".join(" " + key + "=" + quoted_attribute_value(value) for key, value in sorted(node.attrs.items()))
+        yield "<" + name + attributes + ">"
+        for child in node.contents:
+            yield replace_linebreaks(serialized(child))
+        yield "</" + name + ">"
+
+def write_docbook(chunks, output):
+    """Writes the chunks of DocBook to the output file-like object, reindented as they come."""
+    writer = ReindentingWriter(output)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+
 def hubxml2docbook(file, **options):
+    output = io.StringIO()
+    hubxml2docbook_to(file, output, **options)
+    return output.getvalue()
+
+def hubxml2docbook_to(file, output, **options):
+    """Converts the Hub XML file to DocBook, and writes the result to the output file-like object."""
+    if options.get("incremental") or options.get("streaming"):
+        from streaming import hubxml2docbook_stream
+        return hubxml2docbook_stream(file, output, **options)
+
+    if options.get("engine") == "lxml":
+        from lxml_engine import hubxml2docbook_to as hubxml2docbook_lxml
+        return hubxml2docbook_lxml(file, output, **options)
+
     logging.info("hubxml2docbook starting...")
-    # Read the HTML input file
-    with open(file, "r") as f:
-        xml_content = f.read()
 
-    logging.info(file + " read succesfully!")
+    profiler = profiler_of(options)
+    stage = profiler.stage
 
-    soup = BeautifulSoup(xml_content, "xml")
+    checkpoints = Checkpoints.of(file, "bs4", options)
+    stage_reached, checkpoint = checkpoints.latest(options) if checkpoints else (None, None)
 
-    # This line fixes the roles names
-    # If your map file was designed using v0.1.0, comment it
-    fix_role_names(soup)
+    if stage_reached is not None:
+        with stage("load checkpoint", lambda: soup): soup = BeautifulSoup(checkpoint, "xml")
+    else:
+        with stage("parse", lambda: soup):
+            # The parser decodes the bytes itself, from the encoding declared by the file
+            source = binary_source(file)
+            if is_path(source):
+                with open(source, "rb") as f:
+                    soup = BeautifulSoup(f, "xml")
+            else:
+                soup = BeautifulSoup(source, "xml")
 
-    for hub in soup.find_all("hub"):
-        hub.name = "article"
-        hub["version"] = "5.0"
-    for tag in soup.find_all(string=lambda text: isinstance(text, str) and text.strip().startswith("xml-model")):
-        tag.extract()
+            logging.info(input_name(file) + " read succesfully!")
 
-    replace_linebreaks_after_css_attributes(soup)
+        # This line fixes the roles names
+        # If your map file was designed using v0.1.0, comment it
+        with stage("fix_role_names", soup): fix_role_names(soup)
 
-    if not options["ignore_overrides"]: soup, _, _ = turn_overrides_into_roles(str(soup))
+        with stage("rename_hub", soup):
+            for hub in soup.find_all("hub"):
+                hub.name = "article"
+                hub["version"] = "5.0"
+            for tag in soup.find_all(string=lambda text: isinstance(text, str) and text.strip().startswith("xml-model")):
+                tag.extract()
 
-    remove_unnecessary_nodes(soup)
-    # remove_unnecessary_layer(soup)
-    remove_unnecessary_attributes(soup)
-    remove_ns_attributes(soup)
+        with stage("replace_linebreaks_after_css_attributes", soup): replace_linebreaks_after_css_attributes(soup)
 
-    process_images(soup,
-        options["raster"],
-        options["vector"],
-        options["media"])
+        if checkpoints:
+            with stage("save checkpoint"): checkpoints.save("roles", options, str(soup).encode("utf-8"))
 
-    process_tabs(soup)
+    if stage_reached != "notes":
+        if not options["ignore_overrides"]:
+            with stage("turn_overrides_into_roles", soup): turn_overrides_into_roles(soup)
 
-    process_endnotes(soup)
-    process_notes(soup)
+        # remove_unnecessary_layer(soup)
+        profiler.walk(CLEANUP, soup)
 
-    soup = clean_urls_from_linebreaks(soup) # must be done before remove_linebreaks and removeHyphens
+        with stage("process_endnotes", soup): process_endnotes(soup)
+        with stage("process_notes", soup): process_notes(soup)
 
-    if not options["linebreaks"]: remove_linebreaks(soup)
+        if checkpoints:
+            with stage("save checkpoint"): checkpoints.save("notes", options, str(soup).encode("utf-8"))
 
-    fill_empty_elements_with_br(soup)
+    with stage("process_images", soup):
+        process_images(soup,
+            options["raster"],
+            options["vector"],
+            options["media"])
 
-    unwrap_phrase_without_attributes(soup)
+    with stage("clean_urls_from_linebreaks", soup): clean_urls_from_linebreaks(soup) # must be done before remove_linebreaks and removeHyphens
+
+    if not options["linebreaks"]:
+        with stage("remove_linebreaks", soup): remove_linebreaks(soup)
+
+    logging.info("Removing empty elements...")
+    profiler.walk(FINISHING, soup)
 
     # In what cases was this line useful already?
     # soup = remove_hyphens(soup, "xml")
 
     if options["typography"]:
-        soup = remove_orthotypography(soup)
-        soup = add_french_orthotypography(soup, options["thin_spaces"])
+        with stage("typography", soup):
+            remove_orthotypography(soup)
+            add_french_orthotypography(soup, options["thin_spaces"])
 
-    remove_linebreak_before_and_after_phrase(soup)
-    merge_adjacent_phrases_with_same_role(soup)
-    docbook = str(soup)
-
-    docbook = replace_linebreaks(docbook)
+    profiler.walk(PHRASE_LINEBREAKS, soup)
+    with stage("merge_adjacent_phrases_with_same_role", soup):
+        merge_adjacent_phrases_with_same_role(soup, options["merge_identical_phrases"])
+    with stage("serialization"): write_docbook(iter_serialized(soup), output)
 
     logging.info("hubxml2docbook done.")
 
-    return reindent_xml_lines(docbook)
-
 def idml2docbook(input, **options):
+    output = io.StringIO()
+    idml2docbook_to(input, output, **options)
+    return output.getvalue()
+
+def idml2docbook_to(input, output, **options):
+    """Same as idml2docbook, but the DocBook is written to output as it is produced.
+    input is a path, bytes or a binary file-like object (e.g. sys.stdin.buffer
+    or an mmap). output is a file-like object, or the path of a file, which is written
+    atomically and gzip-compressed if it ends with .gz (see output.py)."""
+    if not hasattr(output, "write"):
+        with open_output(output) as file:
+            return idml2docbook_to(input, file, **options)
+
     logging.info("idml2docbook starting...")
 
     # Merging argument options with default options
     options = DEFAULT_OPTIONS | options
 
-    if options["idml2hubxml_file"]:
-        hubxml = input
-        logging.warning("Directly reading the input as a hubxml file.")
-    else:
-        hubxml = idml2hubxml(input, **options)
-    docbook = hubxml2docbook(hubxml, **options)
+    with profiled(options) as options:
+        if options["idml2hubxml_file"]:
+            hubxml = input
+            logging.warning("Directly reading the input as a hubxml file.")
+        else:
+            with profiler_of(options).stage("idml2xml"), idml_path(input) as path:
+                hubxml = idml2hubxml_bytes(path, **options)
+        hubxml2docbook_to(hubxml, output, **options)
     logging.info("idml2docbook done.")
-    return docbook
\ No newline at end of file
+
+def idml2docbook_stream(input, output, **options):
+    """Same as idml2docbook_to, but the Hub XML file is converted part by part
+    (see streaming.py)."""
+    idml2docbook_to(input, output, **(options | {"streaming": True}))
@@ -0,0 +1,109 @@
+"""Runs several tree-rewriting handlers in a single traversal of the tree.
+
+Passes register handlers with the tag names and/or the attributes
+they apply to. During a walk, every element is given to the handlers
+that match it, in their registration order. As soon as a handler detaches
+the element from the tree (decompose, unwrap...), the remaining handlers
+are skipped for this element. The number of times each handler fired
+is recorded in Dispatcher.counts, and the time spent in each handler
+in Dispatcher.times when the walk is given a timer (see profiling.py)."""
+
+import logging
+from collections import Counter
+from bs4 import Tag
+
+def bs4_name(tag):
+    return tag.name
+
+def bs4_attrs(tag):
+    return tag.attrs
+
+def bs4_is_detached(tag, soup):
+    # Decomposed tags have no parent either, and checking .decomposed is slow
+    return tag.parent is None
+
+def bs4_elements(soup, names=None):
+    return [node for node in soup.descendants
+            if isinstance(node, Tag) and (names is None or node.name in names)]
+
+class Dispatcher:
+    def __init__(self, name="dispatcher",
+            name_of=bs4_name, attrs_of=bs4_attrs,
+            is_detached=bs4_is_detached, elements_of=bs4_elements):
+        self.name = name
+        self.handlers = []
+        self.handlers_by_name = {}
+        self.counts = Counter()
+        self.times = Counter()
+        self.name_of = name_of
+        self.attrs_of = attrs_of
+        self.is_detached = is_detached
+        self.elements_of = elements_of
+
+    def register(self, handler, tags=None, attrs=None, predicate=None, name=None):
+        """Registers handler(element) for the elements whose name is in tags,
+        that carry the given attributes (a value of True only checks the presence
+        of the attribute) and for which predicate(element) is true.
+        Every criterion is optional."""
+        tags = set(tags) if tags is not None else None
+        self.handlers.append((name or handler.__name__, handler, tags, attrs or {}, predicate))
+        self.handlers_by_name = {}
+        return handler
+
+    def handlers_for(self, name):
+        """The handlers that can apply to an element, given its name."""
+        if name not in self.handlers_by_name:
+            self.handlers_by_name[name] = [
+                (handler_name, handler, attrs, predicate)
+                for handler_name, handler, tags, attrs, predicate in self.handlers
+                if tags is None or name in tags
+            ]
+        return self.handlers_by_name[name]
+
+    def matches(self, element, attrs, predicate):
+        if attrs:
+            element_attrs = self.attrs_of(element)
+            for attr, value in attrs.items():
+                if attr not in element_attrs:
+                    return False
+                if value is not True and element_attrs[attr] != value:
+                    return False
+        return predicate is None or predicate(element)
+
+    def names(self):
+        """The names of the elements the walk has to visit,
+        or None if a handler applies to every element."""
+        names = set()
+        for _, _, tags, _, _ in self.handlers:
+            if tags is None:
+                return None
+            names |= tags
+        return names
+
+    def run(self, tree, timer=None):
+        """Walks the tree once, in document order. The elements are listed before
+        the walk, so elements created by the handlers are not visited.
+        timer is a function like time.perf_counter, used to time the handlers."""
+        counts = Counter()
+        times = Counter()
+        is_detached = self.is_detached
+        for element in list(self.elements_of(tree, self.names())):
+            if is_detached(element, tree):
+                continue
+            for name, handler, attrs, predicate in self.handlers_for(self.name_of(element)):
+                if (attrs or predicate) and not self.matches(element, attrs, predicate):
+                    continue
+                if timer is None:
+                    handler(element)
+                else:
+                    start = timer()
+                    handler(element)
+                    times[name] += timer() - start
+                counts[name] += 1
+                if is_detached(element, tree):
+                    break
+        self.counts = counts
+        self.times = times
+
+        logging.debug("%s handlers fired: %s", self.name, dict(self.counts))
+        return self.counts
@@ -0,0 +1,234 @@
+"""Synthetic Hub XML files, shaped like the outputs of idml2xml (idml2docbook-generate).
+
+The real documents that idml2docbook converts are often confidential, and
+the fixtures of the tests are small. This module writes Hub XML files of any
+size with the features that make the conversion work: paragraph and
+character styles (and their css:rule elements), direct formatting (css:
+override attributes), footnotes, endnotes (hub:endnote anchors and their
+EndnoteRange links), media objects, tabs and URLs broken by <br/> tags.
+
+The densities are probabilities: per paragraph for the footnotes, endnotes,
+media objects, tabs and URLs, per phrase for the overrides. The output only
+depends on the parameters and on the seed, and is written as it is
+generated, so that very large files can be made with little memory.
+
+    idml2docbook-generate big.xml --size 100
+    idml2docbook-generate notes.xml --paragraphs 500 --footnotes 0.5 --endnotes 0.5"""
+
+import argparse
+import random
+from pathlib import Path
+
+from utils import escape_xml_text
+
+PARAGRAPH_STYLES = {
+    "NormalParagraphStyle": {"css:font-size": "12pt", "css:text-align": "left"},
+    "normal": {"css:font-size": "11pt", "css:text-align": "justify", "css:text-indent": "11.3pt"},
+    "blockquote": {"css:font-size": "10pt", "css:margin-left": "11.3pt"},
+    "title2": {"css:font-size": "18pt", "css:font-weight": "bold"},
+    "title3": {"css:font-size": "14pt", "css:font-style": "italic"},
+    "Note_de_bas_de_pages": {"css:font-size": "8pt"},
+}
+
+CHARACTER_STYLES = {
+    "No_character_style": {},
+    "italic": {"css:font-style": "italic"},
+    "bold": {"css:font-weight": "bold", "css:font-style": "normal"},
+    "Appels_de_notes": {"css:vertical-align": "super"},
+    "Num_rotation_notes": {},
+    "hyperlink": {"css:text-decoration-line": "underline"},
+}
+
+BODY_STYLES = ["normal", "normal", "normal", "NormalParagraphStyle", "blockquote", "title2", "title3"]
+
+OVERRIDES = [
+    {"css:font-style": "italic", "css:font-weight": "normal"},
+    {"css:font-weight": "600", "css:font-size": "19pt"},
+    {"css:text-transform": "uppercase"},
+    {"css:letter-spacing": "0.05em"},
+]
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit curabitur et bibendum leo "
+    "morbi egestas nunc donec fermentum iaculis lobortis efficitur ex hendrerit eros eget "
+    "ligula nulla blandit ornare risus ullamcorper quisque velit accumsan porta tempor "
+    "duis vel sem feugiat massa neque tincidunt vestibulum tellus pellentesque turpis "
+    "sodales pretium nullam facilisis proin rutrum nisl interdum viverra ipsum eleifend").split()
+
+HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<?xml-model href="http://www.le-tex.de/resource/schema/hub/1.2/hub.rng" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"?>
+<hub xmlns="http://docbook.org/ns/docbook"
+     xmlns:css="http://www.w3.org/1996/css"
+     xml:lang="fr-FR"
+     version="5.1-variant le-tex_Hub-1.2"
+     css:version="3.0-variant le-tex_Hub-1.2"
+     css:rule-selection-attribute="role">
+   <info>
+      <keywordset role="hub">
+         <keyword role="source-basename">{name}</keyword>
+         <keyword role="source-type">idml</keyword>
+      </keywordset>
+      <css:rules>
+{rules}
+      </css:rules>
+   </info>
+"""
+
+def attributes_of(properties):
+    return "".join(f' {key}="{value}"' for key, value in properties.items())
+
+def css_rule(name, layout_type, properties):
+    return f'         <css:rule name="{name}" native-name="{name}" layout-type="{layout_type}"{attributes_of(properties)}/>'
+
+class HubXMLGenerator:
+    def __init__(self, phrases=3, overrides=0.1, footnotes=0.05, endnotes=0.02,
+            media=0.01, tabs=0.05, urls=0.02, seed=0):
+        self.phrases = phrases
+        self.overrides = overrides
+        self.footnotes = footnotes
+        self.endnotes = endnotes
+        self.media = media
+        self.tabs = tabs
+        self.urls = urls
+        self.random = random.Random(seed)
+        self.endnote_texts = []
+        self.media_count = 0
+
+    def text(self, minimum=3, maximum=30):
+        words = self.random.choices(WORDS, k=self.random.randint(minimum, maximum))
+        return " ".join(words)
+
+    def phrase(self):
+        attributes = {}
+        if self.random.random() < 0.7:
+            attributes["role"] = self.random.choice(["italic", "bold", "hyperlink", "No_character_style"])
+        if self.random.random() < self.overrides:
+            attributes |= self.random.choice(OVERRIDES)
+        return f"<phrase{attributes_of(attributes)}>{escape_xml_text(self.text(1, 6))}</phrase>"
+
+    def footnote(self):
+        return ('<phrase role="Appels_de_notes"><footnote><para role="Note_de_bas_de_pages">'
+            '<phrase role="Num_rotation_notes"><tab role="footnotemarker"/></phrase>'
+            f"<tab>\t</tab>{escape_xml_text(self.text())}.</para></footnote></phrase>")
+
+    def endnote(self):
+        number = len(self.endnote_texts) + 1
+        self.endnote_texts.append(self.text())
+        return (f'<superscript role="No_character_style"><link xml:id="id_endnoteAnchor-{number}" '
+            f'remap="EndnoteRange" linkend="id_en-{number}">{number}</link></superscript>')
+
+    def url(self):
+        path = "-".join(self.random.choices(WORDS, k=6))
+        cut = self.random.randint(1, len(path) - 1)
+        return f"https://www.example.org/{path[:cut]}<br/>{path[cut:]}/"
+
+    def mediaobject(self):
+        self.media_count += 1
+        extension = self.random.choice(["tif", "psd", "jpg", "eps", "ai", "svg"])
+        width, height = self.random.uniform(20, 500), self.random.uniform(20, 500)
+        return (f'   <para>\n      <mediaobject css:width="{width}pt" css:height="{height}pt">\n'
+            '         <imageobject>\n'
+            f'            <imagedata fileref="file:/synthetic/Links/image_{self.media_count}.{extension}" '
+            f'css:width="{width}px" css:height="{height}px" xml:id="img_{self.media_count}"/>\n'
+            '         </imageobject>\n      </mediaobject>\n   </para>\n')
+
+    def paragraph(self):
+        style = self.random.choice(BODY_STYLES)
+        attributes = {"role": style}
+        if self.random.random() < self.overrides:
+            attributes |= self.random.choice(OVERRIDES)
+        content = []
+        if self.random.random() < self.tabs:
+            content.append("<tab>\t</tab>")
+        content.append(escape_xml_text(self.text()))
+        for _ in range(self.random.randint(0, 2 * self.phrases) if not style.startswith("title") else 0):
+            content.append(" " + self.phrase() + " " + escape_xml_text(self.text(1, 12)))
+        if self.random.random() < self.urls:
+            content.append(" " + self.url() + " " + escape_xml_text(self.text(1, 5)))
+        if self.random.random() < self.footnotes:
+            content.append(self.footnote())
+        if self.random.random() < self.endnotes:
+            content.append(self.endnote())
+        paragraph = f"   <para{attributes_of(attributes)}>{''.join(content)}.</para>\n"
+        if self.random.random() < self.media:
+            paragraph += self.mediaobject()
+        return paragraph
+
+    def endnote_paragraphs(self):
+        yield '   <para role="title2">Notes de fin</para>\n'
+        for number, text in enumerate(self.endnote_texts, 1):
+            yield (f'   <para role="NormalParagraphStyle"><anchor xml:id="id_en-{number}" role="hub:endnote"/>'
+                f'<phrase role="hub:identifier"><link remap="EndnoteMarker" linkend="id_endnoteAnchor-{number}">{number}</link></phrase>'
+                f"<tab>\t</tab>{escape_xml_text(text)}.</para>\n")
+
+    def write(self, output, paragraphs=None, size=None, name="synthetic"):
+        """Writes the document to the output file-like object: paragraphs
+        paragraphs, or as many as needed to reach size bytes (1000 paragraphs
+        by default)."""
+        if paragraphs is None and size is None:
+            paragraphs = 1000
+        rules = [css_rule(name, "para", properties) for name, properties in PARAGRAPH_STYLES.items()]
+        rules += [css_rule(name, "inline", properties) for name, properties in CHARACTER_STYLES.items()]
+        written = output.write(HEADER.format(name=name, rules="\n".join(rules)))
+        count = 0
+        while (paragraphs is None or count < paragraphs) and (size is None or written < size):
+            written += output.write(self.paragraph())
+            count += 1
+        if self.endnote_texts:
+            for paragraph in self.endnote_paragraphs():
+                written += output.write(paragraph)
+        written += output.write("</hub>\n")
+        return written
+
+def generate_hubxml(path, paragraphs=None, size=None, **densities):
+    """Writes a synthetic Hub XML file at path, with paragraphs paragraphs
+    or of about size MB (1000 paragraphs by default). densities are the
+    parameters of HubXMLGenerator. Returns the number of bytes written."""
+    with open(path, "w", encoding="utf-8") as f:
+        return HubXMLGenerator(**densities).write(f, paragraphs,
+            int(float(size) * 1024 * 1024) if size is not None else None,
+            Path(path).stem)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='idml2docbook-generate',
+        description='Generate a synthetic Hub XML file, shaped like the outputs of idml2xml.')
+    parser.add_argument('output', help='filename of the Hub XML file to write')
+    parser.add_argument(
+        '-p', '--paragraphs', type=int,
+        help='number of paragraphs, defaults to 1000 if --size is not given')
+    parser.add_argument(
+        '--size', type=float, metavar='MB',
+        help='approximate size of the file, in MB (the endnotes come on top of it)')
+    parser.add_argument(
+        '--phrases', type=int, default=3,
+        help='average number of phrases per paragraph, defaults to 3')
+    parser.add_argument(
+        '--overrides', type=float, default=0.1,
+        help='probability for a paragraph or a phrase to carry css: overrides, defaults to 0.1')
+    parser.add_argument(
+        '--footnotes', type=float, default=0.05,
+        help='probability for a paragraph to have a footnote, defaults to 0.05')
+    parser.add_argument(
+        '--endnotes', type=float, default=0.02,
+        help='probability for a paragraph to have an endnote, defaults to 0.02')
+    parser.add_argument(
+        '--media', type=float, default=0.01,
+        help='probability for a paragraph to be followed by a media object, defaults to 0.01')
+    parser.add_argument(
+        '--tabs', type=float, default=0.05,
+        help='probability for a paragraph to start with a tab, defaults to 0.05')
+    parser.add_argument(
+        '--urls', type=float, default=0.02,
+        help='probability for a paragraph to have a URL broken by a <br/>, defaults to 0.02')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='seed of the random generator, defaults to 0')
+    args = parser.parse_args(argv)
+
+    written = generate_hubxml(args.output, args.paragraphs, args.size,
+        phrases=args.phrases, overrides=args.overrides, footnotes=args.footnotes,
+        endnotes=args.endnotes, media=args.media, tabs=args.tabs, urls=args.urls, seed=args.seed)
+    print(f"Wrote {written / 1024 / 1024:.1f} MB to {args.output}")
+
+if __name__ == "__main__":
+    main()
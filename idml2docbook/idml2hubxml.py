@@ -1,19 +1,123 @@
+import contextlib
+import shutil
 import subprocess
 import logging
+import tempfile
+import time
 from pathlib import Path
 import os
-from install_dependencies import check_bash, check_java
+from idml2docbook import CACHE_FOLDER
+from install_dependencies import check_bash, cached_java_version
 
 def idml2hubxml(input: str, read_output_file=False, **options):
+    """Runs idml2xml on the IDML file and returns the path of its output, the
+    Hub XML, in the idml2hubxml_output folder (its content with read_output_file)."""
     logging.info("idml2hubxml starting...")
 
+    cache, key, hubxml = cached_output(input, options)
+    if hubxml is not None:
+        outputfile = write_output_file(input, hubxml, options["idml2hubxml_output"])
+    else:
+        outputfile = run_and_cache(input, options["idml2hubxml_output"], cache, key, **options)
+
+    logging.info("idml2hubxml done.")
+
+    if(read_output_file):
+        with open(outputfile, "r") as f:
+            return f.read()
+    else:
+        return outputfile
+
+def idml2hubxml_bytes(input: str, **options):
+    """Same as idml2hubxml, but returns the Hub XML as bytes, to be parsed
+    as they are. Unless options["keep_idml2hubxml_output"] is set, idml2xml
+    writes its output in a temporary folder (under TMPDIR), removed once the
+    Hub XML is read, instead of the idml2hubxml_output folder."""
+    if options.get("keep_idml2hubxml_output"):
+        with open(idml2hubxml(input, **options), "rb") as f:
+            return f.read()
+
+    logging.info("idml2hubxml starting...")
+
+    cache, key, hubxml = cached_output(input, options)
+    if hubxml is None:
+        with tempfile.TemporaryDirectory(prefix="idml2hubxml-") as folder:
+            outputfile = run_and_cache(input, folder, cache, key, **options)
+            if not os.path.exists(outputfile):
+                raise FileNotFoundError("idml2xml did not write any Hub XML for " + input
+                    + ", its log can be kept with --keep-idml2hubxml-output")
+            with open(outputfile, "rb") as f:
+                hubxml = f.read()
+
+    logging.info("idml2hubxml done.")
+    return hubxml
+
+def cached_output(input, options):
+    """Returns the cache of the outputs of idml2xml, the key of input
+    in it and the output cached for input (bytes), or Nones."""
+    if not options.get("idml2hubxml_cache"):
+        return None, None, None
+
+    from cache import GzipCache, cache_key, frontend_revision
+
+    cache = GzipCache(options["idml2hubxml_cache"], options["idml2hubxml_cache_size"])
+    key = cache_key(input, frontend_revision(options["idml2hubxml_script"]))
+    hubxml = cache.get(key)
+    if hubxml is not None:
+        logging.info("Output of idml2xml found in cache for " + input + " (" + key + ")")
+    return cache, key, hubxml
+
+def run_and_cache(input, output_folder, cache, key, **options):
+    """Runs idml2xml with output_folder as its output folder,
+    caches its output and returns its path."""
+    options = options | {"idml2hubxml_output": output_folder}
+
+    start = time.time()
+    outputfile = run_idml2xml(input, **options)
+
+    # idml2xml does not always fail loudly, only fresh outputs are cached
+    if cache is not None and os.path.exists(outputfile) and os.path.getmtime(outputfile) >= start - 1:
+        cache.put(key, outputfile)
+
+    return outputfile
+
+@contextlib.contextmanager
+def idml_path(input):
+    """Gives the path of the IDML input, as idml2xml only reads files: bytes
+    and file-like objects are written to a temporary file first."""
+    if isinstance(input, (str, os.PathLike)):
+        yield str(input)
+        return
+    fd, path = tempfile.mkstemp(suffix=".idml")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if hasattr(input, "read"):
+                shutil.copyfileobj(input, f)
+            else:
+                f.write(input)
+        yield path
+    finally:
+        os.remove(path)
+
+def write_output_file(input, hubxml, output_folder):
+    """Writes a cached Hub XML where idml2xml would have written it."""
+    outputfile = output_folder + "/" + Path(input).stem + ".xml"
+    os.makedirs(output_folder, exist_ok=True)
+    tmp = outputfile + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(hubxml)
+    os.replace(tmp, outputfile)
+    logging.info("Output of idml2xml written at: " + outputfile)
+    return outputfile
+
+def run_idml2xml(input: str, **options):
     # bash_version = check_bash()
     # if (bash_version == -1):
     #     e = RuntimeError("Your bash version is too old. Please update it (>= 5.0.0) or point to a more recent version in your .env file.")
     #     raise e
     # else: logging.info(f"bash version used: {bash_version}.")
 
-    java_version = check_java()
+    java_version = cached_java_version(os.path.join(CACHE_FOLDER, "toolchain.json"))
     if (java_version == -1):
         e = RuntimeError("Your Java version is too old. Please update it (>= 7.0.0).")
         raise e
@@ -37,10 +141,5 @@ def idml2hubxml(input: str, read_output_file=False, **options):
 
     logging.info("Output of idml2xml written at: " + outputfile)
     logging.info("idml2xml log file written at: " + logfile)
-    logging.info("idml2hubxml done.")
 
-    if(read_output_file):
-        with open(outputfile, "r") as f:
-            return f.read()
-    else:
-        return outputfile
\ No newline at end of file
+    return outputfile
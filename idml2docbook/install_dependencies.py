@@ -1,11 +1,10 @@
+import json
 import subprocess
 import sys
 import re
 import shutil
 import os
-from packaging import version
 from pathlib import Path
-from dotenv import load_dotenv
 import argparse
 
 REPO_URL = "https://github.com/yanntrividic/idml2xml-frontend.git"
@@ -19,7 +18,7 @@ IDML2HUBXML_SCRIPT_FOLDER="/path/to/idml2xml-frontend"
 # Command or path to the shell to use idml2xml-frontend
 SHELL="sh"
 
-# This folder will get created
+# This folder will get created if the outputs of idml2xml are kept
 IDML2HUBXML_OUTPUT_FOLDER="idml2hubxml"
 
 # Override defaults values by uncommenting/editing these lines:
@@ -27,9 +26,23 @@ IDML2HUBXML_OUTPUT_FOLDER="idml2hubxml"
 # TYPOGRAPHY=True
 # THIN_SPACES=True
 # LINEBREAKS=True
+# MERGE_IDENTICAL_PHRASES=True
 # MEDIA="images"
 # RASTER="jpg"
 # VECTOR="svg"
+# ENGINE="lxml"
+# STREAMING=True
+# INCREMENTAL="/path/to/fragments"
+# PROFILE="idml2docbook-profile.json"
+# PROFILE_STAGE="fix_role_names"
+# LOG_LEVEL="info" # or off
+# LOG_FILE="idml2docbook-{pid}.log"
+# LOG_JSON=True
+# CHECKPOINTS="/path/to/checkpoints" # or True, for the default folder
+# CHECKPOINTS_SIZE=1024
+# KEEP_IDML2HUBXML_OUTPUT=True
+# IDML2HUBXML_CACHE="/path/to/cache" # or False
+# IDML2HUBXML_CACHE_SIZE=1024
 """
 
 
@@ -75,6 +88,48 @@ def check_java(verbose=False):
         if verbose: print("❌ Java is not installed or not in the system PATH.")
         return -1
 
+JAVA_VERSIONS = {}
+
+def cached_java_version(cache_file=None):
+    """check_java, run once per java binary. The version is kept for the rest
+    of the process and, with cache_file, in that JSON file across runs, keyed
+    by the path and the modification time of the binary: a Java that is
+    updated or switched to another one is probed again."""
+    java = shutil.which("java")
+    if java is None:
+        return -1
+    java = os.path.realpath(java)
+    key = java + "@" + str(os.stat(java).st_mtime_ns)
+    if key in JAVA_VERSIONS:
+        return JAVA_VERSIONS[key]
+
+    versions = {}
+    if cache_file:
+        try:
+            with open(cache_file) as f:
+                versions = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    java_version = versions.get(key)
+    if java_version is None:
+        java_version = check_java()
+        # Failures are not saved, Java could be fixed without its binary changing
+        if cache_file and java_version != -1:
+            versions = {k: v for k, v in versions.items() if not k.startswith(java + "@")}
+            versions[key] = java_version
+            try:
+                Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+                tmp = str(cache_file) + "." + str(os.getpid()) + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(versions, f)
+                os.replace(tmp, cache_file)
+            except OSError:
+                pass # the version is probed again next time
+
+    JAVA_VERSIONS[key] = java_version
+    return java_version
+
 def check_git(verbose=True):
     if not shutil.which("git"):
         sys.exit("❌ Git not found. Please install git to install idml2xml-frontend")
@@ -84,6 +139,8 @@ def check_git(verbose=True):
 def check_bash(verbose=False): # It might not be necessary after all?
     """Returns the bash version
     """
+    from packaging import version
+
     try:
         # Run the 'bash --version' command
         result = subprocess.run([os.getenv("BASH", "bash"), '--version'], stdout=subprocess.PIPE, text=True)
@@ -170,7 +227,6 @@ def main():
     repo_dir = clone_repo(target)
 
     configure_env(target, repo_dir)
-    load_dotenv()
 
     # check_bash(verbose) # It might not be necessary after all?
     check_java(verbose)
@@ -0,0 +1,67 @@
+"""Logging configuration (--log-level, --log-file, --log-json).
+
+Importing idml2docbook does not configure logging: used as a library, its
+records go wherever the application sends them (only the warnings reach
+stderr if the application does not configure logging at all). The command
+line calls configure_logging with its options.
+
+The messages logged for every element or every file are formatted lazily
+(logging.debug("Media was: %s", fileref)), so they cost next to nothing
+below the level. With several processes (--batch), a log file whose name
+holds {pid} gives one file per process, instead of processes contending
+on the same file, and JSON lines carry the pid of their process."""
+
+import json
+import logging
+import os
+import sys
+
+LEVELS = ["debug", "info", "warning", "error", "critical", "off"]
+
+CONFIGURATION = None
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record and per line."""
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "pid": record.process,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def configure_logging(level="warning", file=None, json_lines=False):
+    """Sends the records of level and above to file, or to stderr, as text or
+    as JSON lines. {pid} in file is replaced by the id of the process. level
+    "off" disables logging. A new call replaces the previous configuration."""
+    global CONFIGURATION
+    CONFIGURATION = (level, file, json_lines)
+
+    root = logging.getLogger()
+    for handler in [handler for handler in root.handlers if getattr(handler, "idml2docbook", False)]:
+        root.removeHandler(handler)
+        handler.close()
+
+    if level.lower() == "off":
+        root.setLevel(logging.CRITICAL + 1)
+        return
+
+    if file:
+        handler = logging.FileHandler(file.replace("{pid}", str(os.getpid())), encoding="utf-8", delay=True)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.idml2docbook = True
+    handler.setFormatter(JSONFormatter() if json_lines else logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
+def pool_logging():
+    """Keyword arguments of a ProcessPoolExecutor whose processes log the
+    way this one was configured to, each in its own file with {pid}."""
+    if CONFIGURATION is None:
+        return {}
+    return {"initializer": configure_logging, "initargs": CONFIGURATION}
@@ -0,0 +1,817 @@
+"""lxml-native implementation of hubxml2docbook.
+
+The passes of core.py are rewritten here on lxml.etree elements, so that
+the conversion does not go through BeautifulSoup's pure-Python tree.
+The output is expected to be identical to the one of the bs4 engine:
+the quirks of BeautifulSoup (whitespace-only strings collapsed at parse time,
+sorted attributes, serialization of empty elements...) are reproduced.
+
+Select it with engine="lxml" (or --engine lxml on the command line)."""
+
+import copy
+import logging
+import re
+from collections import Counter
+from lxml import etree
+
+from idml2docbook.core import (
+    NODES_TO_REMOVE,
+    NAMESPACES_TO_REMOVE,
+    ATTRIBUTES_TO_REMOVE,
+    BR,
+    linebreaks_in_urls,
+    convert_media_fileref,
+    strip_orthotypography,
+    LINEBREAK,
+    replace_linebreaks,
+    write_docbook,
+    log_endnotes_summary,
+)
+from map import (
+    APPLY_HEURISTICS,
+    CSS_CLARK,
+    CSSA_PROPERTIES_TO_IGNORE,
+    KEY_ATTRIBUTES,
+    TAGS_WITH_CSSA,
+    TAGS_WITH_RELEVENT_ROLES,
+    build_roles_map_from_rules,
+    css_property,
+    log_renamed_roles,
+    role_renames,
+)
+from dispatch import Dispatcher
+from checkpoints import Checkpoints
+from profiling import profiler_of
+from typography import locale_typography
+from utils import (
+    ASCII_SPACES,
+    binary_source,
+    escape_xml_text,
+    input_name,
+    should_insert_space,
+    quoted_attribute_value,
+)
+
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+XML_ID = "{%s}id" % XML_NS
+
+def is_element(node):
+    """Comments and processing instructions are nodes of the tree as well in lxml."""
+    return isinstance(node.tag, str)
+
+def local_name(el):
+    if not is_element(el):
+        return None
+    tag = el.tag
+    return tag[tag.rfind("}") + 1:]
+
+def iter_elements(root, *names):
+    """Iterates over the elements of a tree whose local name is in names,
+    whatever their namespace is (like BeautifulSoup's find_all does)."""
+    if not names:
+        return root.iter(tag=etree.Element)
+    return root.iter(*["{*}" + name for name in names])
+
+def find_next(el, name):
+    """Returns the first element named name after el in document order, its
+    descendants first, as find_next() does. The search stops at the first
+    match, it does not list every following element."""
+    for found in el.iter("{*}" + name):
+        if found is not el:
+            return found
+    node = el
+    while node is not None:
+        for sibling in node.itersiblings():
+            for found in sibling.iter("{*}" + name):
+                return found
+        node = node.getparent()
+    return None
+
+def qualified_name(context, name):
+    """Returns name in the namespace of the context element."""
+    namespace = etree.QName(context).namespace
+    return etree.QName(namespace, name).text if namespace else name
+
+def new_element(context, name, attrib=None):
+    """Creates an element that belongs to the same namespace as the context element."""
+    return context.makeelement(qualified_name(context, name), attrib or {}, nsmap=context.nsmap)
+
+def attribute_name(el, key):
+    """Returns the name of an attribute as BeautifulSoup displays it, e.g. css:color."""
+    if not key.startswith("{"):
+        return key
+    qname = etree.QName(key)
+    if qname.namespace == XML_NS:
+        return "xml:" + qname.localname
+    for prefix, uri in el.nsmap.items():
+        if uri == qname.namespace and prefix:
+            return prefix + ":" + qname.localname
+    return qname.localname
+
+def node_string(node):
+    """Returns the string BeautifulSoup would see for a comment or a processing instruction."""
+    if node.tag is etree.PI:
+        return node.target + (" " + node.text if node.text else "")
+    return node.text or ""
+
+def get_text(node):
+    if not is_element(node):
+        return node_string(node)
+    return node.xpath("string()")
+
+def last_char(node):
+    txt = get_text(node) if node is not None else ""
+    return txt[-1] if txt else ""
+
+def first_char(node):
+    txt = get_text(node) if node is not None else ""
+    return txt[0] if txt else ""
+
+def slot_before(el):
+    """Returns the (node, "tail" or "text") couple holding the text right before el."""
+    prev = el.getprevious()
+    if prev is not None:
+        return prev, "tail"
+    return el.getparent(), "text"
+
+def text_before(el):
+    """Returns the text node right before el (the previous sibling's tail or the parent's text)."""
+    node, slot = slot_before(el)
+    return getattr(node, slot) if node is not None else None
+
+def set_text_before(el, text):
+    prev = el.getprevious()
+    if prev is not None:
+        prev.tail = text
+    else:
+        el.getparent().text = text
+
+def append_text_before(el, text):
+    if text:
+        set_text_before(el, (text_before(el) or "") + text)
+
+class Segments:
+    """The strings a text node of the lxml tree is made of, for BeautifulSoup.
+
+    unwrap() leaves the strings around and inside an element side by side
+    in the soup, where they stay apart until the document is parsed again,
+    and remove_linebreak_before_and_after removes the whitespace-only strings
+    next to a phrase, which a longer text merged with them would not be.
+    lxml joins them at once: when the strings are kept, unwrap and
+    remove_element note here where they were joined. A text changed since
+    (e.g. by the typography) is a single string again."""
+    def __init__(self):
+        self.slots = {}
+
+    def of(self, node, slot):
+        text = getattr(node, slot)
+        strings = self.slots.get((node, slot))
+        if strings is None or "".join(strings) != (text or ""):
+            return [text] if text else []
+        return strings
+
+    def set(self, node, slot, strings):
+        self.slots[(node, slot)] = strings
+        setattr(node, slot, "".join(strings) or None)
+
+    def move(self, source, source_slot, target, target_slot):
+        """The text of source is appended to the text of target, as a separate string."""
+        strings = self.of(target, target_slot) + self.of(source, source_slot)
+        self.slots.pop((source, source_slot), None)
+        self.set(target, target_slot, strings)
+
+def move_text_before(el, node, slot, segments=None):
+    """Appends the text or the tail of node to the text right before el."""
+    text = getattr(node, slot)
+    if not text:
+        return
+    if segments is None:
+        append_text_before(el, text)
+    else:
+        segments.move(node, slot, *slot_before(el))
+
+def remove_element(el, segments=None):
+    """Removes an element but keeps its tail, as decompose() does."""
+    move_text_before(el, el, "tail", segments)
+    el.tail = None
+    el.getparent().remove(el)
+
+def unwrap(el, segments=None):
+    """Replaces an element with its children, as unwrap() does."""
+    parent = el.getparent()
+    move_text_before(el, el, "text", segments)
+    index = parent.index(el)
+    for i, child in enumerate(list(el)):
+        parent.insert(index + i, child)
+    remove_element(el, segments)
+
+def iter_text_slots(root):
+    """Yields (node, attribute) couples for every text node of the tree:
+    the text of the elements and the tail of every node but the root."""
+    for node in root.iter():
+        if is_element(node):
+            yield node, "text"
+        if node is not root:
+            yield node, "tail"
+
+def collapse_whitespace(root):
+    """BeautifulSoup turns whitespace-only strings into a single newline or space
+    at parse time, and empty strings disappear when a document is parsed again."""
+    for node, slot in iter_text_slots(root):
+        text = getattr(node, slot)
+        if text is None:
+            continue
+        if text == "":
+            setattr(node, slot, None)
+        elif not text.strip(ASCII_SPACES):
+            setattr(node, slot, "\n" if "\n" in text else " ")
+
+def parse(file):
+    parser = etree.XMLParser(recover=True, huge_tree=True, resolve_entities=False)
+    tree = etree.parse(binary_source(file), parser)
+    root = tree.getroot()
+    collapse_whitespace(root)
+    return root
+
+def prolog_of(root):
+    """Processing instructions and comments before the root element."""
+    return list(reversed(list(root.itersiblings(preceding=True))))
+
+def css_rules_of(root):
+    return [dict(rule.attrib) for rule in root.iter(CSS_CLARK + "rule")]
+
+def rename_roles(root, roles):
+    """Gives the slugs of the roles map to the role and name attributes,
+    returns the keys of the roles that were renamed."""
+    renames = role_renames(roles)
+    renamed = set()
+    for el in iter_elements(root):
+        for property in ["role", "name"]:
+            value = el.get(property)
+            if value in renames:
+                el.set(property, renames[value][-1][1])
+                renamed.update(renames[value])
+    return [key for index, key in sorted(renamed)]
+
+def fix_role_names(root):
+    roles = build_roles_map_from_rules(css_rules_of(root))
+    log_renamed_roles(roles, rename_roles(root, roles))
+
+def remove_xml_models(root, prolog):
+    def is_xml_model(text):
+        return text is not None and text.strip().startswith("xml-model")
+
+    prolog = [node for node in prolog if not is_xml_model(node_string(node))]
+    for node in list(root.iter(etree.PI, etree.Comment)):
+        if is_xml_model(node_string(node)):
+            remove_element(node)
+    for node, slot in list(iter_text_slots(root)):
+        if is_xml_model(getattr(node, slot)):
+            setattr(node, slot, None)
+    return prolog
+
+def replace_linebreaks_after_css_attributes(root):
+    logging.info("Replacing linebreaks after <phrase> with typographical heuristics...")
+
+    for phrase in iter_elements(root, "phrase"):
+        has_target_attr = any(
+            etree.QName(attr).localname in ["direction", "transform", "letter-spacing"]
+            for attr in phrase.attrib
+        )
+        if not has_target_attr:
+            continue
+
+        # Only act if the immediate sibling is whitespace
+        if not (phrase.tail and phrase.tail.strip() == ""):
+            continue
+
+        if should_insert_space(get_text(phrase), get_text(phrase.getnext()) if phrase.getnext() is not None else None):
+            phrase.tail = " "
+        else:
+            phrase.tail = None
+
+def new_override_mappings():
+    return {"paragraph": {}, "character": {}, "object": {}}
+
+def turn_overrides_into_roles(root, mappings=None):
+    """Override classes are numbered in document order. Passing the mappings
+    of a previous call keeps the numbering going from one tree to the next."""
+    if mappings is None: mappings = new_override_mappings()
+
+    for tag in iter_elements(root, *TAGS_WITH_CSSA):
+        css_items = [k for k in tag.attrib if k.startswith(CSS_CLARK)]
+        if not css_items:
+            continue
+
+        items = []
+        for k, v in list(tag.attrib.items()):
+            if k.startswith(CSS_CLARK): name = k[len(CSS_CLARK):]
+            elif k in KEY_ATTRIBUTES: name = k
+            else: continue
+            # The ignored properties are removed from the tag
+            if APPLY_HEURISTICS and name in CSSA_PROPERTIES_TO_IGNORE: del tag.attrib[k]
+            item = css_property(name, v)
+            if item is not None: items.append(item)
+        items.sort()
+        key = tuple(items)
+        if not key: continue
+
+        name = local_name(tag)
+        if name == "para": type_name = "paragraph"
+        elif name in ["phrase", "superscript"]: type_name = "character"
+        else: type_name = "object"
+
+        if name in TAGS_WITH_RELEVENT_ROLES:
+            mapping = mappings[type_name]
+            if key not in mapping:
+                mapping[key] = len(mapping) + 1
+            idx = mapping[key]
+
+            override_label = f"{type_name}-override-{idx}"
+            current_role = tag.get("role")
+            tag.set("role", current_role + " " + override_label if current_role else override_label)
+
+        for k in css_items:
+            if k in tag.attrib:
+                del tag.attrib[k]
+
+def remove_unnecessary_nodes(root):
+    for el in list(iter_elements(root, *NODES_TO_REMOVE)): remove_element(el)
+    for el in [el for el in iter_elements(root) if el.get("remap") == "idml2xml:control"]:
+        remove_element(el)
+
+def remove_unnecessary_attributes_of(el):
+    for k in list(el.attrib):
+        if attribute_name(el, k) in ATTRIBUTES_TO_REMOVE: del el.attrib[k]
+
+def remove_unnecessary_attributes(root):
+    for el in iter_elements(root): remove_unnecessary_attributes_of(el)
+
+def is_css_node(el):
+    return el.tag.startswith(CSS_CLARK)
+
+def remove_ns_attributes_of(el):
+    """Removes the CSSa and idml2xml attributes, whatever their prefix, and
+    drops the prefix of the attributes whose namespace will not be declared
+    anymore. etree.cleanup_namespaces must be called once the tree is processed."""
+    for k in list(el.attrib):
+        if not k.startswith("{"):
+            continue
+        namespace = etree.QName(k).namespace
+        if namespace in NAMESPACES_TO_REMOVE:
+            del el.attrib[k]
+        elif namespace != XML_NS:
+            el.attrib[etree.QName(k).localname] = el.attrib.pop(k)
+
+def remove_ns_attributes(root):
+    # Remove all css nodes
+    for el in [el for el in iter_elements(root) if is_css_node(el)]:
+        if el.getparent() is not None: remove_element(el)
+    # Remove attributes
+    for el in iter_elements(root): remove_ns_attributes_of(el)
+    etree.cleanup_namespaces(root)
+
+def process_images(root, rep_raster = None, rep_vector = None, folder = None):
+    logging.info("Processing media filenames...")
+
+    for tag in list(iter_elements(root, "mediaobject", "inlinemediaobject")):
+        imagedata = find_next(tag, "imagedata")
+        fileref = imagedata.get("fileref")
+        imagedata.set("fileref", convert_media_fileref(fileref, rep_raster, rep_vector, folder))
+
+        if (rep_raster or rep_vector or folder):
+            logging.debug("Media was: %s", fileref)
+            logging.debug("and is now: %s", imagedata.get("fileref"))
+
+def process_tab(tab):
+    tab.tag = qualified_name(tab, "phrase")
+    tab.set("role", tab.get("role") + " converted-tab" if "role" in tab.attrib else "converted-tab")
+
+def process_tabs(root):
+    for tab in list(iter_elements(root, "tab")): process_tab(tab)
+
+def index_endnotes(root):
+    """Walks the tree once and returns the endnote paragraphs by anchor id,
+    and the EndnoteRange links in document order."""
+    endnote_map = {}
+    links = []
+    for el in iter_elements(root, "anchor", "link"):
+        if local_name(el) == "anchor":
+            anchor_id = el.get(XML_ID)
+            if el.get("role") != "hub:endnote" or not anchor_id:
+                continue
+            para = next(el.iterancestors("{*}para"), None)
+            if para is not None:
+                endnote_map[anchor_id] = para
+        elif el.get("remap") == "EndnoteRange":
+            links.append(el)
+    return endnote_map, links
+
+def is_endnote_marker(el):
+    return (local_name(el) == "anchor" and el.get("role") == "hub:endnote") or \
+        (local_name(el) == "link" and el.get("remap") == "EndnoteMarker")
+
+def replace_endnote_links(links, endnote_map, move=True):
+    """Replaces the links with footnotes holding their endnote. The content of an
+    endnote is moved into the footnote of its last link (unless move is False),
+    it is only copied for the links before, when the endnote is referenced
+    more than once."""
+    remaining = Counter(link.get("linkend") for link in links)
+    for link in links:
+        linkend = link.get("linkend")
+        if not linkend or linkend not in endnote_map:
+            continue
+        remaining[linkend] -= 1
+        note = endnote_map[linkend]
+        if remaining[linkend] or not move:
+            note = copy.deepcopy(note)
+
+        # Nested markers can simply be removed, but the direct children of the
+        # paragraph are kept as separate strings/elements, the same way bs4 does.
+        for el in [el for el in note.iterdescendants() if el.getparent() is not note and is_element(el) and is_endnote_marker(el)]:
+            remove_element(el)
+        contents = [note.text]
+        for child in note:
+            if not (is_element(child) and is_endnote_marker(child)):
+                contents.append(child)
+            contents.append(child.tail)
+            child.tail = None
+        contents = [c for c in contents if c is not None and not (isinstance(c, str) and not c.strip())]
+
+        footnote = new_element(link, "footnote", {"endnote": "1"})
+        para = etree.SubElement(footnote, qualified_name(link, "para"))
+        last = None
+        for content in contents:
+            if isinstance(content, str):
+                if last is None: para.text = (para.text or "") + content
+                else: last.tail = (last.tail or "") + content
+            else:
+                para.append(content)
+                last = content
+
+        footnote.tail = link.tail
+        link.getparent().replace(link, footnote)
+
+def process_endnotes(root):
+    logging.info("Processing endnotes...")
+
+    endnote_map, links = index_endnotes(root)
+    replace_endnote_links(links, endnote_map)
+    for para in set(endnote_map.values()):
+        remove_element(para)
+
+    log_endnotes_summary(endnote_map, [link.get("linkend") for link in links])
+    logging.info("Endnotes processed successfully.")
+
+def remove_linebreak_before_and_after(el, segments=None):
+    """Removes the whitespace-only strings right before and after el."""
+    if segments is None:
+        prev = text_before(el)
+        if prev is not None and prev.strip() == "":
+            set_text_before(el, None)
+        if el.tail is not None and el.tail.strip() == "":
+            el.tail = None
+        return
+
+    node, slot = slot_before(el)
+    strings = segments.of(node, slot)
+    while strings and strings[-1].strip() == "":
+        strings = strings[:-1]
+    segments.set(node, slot, strings)
+
+    strings = segments.of(el, "tail")
+    while strings and strings[0].strip() == "":
+        strings = strings[1:]
+    segments.set(el, "tail", strings)
+
+def remove_newlines_inside(el):
+    for node, slot in iter_text_slots(el):
+        if node is el and slot == "tail":
+            continue
+        txt = getattr(node, slot)
+        if txt is None:
+            continue
+        if txt.strip() == "":
+            setattr(node, slot, None)
+        else:
+            setattr(node, slot, txt.replace("\n", "").replace("\r", ""))
+
+def process_notes(root):
+    for footnote in list(iter_elements(root, "footnote")):
+        remove_linebreak_before_and_after(footnote)
+        remove_newlines_inside(footnote)
+
+def is_plain_br(el):
+    return is_element(el) and local_name(el) == "br" and not el.attrib and len(el) == 0 and not el.text
+
+def clean_urls_from_linebreaks(root):
+    parents = []
+    for br in iter_elements(root, "br"):
+        if not parents or parents[-1] is not br.getparent():
+            parents.append(br.getparent())
+
+    for parent in parents:
+        run = []
+        for child in list(parent) + [None]:
+            if child is not None and is_plain_br(child):
+                run.append(child)
+                continue
+            if run:
+                join_url_run(run)
+            run = []
+
+    collapse_whitespace(root)
+
+def join_url_run(brs):
+    parts = [escape_xml_text(text_before(brs[0]) or "")]
+    length = len(parts[0])
+    offsets = []
+    for br in brs:
+        offsets.append(length)
+        parts.append(BR + escape_xml_text(br.tail or ""))
+        length += len(parts[-1])
+
+    for i in linebreaks_in_urls("".join(parts), offsets):
+        remove_element(brs[i])
+
+def remove_linebreaks(root, segments=None):
+    logging.info("Removing linebreaks...")
+    for br in list(iter_elements(root, "br")):
+        prev_text = text_before(br)
+        lc = prev_text[-1] if prev_text else last_char(br.getprevious())
+        if re.compile(r"\s").match(lc):
+            unwrap(br, segments)
+        else:
+            for child in list(br): br.remove(child)
+            br.text = " "
+            unwrap(br, segments)
+
+def fill_empty_element_with_br(el):
+    if len(el) == 0 and el.text is None:
+        etree.SubElement(el, qualified_name(el, "br"))
+
+def fill_empty_elements_with_br(root):
+    logging.info("Removing empty elements...")
+    for el in list(iter_elements(root, "para")): fill_empty_element_with_br(el)
+
+def unwrap_phrase_without_attribute(tag, segments=None):
+    if tag.get("role") == "converted-tab":
+        return
+    if not tag.attrib: unwrap(tag, segments)
+
+def unwrap_phrase_without_attributes(root):
+    for tag in list(iter_elements(root, "phrase")): unwrap_phrase_without_attribute(tag)
+
+def remove_orthotypography(root):
+    logging.info("Removing input's orthotypography...")
+
+    for el in iter_elements(root):
+        for attr, value in el.attrib.items():
+            new_value = strip_orthotypography(value)
+            if new_value != value: el.set(attr, new_value)
+
+    for node in root.iter():
+        if node.text is not None:
+            text = strip_orthotypography(node.text)
+            if text != node.text: node.text = text
+        if node is not root and node.tail is not None:
+            tail = strip_orthotypography(node.tail)
+            if tail != node.tail: node.tail = tail
+
+    collapse_whitespace(root)
+
+def add_french_orthotypography(root, thin_spaces):
+    logging.info("Adding new french orthotypography...")
+
+    typography = locale_typography("fr", thin_spaces)
+    for node, slot in iter_text_slots(root):
+        text = getattr(node, slot)
+        if text is None:
+            continue
+        new_text = typography(text)
+        if new_text != text: setattr(node, slot, new_text)
+
+def remove_linebreak_before_and_after_phrase(root):
+    for tag in list(iter_elements(root, "phrase")):
+        remove_linebreak_before_and_after(tag)
+
+def is_detached(el, root):
+    return el is not root and el.getroottree().getroot() is not root
+
+def new_dispatcher(name):
+    return Dispatcher(name,
+        name_of=local_name,
+        attrs_of=lambda el: el.attrib,
+        is_detached=is_detached,
+        elements_of=lambda root, names: list(iter_elements(root, *(names or []))))
+
+# Same walks as in core.py
+CLEANUP = new_dispatcher("cleanup")
+CLEANUP.register(remove_element, tags=NODES_TO_REMOVE, name="remove_unnecessary_node")
+CLEANUP.register(remove_element, attrs={"remap": "idml2xml:control"}, name="remove_control_node")
+CLEANUP.register(remove_unnecessary_attributes_of)
+CLEANUP.register(remove_element, predicate=is_css_node, name="remove_css_node")
+CLEANUP.register(remove_ns_attributes_of)
+CLEANUP.register(process_tab, tags=["tab"])
+
+# The two walks below keep track of the strings in segments (see Segments)
+def finishing(segments):
+    dispatcher = new_dispatcher("finishing")
+    dispatcher.register(fill_empty_element_with_br, tags=["para"])
+    dispatcher.register(lambda tag: unwrap_phrase_without_attribute(tag, segments),
+        tags=["phrase"], name="unwrap_phrase_without_attribute")
+    return dispatcher
+
+def phrase_linebreaks(segments):
+    dispatcher = new_dispatcher("phrase linebreaks")
+    dispatcher.register(lambda tag: remove_linebreak_before_and_after(tag, segments),
+        tags=["phrase"], name="remove_linebreak_before_and_after")
+    return dispatcher
+
+def merge_adjacent_phrases_with_same_role(root, same_attributes=False):
+    logging.info("Merging adjacent phrases with identical role…")
+
+    def is_phrase(el):
+        return is_element(el) and local_name(el) == "phrase"
+
+    def mergeable(cur, nxt):
+        if not is_phrase(cur) or not is_phrase(nxt):
+            return False
+        if same_attributes:
+            return dict(cur.attrib) == dict(nxt.attrib)
+        return list(cur.attrib.keys()) == ["role"] and list(nxt.attrib.keys()) == ["role"] \
+            and cur.get("role") == nxt.get("role")
+
+    for parent in list(iter_elements(root)):
+        cur = parent[0] if len(parent) else None
+        while cur is not None:
+            nxt = cur.getnext()
+            if nxt is not None and not cur.tail and mergeable(cur, nxt):
+                if len(cur): cur[-1].tail = (cur[-1].tail or "") + (nxt.text or "") or None
+                else: cur.text = (cur.text or "") + (nxt.text or "") or None
+                for child in list(nxt): cur.append(child)
+                cur.tail = nxt.tail
+                nxt.tail = None
+                parent.remove(nxt)
+                continue
+            cur = nxt
+
+def serialize(root, prolog=()):
+    """Serializes the tree the same way str(soup) does."""
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n']
+    for node in prolog:
+        serialize_node(node, out, {})
+    serialize_node(root, out, {})
+    return "".join(out)
+
+def serialized_name(node):
+    return (node.prefix + ":" if node.prefix else "") + etree.QName(node).localname
+
+def start_tag(node, parent_nsmap, empty=False):
+    attrs = [(attribute_name(node, k), v) for k, v in node.attrib.items()]
+    for prefix, uri in node.nsmap.items():
+        if parent_nsmap.get(prefix) != uri:
+            attrs.append(("xmlns:" + prefix if prefix else "xmlns", uri))
+    attrs.sort()
+    attribute_string = "".join(" " + k + "=" + quoted_attribute_value(v) for k, v in attrs)
+    return "<" + serialized_name(node) + attribute_string + ("/>" if empty else ">")
+
+def is_serialized_as_br(node, parent_nsmap):
+    return local_name(node) == "br" and len(node) == 0 and node.text is None and not node.attrib \
+        and start_tag(node, parent_nsmap, empty=True) == "<br/>"
+
+def serialize_node(node, out, parent_nsmap, linebreak=None):
+    """Appends the serialization of node to out. If linebreak is given,
+    it replaces the <br/> tags (see replace_linebreaks)."""
+    if node.tag is etree.Comment:
+        out.append(replace_linebreaks("<!--" + (node.text or "") + "-->", linebreak))
+    elif node.tag is etree.PI:
+        out.append(replace_linebreaks("<?" + node_string(node) + "?>", linebreak))
+    elif linebreak and is_serialized_as_br(node, parent_nsmap):
+        out.append(linebreak)
+    elif len(node) == 0 and node.text is None:
+        out.append(start_tag(node, parent_nsmap, empty=True))
+    else:
+        out.append(start_tag(node, parent_nsmap))
+        if node.text is not None: out.append(escape_xml_text(node.text))
+        nsmap = node.nsmap
+        for child in node:
+            serialize_node(child, out, nsmap, linebreak)
+        out.append("</" + serialized_name(node) + ">")
+    if node.getparent() is not None and node.tail is not None:
+        out.append(escape_xml_text(node.tail))
+
+def iter_serialized(root, prolog=()):
+    """Yields serialize(root, prolog) chunk by chunk, with the <br/> tags replaced
+    (see replace_linebreaks): the children of the root are serialized one at a time."""
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n']
+    for node in prolog:
+        serialize_node(node, out, {}, LINEBREAK)
+    if len(root) == 0 and root.text is None:
+        serialize_node(root, out, {}, LINEBREAK)
+        yield "".join(out)
+        return
+    out.append(start_tag(root, {}))
+    if root.text is not None: out.append(escape_xml_text(root.text))
+    yield "".join(out)
+    for child in root:
+        out = []
+        serialize_node(child, out, root.nsmap, LINEBREAK)
+        yield "".join(out)
+    yield "</" + serialized_name(root) + ">"
+
+def checkpoint_of(root, prolog):
+    """The tree and its prolog, as bytes lxml can parse again as they are."""
+    return b"".join(etree.tostring(node, encoding="utf-8", xml_declaration=False) for node in prolog) \
+        + etree.tostring(root, encoding="utf-8", xml_declaration=False)
+
+def clean_tree(root, options, mappings=None):
+    """The passes that come after the role names are fixed, up to the endnotes."""
+    profiler = profiler_of(options)
+    stage = profiler.stage
+
+    with stage("replace_linebreaks_after_css_attributes", root): replace_linebreaks_after_css_attributes(root)
+
+    if not options["ignore_overrides"]:
+        with stage("turn_overrides_into_roles", root): turn_overrides_into_roles(root, mappings)
+
+    profiler.walk(CLEANUP, root)
+    with stage("cleanup_namespaces", root): etree.cleanup_namespaces(root)
+
+def finish_tree(root, options):
+    """The passes that come after the notes were processed."""
+    profiler = profiler_of(options)
+    stage = profiler.stage
+
+    with stage("process_images", root):
+        process_images(root,
+            options["raster"],
+            options["vector"],
+            options["media"])
+
+    with stage("clean_urls_from_linebreaks", root): clean_urls_from_linebreaks(root) # must be done before remove_linebreaks and removeHyphens
+
+    # The strings are merged by clean_urls_from_linebreaks, as by a new parse
+    segments = Segments()
+
+    if not options["linebreaks"]:
+        with stage("remove_linebreaks", root): remove_linebreaks(root, segments)
+
+    logging.info("Removing empty elements...")
+    profiler.walk(finishing(segments), root)
+
+    if options["typography"]:
+        with stage("typography", root):
+            remove_orthotypography(root)
+            add_french_orthotypography(root, options["thin_spaces"])
+        # and by remove_orthotypography
+        segments = Segments()
+
+    profiler.walk(phrase_linebreaks(segments), root)
+    with stage("merge_adjacent_phrases_with_same_role", root):
+        merge_adjacent_phrases_with_same_role(root, options["merge_identical_phrases"])
+
+def rename_hub(root):
+    for hub in list(iter_elements(root, "hub")):
+        hub.tag = qualified_name(hub, "article")
+        hub.set("version", "5.0")
+
+def hubxml2docbook_to(file, output, **options):
+    logging.info("hubxml2docbook starting (lxml engine)...")
+
+    stage = profiler_of(options).stage
+
+    checkpoints = Checkpoints.of(file, "lxml", options)
+    stage_reached, checkpoint = checkpoints.latest(options) if checkpoints else (None, None)
+
+    if stage_reached is not None:
+        with stage("load checkpoint", lambda: root):
+            root = etree.fromstring(checkpoint, etree.XMLParser(huge_tree=True, resolve_entities=False))
+            prolog = prolog_of(root)
+    else:
+        with stage("parse", lambda: root): root = parse(file)
+
+        logging.info(input_name(file) + " read succesfully!")
+
+        with stage("fix_role_names", root): fix_role_names(root)
+
+        with stage("rename_hub", root):
+            rename_hub(root)
+            prolog = remove_xml_models(root, prolog_of(root))
+
+        if checkpoints:
+            with stage("save checkpoint"): checkpoints.save("roles", options, checkpoint_of(root, prolog))
+
+    if stage_reached != "notes":
+        clean_tree(root, options)
+        with stage("process_endnotes", root): process_endnotes(root)
+        with stage("process_notes", root): process_notes(root)
+
+        if checkpoints:
+            with stage("save checkpoint"): checkpoints.save("notes", options, checkpoint_of(root, prolog))
+
+    finish_tree(root, options)
+
+    with stage("serialization"): write_docbook(iter_serialized(root, prolog), output)
+
+    logging.info("hubxml2docbook done.")
@@ -1,14 +1,12 @@
-import re
+import argparse
 import sys
 import json
 import logging
 import os
+from functools import lru_cache
 from pathlib import Path
 from utils import custom_slugify
 from bs4 import BeautifulSoup
-from natsort import natsorted
-import natsort as ns
-import pandas as pd
 
 APPLY_HEURISTICS = True
 
@@ -52,7 +50,7 @@ def get_map(file):
     data = None
     try:
         data = json.load(f)
-        logging.debug("Data read from map file: " + str(data))
+        logging.debug("Data read from map file: %s", data)
     except:
         logging.warning("No data was read from map file.")
     return data
@@ -79,103 +77,162 @@ def build_roles_map(soup):
     """Takes a Hub XML soup as input, and builds a dict
     containing the exact InDesign style, the Hub role name,
     if the style is a default one, and a slugified role name as key."""
+    return build_roles_map_from_rules(rule.attrs for rule in css_rules(soup))
+
+def build_roles_map_from_rules(rules):
+    """Same as build_roles_map, but takes the attributes of
+    the css:rule elements (as mappings) as input."""
+    styles = tuple((attrs["name"], attrs["native-name"]) for attrs in rules if "native-name" in attrs)
+    return dict(roles_map_of(styles))
+
+@lru_cache(maxsize=64)
+def roles_map_of(styles):
+    """The roles map of a set of (name, native-name) styles. It is
+    computed once per set: the documents made with the same InDesign
+    template (e.g. the books of a --batch) share it."""
     roles = {}
-    for rule in soup.find_all("css:rule"):
-        if "native-name" in rule.attrs:
-            to_slugify = native = rule.attrs["native-name"]
-            default = False
-            
-            if native.startswith("$ID/"):
-                default = True
-                to_slugify = native[4:]
-            slug = custom_slugify(to_slugify)
+    for name, native in styles:
+        to_slugify = native
+        default = False
+
+        if native.startswith("$ID/"):
+            default = True
+            to_slugify = native[4:]
+        slug = custom_slugify(to_slugify)
 
-            roles[slug] = {"hub": rule.attrs["name"], "native": native, "default": default}
+        roles[slug] = {"hub": name, "native": native, "default": default}
     return roles
 
+def role_renames(roles):
+    """Maps the role and name values to rename to the renames they go
+    through, as (index in roles, key) couples, the last one giving their
+    new value. The roles are renamed one after the other, so a slug that
+    is the hub name of a later role is renamed again: the renames are
+    composed here, to be applied in a single pass over the document."""
+    return role_renames_of(tuple((key, value["hub"]) for key, value in roles.items()))
+
+@lru_cache(maxsize=64)
+def role_renames_of(pairs):
+    renames = {}
+    # Values taken by renamed values, and the values they were renamed from
+    holders = {}
+    for index, (key, hub) in enumerate(pairs):
+        if hub == key:
+            continue
+        moved = holders.pop(hub, [])
+        if hub not in renames: moved.append(hub)
+        for original in moved:
+            renames.setdefault(original, []).append((index, key))
+        holders.setdefault(key, []).extend(moved)
+    return renames
+
+def log_renamed_roles(roles, renamed):
+    for key in renamed:
+        value = roles[key]
+        logging.debug("Role name for style \"%s\" was changed: %s -> %s", value["native"], value["hub"], key)
+
 def update_roles_with_better_slugs(soup, roles):
     """Takes a Hub XML soup and the corresponding roles
     map, and updates the roles."""
-    for key, value in roles.items():
-        log = False
+    renames = role_renames(roles)
+    renamed = set()
+    for el in soup.find_all(True):
         for property in ["role", "name"]:
-            for el in soup.find_all(attrs={property: value["hub"]}):
-                if el[property] != key:
-                    el[property] = key
-                    if not log:
-                        logging.debug("Role name for style \"" + value["native"] + "\" was changed: " + value["hub"] + " -> " + key)
-                        log = True
-
+            value = el.attrs.get(property)
+            if value in renames:
+                el[property] = renames[value][-1][1]
+                renamed.update(renames[value])
+    log_renamed_roles(roles, [key for index, key in sorted(renamed)])
+
+
+CSS_NS = "http://www.w3.org/1996/css"
+# The CSSa namespace in Clark notation, as lxml writes the names
+CSS_CLARK = "{" + CSS_NS + "}"
+
+# Some CSSa (https://github.com/le-tex/CSSa) properties
+# must be deleted for a smarter overrides detection.
+# This list needs to be refined.
+CSSA_PROPERTIES_TO_IGNORE = frozenset([
+    "hyphens",                 # usually used for handling rags
+    "initial-letter",          # ignoring drop caps
+    "letter-spacing",          # usually used for handling rags
+    "line-height",             # maybe we can ignore it as well?
+    "text-decoration-offset",  # offset with the underlines
+    "text-decoration-width",   # width of the underline
+    "break-after",             # is this added by idml2hubxml to avoid the block-break character?
+    "page-break-after",        # is this added by idml2hubxml to avoid the page-break character?
+    "border-width",            # applied on chars by idml2hubxml, but seems to be a bug.
+    "margin-top",              # often used to adjust in the page.
+    "margin-bottom",           # often used to adjust in the page.
+    "direction",               # reading direction, most certainly is not relevent there...
+    "text-align-last",         # a wild guess...
+])
+
+# The default color, and black transparent
+CSSA_VALUES_TO_IGNORE = frozenset(["device-cmyk(0,0,0,1)", "device-cmyk(0,0,0,0)"])
+
+# The attributes that are part of the key of a style or an override, besides the css:* ones
+KEY_ATTRIBUTES = frozenset(["remap", "native-name", "name"])
+KEY_ATTRIBUTES_WITH_ROLE = KEY_ATTRIBUTES | {"role"}
 
 def normalize_attr_name(name: str) -> str:
-    """Return the local name with any namespace/prefix removed."""
-    if name.startswith('css_namespace__'):
-        name = name[len('css_namespace__'):]
-    return name
-
-def looks_like_css_attr(name: str):
-    """
-    Heuristic: detect attributes that were intended as css:*,
-    which means attributes that start with the css_namespace__ prefix
-    """
-    if name.startswith('css_namespace__'):
-        return True
-    return False
+    """Return the local name of a CSSa attribute, other names as they are."""
+    if getattr(name, "namespace", None) == CSS_NS:
+        return name.name
+    return name[len(CSS_CLARK):] if name.startswith(CSS_CLARK) else name
+
+def is_css_attribute(name):
+    """Whether an attribute is in the CSSa namespace, whatever its prefix:
+    BeautifulSoup gives the namespace of the attributes it parsed, lxml
+    (and the mappings built from its elements) gives Clark names. A name
+    is never recognized by its prefix alone."""
+    namespace = getattr(name, "namespace", None)
+    if namespace is not None:
+        return namespace == CSS_NS
+    return name.startswith(CSS_CLARK)
+
+def css_rules(soup):
+    """The css:rule elements of a soup, whatever the prefix of the CSSa namespace."""
+    return [rule for rule in soup.find_all("rule") if rule.namespace == CSS_NS]
+
+def css_property(name, value, apply_heuristics=APPLY_HEURISTICS):
+    """The (name, value) couple of a property, or None if it is ignored by
+    the heuristics. The keys are compared over and over while the overrides
+    are numbered: the strings are interned, so that they are compared by
+    identity, and freed once no key holds them anymore."""
+    if apply_heuristics and (name in CSSA_PROPERTIES_TO_IGNORE or value in CSSA_VALUES_TO_IGNORE):
+        return None
+    return (sys.intern(str(name)), sys.intern(str(value)))
 
 def canonical_css_key(tag, include_role=True):
     """Create a stable tuple key of (localname, value) sorted by name/value."""
     items = []
-    relevant_properties = ["remap", "native-name", "name"]
-    if include_role: relevant_properties += ["role"]
+    relevant_properties = KEY_ATTRIBUTES_WITH_ROLE if include_role else KEY_ATTRIBUTES
     for k, v in list(tag.attrs.items()):
-        if looks_like_css_attr(k) or k in relevant_properties : items = filter_property(items, tag, k, v)
+        if is_css_attribute(k) or k in relevant_properties: items = filter_property(items, tag, k, v)
     items.sort()
     return tuple(items)
 
 # Some CSS properties are not relevant here, so we might want to
 # filter them in order to have more interesting overrides classes...
 def filter_property(items, tag, k, v, apply_heuristics=APPLY_HEURISTICS):
-    # Some CSSa (https://github.com/le-tex/CSSa) properties 
-    # must be deleted for a smarter overrides detection. 
-    # This list needs to be refined.
-    CSSA_PROPERTIES_TO_IGNORE = [
-        "hyphens",                 # usually used for handling rags
-        "initial-letter",          # ignoring drop caps
-        "letter-spacing",          # usually used for handling rags
-        "line-height",             # maybe we can ignore it as well?
-        "text-decoration-offset",  # offset with the underlines
-        "text-decoration-width",   # width of the underline
-        "break-after",             # is this added by idml2hubxml to avoid the block-break character?
-        "page-break-after",        # is this added by idml2hubxml to avoid the page-break character?
-        "border-width",            # applied on chars by idml2hubxml, but seems to be a bug.
-        "margin-top",              # often used to adjust in the page.
-        "margin-bottom",           # often used to adjust in the page.
-        "direction",               # reading direction, most certainly is not relevent there...
-        "text-align-last",         # a wild guess...
-    ]
-
     name = normalize_attr_name(k)
-    append = True
-
-    if apply_heuristics:
-        # If we ignore this property, pass
-        if name in CSSA_PROPERTIES_TO_IGNORE:
-            del tag[k]
-            append = False
-        # If the color is equivalent to the default color or if is black transparent, pass
-        if v == "device-cmyk(0,0,0,1)": append = False
-        if v == "device-cmyk(0,0,0,0)": append = False
-        # TODO: Detect if value is 0 or one of the variants, and append false
-    
-    if append: items.append((name, v))
 
-    return items
+    # The ignored properties are removed from the tag
+    if apply_heuristics and name in CSSA_PROPERTIES_TO_IGNORE:
+        del tag[k]
+    item = css_property(name, v, apply_heuristics)
+    if item is not None: items.append(item)
 
-def turn_overrides_into_roles(xml):
-    # Hacky way to enable namespace support for the `css:`-prefixed attributes
-    xml = xml.replace('css:', 'css_namespace__')
+    return items
 
-    soup = BeautifulSoup(xml, "xml")
+def turn_overrides_into_roles(soup):
+    """Detects the direct formatting (the css:* attributes) of the tree
+    and turns each distinct set of properties into an override role.
+    The soup is modified in place. For backwards compatibility, a serialized
+    Hub XML string is also accepted, in which case a new soup is built."""
+    if isinstance(soup, str):
+        soup = BeautifulSoup(soup, "xml")
 
     para_map = {}      # properties_tuple -> index
     para_applied = {}  # properties_tuple -> set(base_role)
@@ -195,7 +252,7 @@ def turn_overrides_into_roles(xml):
     # Walk only para and phrase
     for tag in soup.find_all(TAGS_WITH_CSSA):
         # find css-like attrs
-        css_items = [(k, v) for k, v in tag.attrs.items() if looks_like_css_attr(k)]
+        css_items = [(k, v) for k, v in tag.attrs.items() if is_css_attribute(k)]
         if not css_items:
             continue
 
@@ -248,14 +305,17 @@ def turn_overrides_into_roles(xml):
 
     return soup, paragraph_styles_overrides, character_styles_overrides
 
-def get_styles(xml):
-
-    soup = BeautifulSoup(xml, "xml")
+def get_styles(soup):
+    """The keys of the paragraph and character styles (the css:rule
+    elements) of a Hub XML soup, or string. The properties ignored by
+    the heuristics are removed from the css:rule elements."""
+    if isinstance(soup, str):
+        soup = BeautifulSoup(soup, "xml")
 
     paragraph_styles = {}
     character_styles = {}
 
-    for tag in soup.find_all("css_namespace__rule"):
+    for tag in css_rules(soup):
         
         key = canonical_css_key(tag)
 
@@ -264,6 +324,82 @@ def get_styles(xml):
     
     return paragraph_styles, character_styles
 
+class StyleAnalysis:
+    """What analyse_styles found in a Hub XML document: the keys of its
+    paragraph and character styles by name, its paragraph and character
+    overrides as (index, applied_to, key) triples, and the (role, tag)
+    couples of its elements, overrides included. soup is the analysed
+    document, its overrides turned into roles."""
+    def __init__(self, soup, paragraph_styles, character_styles,
+            paragraph_styles_overrides, character_styles_overrides, roles):
+        self.soup = soup
+        self.paragraph_styles = paragraph_styles
+        self.character_styles = character_styles
+        self.paragraph_styles_overrides = paragraph_styles_overrides
+        self.character_styles_overrides = character_styles_overrides
+        self.roles = roles
+
+    def styles(self):
+        """The arguments of generate_css_from_styles, generate_ods..."""
+        return (self.paragraph_styles, self.character_styles,
+            self.paragraph_styles_overrides, self.character_styles_overrides)
+
+    def relevant_roles(self):
+        """The (role, tag) couples a map applies to, in natural order."""
+        from natsort import natsorted, ns
+        return [(role, tag) for role, tag in natsorted(self.roles, alg=ns.IGNORECASE)
+            if tag in TAGS_WITH_RELEVENT_ROLES]
+
+    def coverage(self, map):
+        """The roles covered by map (a dict built by build_dict_from_map_array),
+        and the (role, tag) couples it does not cover, the phrases last."""
+        covered = []
+        uncovered = []
+        for role, tag in self.relevant_roles():
+            if role in map:
+                covered.append(role)
+            else:
+                uncovered.append((role, tag))
+        uncovered.sort(key=lambda c: 1 if c[1] == "phrase" else 0)
+        return covered, uncovered
+
+    def css(self):
+        return generate_css_from_styles(*self.styles())
+
+    def to_css(self, filename_stem):
+        generate_css_to_file(*self.styles(), filename_stem)
+
+    def to_ods(self, filename_stem):
+        generate_ods(*self.styles(), filename_stem)
+
+    def to_json_template(self, file):
+        generate_json_template(self.roles, file)
+
+def roles_of(soup):
+    """The (role, tag) couples of the elements that come after the info
+    element of a Hub XML soup, except the roles of idml2xml (hub...)."""
+    info = soup.find("info")
+    if info is None:
+        raise ValueError("This file doesn't seem to be coming from idml2xml...")
+    roles = set()
+    for sibling in info.find_next_siblings(True):
+        for tag in [sibling] + sibling.find_all(True):
+            role = tag.get("role")
+            if role is not None and not role.startswith("hub"):
+                roles.add((role, tag.name))
+    return roles
+
+def analyse_styles(hubxml):
+    """Parses a Hub XML document (string, bytes or binary file-like object)
+    once, and finds its styles, its overrides and the roles of its elements
+    on the same soup. Returns a StyleAnalysis."""
+    soup = BeautifulSoup(hubxml, "xml")
+    fix_role_names(soup)
+    paragraph_styles, character_styles = get_styles(soup)
+    soup, paragraph_styles_overrides, character_styles_overrides = turn_overrides_into_roles(soup)
+    return StyleAnalysis(soup, paragraph_styles, character_styles,
+        paragraph_styles_overrides, character_styles_overrides, roles_of(soup))
+
 def generate_ods(
     paragraph_styles,
     character_styles,
@@ -271,6 +407,10 @@ def generate_ods(
     character_styles_overrides,
     filename_stem):
 
+    # pandas takes long to import, and is only needed here
+    import pandas as pd
+    from natsort import natsorted, ns
+
     output_file = f"{filename_stem}.ods"
 
     pairs = [
@@ -326,17 +466,7 @@ def generate_ods(
 def generate_css(hubxml):
     """Takes a Hub XML file as input, and outputs a string that corresponds
     to a CSS file that contains the extracted styles."""
-    soup = BeautifulSoup(hubxml, "xml")
-    fix_role_names(soup)
-    hubxml = str(soup)
-    hubxml = hubxml.replace('css:', 'css_namespace__')
-    paragraph_styles, character_styles = get_styles(hubxml)
-    soup, paragraph_styles_overrides, character_styles_overrides = turn_overrides_into_roles(hubxml)
-    return generate_css_from_styles(
-        paragraph_styles,
-        character_styles,
-        paragraph_styles_overrides,
-        character_styles_overrides)
+    return analyse_styles(hubxml).css()
 
 def generate_css_from_styles(
     paragraph_styles,
@@ -406,6 +536,8 @@ def generate_css_to_file(
     print(f"✅ Saved CSS to {output_file}")
 
 def generate_json_template(roles, file):
+    from natsort import natsorted, ns
+
     selectors = set()
     for role, tag in roles:
         if tag not in TAGS_WITH_RELEVENT_ROLES:
@@ -441,92 +573,52 @@ def build_dict_from_map_array(map):
         map_dict[entry["selector"][1:].replace(".", " ")] = entry["operation"]
     return map_dict
 
-if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print(": python map.py input.xml [--map map.json] [--to-ods] [--to-css] [--to-json-template]")
-        sys.exit(1)
-
-    has_map = "--map" in sys.argv
-    map = sys.argv[sys.argv.index("--map") + 1] if has_map else None
-    to_ods = "--to-ods" in sys.argv
-    to_css = "--to-css" in sys.argv
-    to_json_template = "--to-json-template" in sys.argv
-
-    sys.argv = [arg for arg in sys.argv if arg not in ["--to-ods", "--to-css", "--to-json-template"]]
-
-    file = sys.argv[1]
-    map_file = Path(map) if map else None
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='idml2docbook-utils',
+        description='List the styles and roles of a Hub XML file, and export them.')
+    parser.add_argument(
+        'input', type=str,
+        help='Hub XML file to analyse')
+    parser.add_argument(
+        '--map', type=str,
+        help='map file (JSON) whose coverage of the roles of the input is reported')
+    parser.add_argument(
+        '--to-ods', action='store_true',
+        help='saves the styles and overrides to an ODS file next to the input')
+    parser.add_argument(
+        '--to-css', action='store_true',
+        help='saves the styles and overrides to a CSS file next to the input')
+    parser.add_argument(
+        '--to-json-template', action='store_true',
+        help='saves a map file with a selector for every role of the input next to it, and exits')
+    args = parser.parse_args(argv)
+
+    file = args.input
+    map = None
+    if args.map and Path(args.map).exists():
+        map = get_map(args.map)
+        map = build_dict_from_map_array(map) if map else None
+
+    with open(file, "rb") as f:
+        analysis = analyse_styles(f)
 
-    file = sys.argv[1]
-    if(map_file and map_file.exists()):
-        map = get_map(map_file)
-        map = build_dict_from_map_array(map)
-
-    # Read the HTML input
-    with open(file, "r") as f:
-        hubxml = f.read()
-
-    soup = BeautifulSoup(hubxml, "xml")
-    fix_role_names(soup)
-    hubxml = str(soup)
-    hubxml = hubxml.replace('css:', 'css_namespace__')
-    paragraph_styles, character_styles = get_styles(hubxml)
-    soup, paragraph_styles_overrides, character_styles_overrides = turn_overrides_into_roles(hubxml)
-    hubxml = str(soup)
+    file_stem = os.path.splitext(file)[0]
 
     # Save as ODS
-    if to_ods:
-        file_stem = os.path.splitext(file)[0]
-        generate_ods(
-            paragraph_styles,
-            character_styles,
-            paragraph_styles_overrides,
-            character_styles_overrides,
-            file_stem
-        )
+    if args.to_ods: analysis.to_ods(file_stem)
 
     # Save as CSS
-    if to_css:
-        file_stem = os.path.splitext(file)[0]
-        generate_css_to_file(
-            paragraph_styles,
-            character_styles,
-            paragraph_styles_overrides,
-            character_styles_overrides,
-            file_stem
-        )
-
-    type_and_role = r'<(\w+)[^>]*\brole="(.*?)"[^>]*>'
-
-    roles = set()
-
-    try:
-        for tag_name, role_attr in re.findall(type_and_role, hubxml.split("</info>")[1]):
-            if not role_attr.startswith("hub"):
-                roles.add((role_attr, tag_name))
-    except Exception as e:
-        raise ValueError("This file doesn't seem to be coming from idml2xml...") from e
+    if args.to_css: analysis.to_css(file_stem)
 
     bold_print("Role/tag couples present in " + file + ":")
-    for role, tag in natsorted(roles, alg=ns.IGNORECASE):
-        if tag in TAGS_WITH_RELEVENT_ROLES:
-            print(f"- {role} ({tag})")
+    for role, tag in analysis.relevant_roles():
+        print(f"- {role} ({tag})")
 
-    if to_json_template: generate_json_template(roles, file)
+    if args.to_json_template: analysis.to_json_template(file)
 
     if map:
-        covered = []
-        uncovered = []
-
-        for role, tag in natsorted(roles, alg=ns.IGNORECASE):
-            if tag in TAGS_WITH_RELEVENT_ROLES:
-                if map and role not in map:
-                    uncovered.append((role, tag))
-                elif map:
-                    covered.append(role)
-
-        uncovered.sort(key=lambda c: 1 if c[1] == "phrase" else 0)
-        covered.sort(key=lambda c: 1 if c[1] == "phrase" else 0)
+        covered, uncovered = analysis.coverage(map)
 
         print(OKGREEN)
         if covered:
@@ -534,7 +626,7 @@ if __name__ == "__main__":
             for c in covered:
                 print("- " + c + " => " + log_map_entry(map[c]))
         else:
-            bold_print(WARNING + (map_file + " does not apply to " + file))
+            bold_print(WARNING + (args.map + " does not apply to " + file))
 
         if uncovered:
             print(WARNING)
@@ -546,3 +638,6 @@ if __name__ == "__main__":
         print(END)
     else:
         print("\nNo data was read from the map file, or no map file was given!")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Output files, written atomically.
+
+The DocBook is written to a temporary file next to the target, which is
+renamed over it once the conversion succeeded: a failed or interrupted
+conversion does not leave a truncated file behind, and the previous version
+of the file stays readable until the new one is complete. Targets ending
+in .gz are gzip-compressed."""
+
+import contextlib
+import gzip
+import io
+import os
+import tempfile
+from pathlib import Path
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# The mode of new files. The umask can only be read by setting it, for the
+# whole process: files created by other threads meanwhile would get the wrong
+# mode. It is read once, when the module is imported, not for every output.
+FILE_MODE = 0o666 & ~current_umask()
+
+@contextlib.contextmanager
+def open_output(path, encoding="utf-8"):
+    """Opens path for writing text, atomically, and gzipped if it ends with .gz."""
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix="." + path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as raw:
+            if path.suffix == ".gz":
+                # No timestamp in the header: the same output gives the same file
+                binary = gzip.GzipFile(filename=path.stem, fileobj=raw, mode="wb", mtime=0)
+            else:
+                binary = raw
+            with io.TextIOWrapper(binary, encoding=encoding) as f:
+                yield f
+        # mkstemp creates files only readable by their owner
+        os.chmod(tmp, FILE_MODE)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
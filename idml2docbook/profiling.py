@@ -0,0 +1,184 @@
+"""Per-stage profile of a conversion (--profile).
+
+Each stage of the conversion (idml2xml, parsing, renaming the roles,
+every cleanup pass, serialization...) is timed and measured:
+
+* wall: elapsed time, in seconds;
+* cpu: CPU time of the process and of its finished subprocesses, in seconds;
+* memory: peak of the memory allocated by Python during the stage, above
+  what was allocated when it started, in bytes (measured with tracemalloc,
+  which slows down the conversion, and blind to the memory of idml2xml);
+* nodes: number of elements in the tree after the stage.
+
+A stage run several times (e.g. once per part in streaming mode) is reported
+once, with its number of calls, the sum of its times and of its nodes, and
+its largest memory peak. The handlers of
+a Dispatcher walk (see dispatch.py) are reported below the walk, with the
+time spent in each of them.
+
+The report is written as JSON and as a table. One stage can also be run
+under cProfile, its statistics are written next to the report and can be
+read with pstats or snakeviz."""
+
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import time
+import tracemalloc
+import types
+from pathlib import Path
+
+def cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def count_nodes(tree):
+    if hasattr(tree, "find_all"):
+        return len(tree.find_all(True))
+    return sum(1 for _ in tree.iter("*"))
+
+class Profiler:
+    def __init__(self, cprofile_stage=None, memory=True):
+        """Without memory, tracemalloc is not used and the memory is not reported."""
+        self.stages = {}
+        self.open_stages = []
+        self.cprofile_stage = cprofile_stage
+        self.cprofile = None
+        self.timer = time.perf_counter
+        self.memory = memory
+        self.started_tracemalloc = memory and not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+        self.start = time.perf_counter(), cpu_time()
+
+    def record(self, name):
+        if name not in self.stages:
+            self.stages[name] = {"name": name, "calls": 0, "wall": 0.0, "cpu": 0.0, "memory": 0, "nodes": None}
+        return self.stages[name]
+
+    def update_peaks(self):
+        """The peak of tracemalloc is shared: it is reset when a stage starts,
+        the stages it is nested in keep the peak reached until then."""
+        if not self.memory:
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self.open_stages:
+            stage["peak"] = max(stage["peak"], peak)
+
+    @contextlib.contextmanager
+    def stage(self, name, tree=None):
+        """Measures the code run in the with block. tree is the tree the stage
+        works on, or a function returning it once the stage is done."""
+        self.update_peaks()
+        current = {"peak": 0, "memory": 0}
+        if self.memory:
+            tracemalloc.reset_peak()
+            current["memory"] = tracemalloc.get_traced_memory()[0]
+        self.open_stages.append(current)
+        profile = None
+        if name == self.cprofile_stage:
+            profile = self.cprofile = self.cprofile or cProfile.Profile()
+        wall, cpu = time.perf_counter(), cpu_time()
+        done = False
+        try:
+            if profile: profile.enable()
+            yield
+            done = True
+        finally:
+            if profile: profile.disable()
+            wall, cpu = time.perf_counter() - wall, cpu_time() - cpu
+            self.update_peaks()
+            self.open_stages.pop()
+            record = self.record(name)
+            record["calls"] += 1
+            record["wall"] += wall
+            record["cpu"] += cpu
+            if self.memory:
+                record["memory"] = max(record["memory"], current["peak"] - current["memory"])
+            else:
+                record["memory"] = None
+            # Not callable(): bs4 tags are callable
+            if done and isinstance(tree, types.FunctionType): tree = tree()
+            if done and tree is not None:
+                record["nodes"] = (record["nodes"] or 0) + count_nodes(tree)
+
+    def walk(self, dispatcher, tree):
+        """Runs a Dispatcher walk as a stage, with the time spent in each handler."""
+        with self.stage(dispatcher.name, tree):
+            dispatcher.run(tree, self.timer)
+        for name, *_ in dispatcher.handlers:
+            record = self.record(dispatcher.name + ": " + name)
+            record["parent"] = dispatcher.name
+            record["calls"] += dispatcher.counts[name]
+            record["wall"] += dispatcher.times[name]
+            record["cpu"] = record["memory"] = None
+
+    def report(self):
+        return {
+            "wall": time.perf_counter() - self.start[0],
+            "cpu": cpu_time() - self.start[1],
+            "stages": list(self.stages.values()),
+        }
+
+    def table(self):
+        report = self.report()
+        lines = [f"{'stage':<48} {'calls':>7} {'wall (s)':>9} {'cpu (s)':>9} {'memory (MB)':>12} {'nodes':>9}"]
+        def number(value, format):
+            return "" if value is None else format.format(value)
+        for stage in report["stages"] + [{"name": "total", "calls": None, "wall": report["wall"], "cpu": report["cpu"], "memory": None, "nodes": None}]:
+            name = ("  " + stage["name"][len(stage["parent"]) + 2:]) if stage.get("parent") else stage["name"]
+            lines.append(f"{name:<48} {number(stage['calls'], '{}'):>7} {number(stage['wall'], '{:.3f}'):>9} "
+                f"{number(stage['cpu'], '{:.3f}'):>9} {number(stage['memory'] and stage['memory'] / 1024 / 1024, '{:.1f}'):>12} "
+                f"{number(stage['nodes'], '{}'):>9}")
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Writes the report to path (JSON), the table next to it (.txt)
+        and the statistics of the cProfile stage (.prof)."""
+        path = Path(path)
+        if path.parent: path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        table = self.table()
+        with open(path.with_suffix(".txt"), "w") as f:
+            f.write(table + "\n")
+        logging.info("Profile written at: " + str(path) + "\n" + table)
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(path.with_suffix(".prof"))
+            logging.info("cProfile statistics of \"" + self.cprofile_stage + "\" written at: " + str(path.with_suffix(".prof")))
+        elif self.cprofile_stage:
+            logging.warning("No stage named \"" + self.cprofile_stage + "\" was run, nothing to profile with cProfile.")
+        return table
+
+    def close(self):
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+class NoProfiler:
+    """Stands in for a Profiler when the conversion is not profiled."""
+    def stage(self, name, tree=None):
+        return contextlib.nullcontext()
+
+    def walk(self, dispatcher, tree):
+        dispatcher.run(tree)
+
+NO_PROFILER = NoProfiler()
+
+def profiler_of(options):
+    return options.get("profiler") or NO_PROFILER
+
+@contextlib.contextmanager
+def profiled(options):
+    """Gives the options to use in the with block: if options["profile"]
+    is set, they carry a Profiler, whose report is written at the end."""
+    if not options.get("profile"):
+        yield options
+        return
+    profiler = Profiler(options.get("profile_stage"))
+    try:
+        yield options | {"profiler": profiler}
+        profiler.write(options["profile"])
+    finally:
+        profiler.close()
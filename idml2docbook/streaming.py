@@ -0,0 +1,320 @@
+"""Bounded-memory conversion of Hub XML files, built on the lxml engine.
+
+The Hub XML file is parsed incrementally and every top-level child of <hub>
+(with the comments and processing instructions before it) is converted on
+its own, in a copy of the root element, then written to the output and
+dropped. Memory use is therefore bound by the largest top-level child
+instead of the size of the document.
+
+The state shared by the whole document is gathered by a first, cheap pass
+over the file: the css:rule elements (role names), the numbering of the
+override classes, and a raw copy of the endnote paragraphs, which usually
+come at the very end of the file while they are referenced all along it.
+
+The output is the one of the lxml engine, as long as the top-level children
+do not interact with each other: inline elements (e.g. <phrase>) or text
+directly in <hub> are merged with or cleaned up after their neighbours.
+The first pass looks for them, and a warning is logged if there are any.
+
+In incremental mode, the DocBook of every top-level child is also cached,
+under the hash of its Hub XML and of everything else it depends on: the
+role names (so, the style resources), the override classes it got, the
+endnotes it refers to and the options. When a document is converted again
+after a few changes, only the parts that changed are converted, the others
+are taken from the cache and stitched together. The parts are the top-level
+children of <hub>, not the stories of the IDML file: idml2xml only converts
+whole packages, so a changed story still runs idml2xml on the whole package.
+A document whose top-level children interact is converted by the lxml
+engine instead, without the cache."""
+
+import copy
+import hashlib
+import io
+import json
+import logging
+from lxml import etree
+
+from idml2docbook.core import LINEBREAK, write_docbook, log_endnotes_summary
+from idml2docbook.lxml_engine import (
+    collapse_whitespace,
+    css_rules_of,
+    rename_roles,
+    log_renamed_roles,
+    rename_hub,
+    remove_xml_models,
+    prolog_of,
+    new_override_mappings,
+    turn_overrides_into_roles,
+    clean_tree,
+    finish_tree,
+    index_endnotes,
+    process_notes,
+    replace_endnote_links,
+    iter_elements,
+    local_name,
+    remove_element,
+    start_tag,
+    serialize_node,
+    serialized_name,
+)
+from map import build_roles_map_from_rules
+from cache import GzipCache
+from checkpoints import code_revision
+from profiling import profiler_of
+from utils import escape_xml_text, is_path, input_name
+
+def rereadable(file):
+    """Returns a function giving the input, from its start, for each pass over
+    it. Streams that cannot be rewound (e.g. stdin) are read in memory once."""
+    if is_path(file):
+        return lambda: file
+    if hasattr(file, "read"):
+        seekable = getattr(file, "seekable", None)
+        if seekable() if seekable else hasattr(file, "seek"):
+            start = file.tell()
+            def rewound():
+                file.seek(start)
+                return file
+            return rewound
+        file = file.read()
+    return lambda: io.BytesIO(file)
+
+def iter_top_level_nodes(file):
+    """Parses file incrementally and yields (root, nodes) couples, nodes being
+    the next top-level children of the root. A child is only yielded once
+    its tail has been parsed. The last couple holds what remains in the root."""
+    context = etree.iterparse(file, events=("start", "end"),
+        recover=True, huge_tree=True, resolve_entities=False)
+    depth = 0
+    root = pending = None
+    for event, el in context:
+        if event == "start":
+            if depth == 0:
+                root = el
+            elif depth == 1 and pending is not None:
+                nodes = []
+                for node in root:
+                    nodes.append(node)
+                    if node is pending: break
+                yield root, nodes
+                pending = None
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                pending = el
+            elif depth == 0:
+                yield root, list(root)
+
+def new_part(root, nodes, text=None):
+    """Moves nodes into an empty copy of the root element."""
+    part = etree.Element(root.tag, root.attrib, nsmap=root.nsmap)
+    part.text = text
+    for node in nodes:
+        part.append(node)
+    collapse_whitespace(part)
+    return part
+
+# The options that change the DocBook of a part
+CONVERSION_OPTIONS = ["ignore_overrides", "typography", "thin_spaces", "linebreaks", "media", "raster", "vector",
+    "merge_identical_phrases"]
+
+def digest(*items):
+    return hashlib.sha256(json.dumps(items, sort_keys=True).encode()).hexdigest()
+
+def roles_of(el):
+    """The role attributes of el and its descendants, once the overrides are numbered."""
+    return [node.get("role") for node in iter_elements(el)]
+
+# Inline elements, which the cleanup merges with or trims after their siblings
+INLINE_ELEMENTS = ["phrase", "link", "br", "tab"]
+
+def interacting_node(root, nodes, first):
+    """Describes the first of nodes (top-level children of root) that cannot
+    be converted apart from its neighbours, or returns None."""
+    if first and root.text and root.text.strip():
+        return "text " + repr(root.text.strip()[:20])
+    for node in nodes:
+        if local_name(node) in INLINE_ELEMENTS:
+            return "<" + local_name(node) + "> element"
+        if node.tail and node.tail.strip():
+            return "text " + repr(node.tail.strip()[:20])
+    return None
+
+def prescan(file, options, fingerprint=False):
+    """Returns the roles map, the override mappings of the whole document,
+    raw copies of the endnote paragraphs, indexed by anchor id, a dict for
+    every part, with the linkends of its EndnoteRange links and what in it
+    interacts with the other parts (see interacting_node), and a dict of
+    fingerprints of the endnotes. If fingerprint is set, the dicts of the parts
+    hold their fingerprints as well, and the fingerprints of the endnotes are
+    computed (see fragment_key)."""
+    logging.info("Scanning " + input_name(file) + "...")
+
+    rules = []
+    roles = {}
+    mappings = new_override_mappings()
+    endnotes = {}
+    parts = []
+    endnote_fingerprints = {}
+
+    for root, nodes in iter_top_level_nodes(file):
+        first = not parts
+        interacting = interacting_node(root, nodes, first)
+        part = new_part(root, nodes)
+
+        copies = {}
+        endnote_paras, links = index_endnotes(part)
+        for anchor_id, para in endnote_paras.items():
+            if para not in copies: copies[para] = copy.deepcopy(para)
+            endnotes[anchor_id] = copies[para]
+        description = {"linkends": [link.get("linkend") for link in links], "interacting": interacting}
+
+        if fingerprint:
+            raw = etree.tostring(part, encoding="unicode")
+            if first:
+                raw += "".join(etree.tostring(node, encoding="unicode") for node in prolog_of(root)) + (root.text or "")
+
+        new_rules = css_rules_of(part)
+        if new_rules:
+            rules += new_rules
+            roles = build_roles_map_from_rules(rules)
+        rename_roles(part, roles)
+        rename_hub(part)
+        if not options["ignore_overrides"]: turn_overrides_into_roles(part, mappings)
+
+        if fingerprint:
+            description |= {"raw": digest(raw), "roles": roles_of(part)}
+        parts.append(description)
+        if fingerprint:
+            for anchor_id, para in endnote_paras.items():
+                endnote_fingerprints[anchor_id] = digest(etree.tostring(copies[para], encoding="unicode"), roles_of(para))
+
+    return roles, mappings, endnotes, parts, endnote_fingerprints
+
+def fragment_key(index, part, endnote_fingerprints, roles, options):
+    """What the DocBook of a part depends on."""
+    return digest(code_revision(),
+        {name: options[name] for name in CONVERSION_OPTIONS},
+        roles,
+        index == 0,
+        part["raw"],
+        part["roles"],
+        [endnote_fingerprints.get(linkend) for linkend in part["linkends"]])
+
+def hubxml2docbook_stream(file, output, **options):
+    """Converts the Hub XML file to DocBook, and writes the result
+    to the output file-like object as it goes."""
+    logging.info("hubxml2docbook starting (streaming)...")
+
+    source = rereadable(file)
+
+    stage = profiler_of(options).stage
+
+    fragments = None
+    if options.get("incremental"):
+        fragments = GzipCache(options["incremental"], options.get("checkpoints_size") or 1024, suffix=".fragment.gz")
+    with stage("prescan"):
+        roles, mappings, raw_endnotes, parts, endnote_fingerprints = prescan(source(), options, fingerprint=fragments is not None)
+    log_endnotes_summary(raw_endnotes, [linkend for part in parts for linkend in part["linkends"]])
+
+    interacting = next((part["interacting"] for part in parts if part["interacting"]), None)
+    if interacting is not None:
+        if fragments is not None:
+            logging.warning("The " + interacting + " directly in <hub> is converted with its neighbours: "
+                "the document is converted as a whole by the lxml engine, without the incremental cache.")
+            from lxml_engine import hubxml2docbook_to
+            return hubxml2docbook_to(source(), output, **options)
+        logging.warning("The " + interacting + " directly in <hub> is converted with its neighbours: "
+            "the output of the streaming engine may differ from the one of the lxml engine.")
+    endnotes = {}
+    renamed = []
+    reused = 0
+
+    def prepare(part):
+        with stage("fix_role_names", part):
+            for key in rename_roles(part, roles):
+                if key not in renamed: renamed.append(key)
+        with stage("rename_hub", part): rename_hub(part)
+        clean_tree(part, options, mappings)
+
+    def endnote(root, anchor_id):
+        raw = raw_endnotes[anchor_id]
+        if id(raw) not in endnotes:
+            part = new_part(root, [copy.deepcopy(raw)])
+            prepare(part)
+            endnotes[id(raw)] = part[0]
+        return endnotes[id(raw)]
+
+    def chunks():
+        nonlocal reused
+        for index, (root, nodes) in enumerate(iter_top_level_nodes(source())):
+            if fragments is not None:
+                key = fragment_key(index, parts[index], endnote_fingerprints, roles, options)
+                fragment = fragments.get(key)
+                if fragment is not None:
+                    reused += 1
+                    for node in nodes: root.remove(node)
+                else:
+                    fragment = convert(index, root, nodes).encode("utf-8")
+                    if not article_closed: fragments.put_bytes(key, fragment, evict=False)
+                yield fragment.decode("utf-8")
+            else:
+                yield convert(index, root, nodes)
+
+        if fragments is not None:
+            fragments.evict()
+            logging.info(f"{reused} parts out of {len(parts)} were taken from the cache.")
+
+        article = new_part(root, [])
+        rename_hub(article)
+        if not article_closed:
+            yield "</" + serialized_name(article) + ">"
+
+    article_closed = False
+
+    def convert(index, root, nodes):
+        """Returns the DocBook of a part."""
+        first = index == 0
+        part = new_part(root, nodes, root.text if first else None)
+        prolog = remove_xml_models(part, prolog_of(root) if first else [])
+        prepare(part)
+
+        endnote_paras, links = index_endnotes(part)
+        endnote_map = {
+            link.get("linkend"): endnote(root, link.get("linkend"))
+            for link in links if link.get("linkend") in raw_endnotes
+        }
+        with stage("process_endnotes", part):
+            # The endnotes are shared by the parts, they are always copied
+            replace_endnote_links(links, endnote_map, move=False)
+            for para in set(endnote_paras.values()):
+                remove_element(para)
+        with stage("process_notes", part): process_notes(part)
+
+        finish_tree(part, options)
+
+        with stage("serialization"): return serialize_part(first, part, prolog, nodes)
+
+    def serialize_part(first, part, prolog, nodes):
+        nonlocal article_closed
+        out = []
+        if first:
+            out.append('<?xml version="1.0" encoding="utf-8"?>\n')
+            for node in prolog:
+                serialize_node(node, out, {}, LINEBREAK)
+            if not nodes and part.text is None:
+                # Empty document
+                out.append(start_tag(part, {}, empty=True))
+                article_closed = True
+                return "".join(out)
+            out.append(start_tag(part, {}))
+            if part.text is not None: out.append(escape_xml_text(part.text))
+        for node in part:
+            serialize_node(node, out, part.nsmap, LINEBREAK)
+        return "".join(out)
+
+    write_docbook(chunks(), output)
+
+    log_renamed_roles(roles, renamed)
+    logging.info("hubxml2docbook done.")
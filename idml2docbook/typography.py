@@ -0,0 +1,78 @@
+"""Typography rules, as data tables compiled once.
+
+A Typography is made of:
+
+* a translation table: characters replaced by strings (possibly empty),
+  all of them in a single pass over the text with str.translate;
+* rules: (pattern, replacement) couples, applied in order with re.sub.
+  The rules of a locale feed each other (e.g. the space inserted after «
+  is then found by the rule for »), so they are not merged into one pattern;
+* a trigger: a pattern found in every text a rule or the translation table
+  changes. Texts where it is not found are returned as they are, which is
+  the case of most text nodes.
+
+The replacements of the rules can use spaces by name, e.g. "{colon_space}:",
+as they depend on the options (see spaces_of)."""
+
+import re
+from functools import lru_cache
+
+NON_DISCRETIONARY_HYPHEN = u"\u00ad"
+NO_BREAK_SPACE = u"\u00a0"
+NARROW_NO_BREAK_SPACE = u"\u202f"
+
+SPECIAL_SPACES = [
+    u"\u00a0", u"\u1680", u"\u180e", u"\u2000", u"\u2001", u"\u2002", u"\u2003", u"\u2004",
+    u"\u2005", u"\u2006", u"\u2007", u"\u2008", u"\u2009", u"\u200a", u"\u200b", u"\u202f",
+    u"\u205f", u"\u3000"
+]
+
+# Removes the typography of the input: non-discretionary hyphens, special spaces
+STRIP = {NON_DISCRETIONARY_HYPHEN: ""} | {space: " " for space in SPECIAL_SPACES}
+
+LOCALES = {
+    "fr": {
+        "rules": [
+            (r"\s+([!\?;€\$%])", "{thin_space}\\1"), # thin spaces
+            (r"\s+\:", "{colon_space}:"), # nbsp, doesn't seem to work...
+            (r"(\d)\s+(\d\d\d)", "\\1{thin_space}\\2"), # numbers
+            (r"«\s*", "«{thin_space}"), # quotes
+            (r"\s*»", "{thin_space}»"), # quotes
+            (r"([^0-9])°\s*", "\\1°{thin_space}"), # degrees
+            (r"\.\.\.", "…"), # suspension marks
+        ],
+        "trigger": r"\s[!\?;€\$%:]|\d\s|[«»°]|\.\.\.",
+    },
+}
+
+def spaces_of(thin_spaces):
+    """The spaces the replacements can use. With thin_spaces, only non-breaking thin spaces are used."""
+    return {
+        "thin_space": NARROW_NO_BREAK_SPACE,
+        "colon_space": NARROW_NO_BREAK_SPACE if thin_spaces else NO_BREAK_SPACE,
+    }
+
+class Typography:
+    def __init__(self, translation=None, rules=(), trigger=None, spaces=None):
+        self.translation = str.maketrans(translation) if translation else None
+        self.rules = [(re.compile(pattern), replacement.format(**(spaces or {})))
+            for pattern, replacement in rules]
+        if trigger is None:
+            trigger = "[" + "".join(re.escape(char) for char in translation) + "]"
+        self.trigger = re.compile(trigger)
+
+    def __call__(self, text):
+        if not self.trigger.search(text):
+            return text
+        if self.translation:
+            text = text.translate(self.translation)
+        for pattern, replacement in self.rules:
+            text = pattern.sub(replacement, text)
+        return text
+
+@lru_cache(maxsize=None)
+def locale_typography(locale, thin_spaces=False):
+    rules = LOCALES[locale]
+    return Typography(rules=rules["rules"], trigger=rules["trigger"], spaces=spaces_of(thin_spaces))
+
+strip_typography = Typography(STRIP)
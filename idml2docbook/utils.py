@@ -1,6 +1,7 @@
 from bs4 import BeautifulSoup, Tag, NavigableString
 import re
 import unidecode
+import io
 import json
 import sys
 import urllib
@@ -81,6 +82,40 @@ def decode_path(encoded_path):
     It is sometimes necessary to decode them."""
     return urllib.parse.unquote(encoded_path)
 
+def is_path(file):
+    """Inputs are paths, bytes (or any bytes-like object) or binary file-like objects."""
+    return isinstance(file, (str, os.PathLike))
+
+def input_name(file):
+    """The name of an input in the logs, e.g. <stdin> or <bytes>."""
+    if is_path(file):
+        return str(file)
+    return str(getattr(file, "name", None) or "<" + type(file).__name__ + ">")
+
+def binary_source(file):
+    """The input as the XML parsers take it: a path or a binary file-like
+    object (e.g. an mmap). Bytes are wrapped in a BytesIO, which does not copy them."""
+    if is_path(file):
+        return os.fspath(file)
+    if hasattr(file, "read"):
+        return file
+    return io.BytesIO(file)
+
+def escape_xml_text(text):
+    """Escapes a text node the way BeautifulSoup's minimal formatter does."""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def quoted_attribute_value(value):
+    """Escapes and quotes an attribute value the way BeautifulSoup does."""
+    value = escape_xml_text(value)
+    quote_with = '"'
+    if '"' in value:
+        if "'" in value:
+            value = value.replace('"', "&quot;")
+        else:
+            quote_with = "'"
+    return quote_with + value + quote_with
+
 def generate_xml_id(title_text, xml_ids):
     xml_id = custom_slugify(title_text)
     if xml_id in xml_ids:
@@ -107,6 +142,25 @@ def remove_newlines_inside(tag):
             txt = txt.replace("\n", "").replace("\r", "")
             node.replace_with(txt)
 
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+def normalize_strings(tag):
+    """
+    Merge adjacent text nodes and collapse whitespace-only ones into a single
+    newline or space, the same way BeautifulSoup does when parsing a document.
+    The tree is thus left in the shape it would have after a serialize/parse round trip.
+    """
+    for node in list(tag.find_all(string=True)):
+        if type(node) is NavigableString and node == "":
+            node.extract()
+
+    tag.smooth()
+
+    for node in list(tag.find_all(string=True)):
+        if type(node) is NavigableString and not node.strip(ASCII_SPACES):
+            collapsed = "\n" if "\n" in node else " "
+            if node != collapsed: node.replace_with(collapsed)
+
 def remove_linebreak_after(tag):
     # Remove all whitespace only nodes after
     nxt = tag.next_sibling
@@ -179,23 +233,35 @@ def split_leading_closers(s):
 
 
 def reindent_xml_lines(xml, indent="    "):
-    level = 0
-    out = []
-
-    for line in xml.splitlines():
+    return "\n".join(iter_reindented_lines(xml.splitlines(), indent))
+
+def iter_reindented_lines(lines, indent="    "):
+    """Reindents lines of XML one after the other, so that a document
+    can be reindented while it is being written."""
+    reindenter = Reindenter(indent)
+    for line in lines:
+        yield reindenter.reindent(line)
+
+class Reindenter:
+    """Reindents lines of XML, the level of a line depending on the tags
+    opened and closed by the lines before it."""
+    def __init__(self, indent="    "):
+        self.indent = indent
+        self.level = 0
+
+    def reindent(self, line):
         stripped = line.lstrip()
 
         if not stripped:
-            out.append("")
-            continue
+            return ""
 
         # Deindent for leading closing tags
         leading_closers, remainder = split_leading_closers(stripped)
-        level -= leading_closers
-        if level < 0:
-            level = 0
+        self.level -= leading_closers
+        if self.level < 0:
+            self.level = 0
 
-        out.append(f"{indent * level}{stripped}")
+        reindented = f"{self.indent * self.level}{stripped}"
 
         # Count tags, but ignore the leading closers we already handled
         tags = TAG_RE.findall(remainder)
@@ -216,8 +282,44 @@ def reindent_xml_lines(xml, indent="    "):
                 opens += 1
 
         # Update level
-        level += opens - closes
-        if level < 0:
-            level = 0
-
-    return "\n".join(out)
\ No newline at end of file
+        self.level += opens - closes
+        if self.level < 0:
+            self.level = 0
+
+        return reindented
+
+# The line boundaries of str.splitlines()
+LINE_BOUNDARY_RE = re.compile("[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]")
+
+class ReindentingWriter:
+    """File-like object: the XML written to it is reindented the way
+    reindent_xml_lines does, and written to sink line by line.
+    Only the line being written is kept, the chunks can be of any size."""
+    def __init__(self, sink, indent="    "):
+        self.sink = sink
+        self.reindenter = Reindenter(indent)
+        self.pending = []
+        self.first_line = True
+
+    def write(self, chunk):
+        if not LINE_BOUNDARY_RE.search(chunk):
+            self.pending.append(chunk)
+            return
+        text = "".join(self.pending) + chunk
+        # The last line may go on in the next chunk (even "\r" may be followed by "\n")
+        last = text.splitlines(keepends=True)[-1]
+        self.pending = [last]
+        self.write_lines(text[:len(text) - len(last)].splitlines())
+
+    def write_lines(self, lines):
+        if not lines:
+            return
+        text = "\n".join(map(self.reindenter.reindent, lines))
+        self.sink.write(text if self.first_line else "\n" + text)
+        self.first_line = False
+
+    def close(self):
+        """Writes the last line. The sink is not closed."""
+        rest = "".join(self.pending)
+        self.pending = []
+        self.write_lines(rest.splitlines())
@@ -1,4 +1,5 @@
 # tests/test_idml2docbook.py
+import sys
 from pathlib import Path
 import pytest
 from idml2docbook.core import idml2docbook
@@ -56,6 +57,25 @@ def test_convert_css_transform_direction():
     assert expected_docbook == processed_docbook
 
 
+# Without typography, the whitespace-only strings left by the unwrapped
+# phrases and <br/> tags are removed around the phrases
+GOLDENS_WITHOUT_TYPOGRAPHY = [
+    ("bollo/bollo.xml", "bollo/bollo.default.dbk", {}),
+    ("bollo/bollo.xml", "bollo/bollo.ignore_overrides.dbk", {'ignore_overrides': True}),
+    ("css_transform_direction/css_transform_direction.xml",
+        "css_transform_direction/css_transform_direction.default.dbk", {}),
+    ("css_transform_direction/css_transform_direction.xml",
+        "css_transform_direction/css_transform_direction.linebreaks.dbk", {'linebreaks': True}),
+]
+
+@pytest.mark.parametrize("engine", ["bs4", "lxml"])
+@pytest.mark.parametrize("hubxml, dbk, options", GOLDENS_WITHOUT_TYPOGRAPHY)
+def test_convert_without_typography(hubxml, dbk, options, engine):
+    options = DEFAULT_OPTIONS | options | {'idml2hubxml_file': True, 'checkpoints': False, 'engine': engine}
+    expected_docbook = (TESTDATA / dbk).read_text(encoding="utf-8")
+    assert idml2docbook(str(TESTDATA / hubxml), **options) == expected_docbook
+
+
 FILES = [
     {
         "idml": "hello_world/hello_world.idml",
@@ -80,4 +100,628 @@ def test_convert_idml_to_docbook(files):
     expected_docbook = dbk_path.read_text(encoding="utf-8")
     processed_docbook = idml2docbook(str(idml_path), **DEFAULT_OPTIONS)
     
-    assert expected_docbook == processed_docbook
\ No newline at end of file
+    assert expected_docbook == processed_docbook
+HUBXML_FILES = [
+    "bollo/bollo.xml",
+    "css_transform_direction/css_transform_direction.xml",
+    "hello_world/hello_world.xml",
+    "package/test.xml",
+]
+
+ENGINE_OPTIONS = [
+    {},
+    {'ignore_overrides': True, 'typography': True, 'thin_spaces': True},
+    {'linebreaks': True, 'raster': "jpg", 'vector': "svg", 'media': "images"},
+]
+
+@pytest.mark.parametrize("hubxml", HUBXML_FILES)
+@pytest.mark.parametrize("options", ENGINE_OPTIONS)
+def test_lxml_engine_matches_bs4_engine(hubxml, options):
+    hubxml_path = TESTDATA / hubxml
+    options = DEFAULT_OPTIONS | options | {'idml2hubxml_file': True}
+
+    bs4_docbook = idml2docbook(str(hubxml_path), **(options | {'engine': "bs4"}))
+    lxml_docbook = idml2docbook(str(hubxml_path), **(options | {'engine': "lxml"}))
+
+    assert bs4_docbook == lxml_docbook
+
+@pytest.mark.parametrize("hubxml", HUBXML_FILES)
+@pytest.mark.parametrize("options", ENGINE_OPTIONS)
+def test_streaming_matches_lxml_engine(hubxml, options):
+    import io
+    from idml2docbook.core import idml2docbook_stream
+
+    hubxml_path = TESTDATA / hubxml
+    options = DEFAULT_OPTIONS | options | {'idml2hubxml_file': True, 'engine': "lxml"}
+
+    output = io.StringIO()
+    idml2docbook_stream(str(hubxml_path), output, **options)
+
+    assert output.getvalue() == idml2docbook(str(hubxml_path), **options)
+
+def test_convert_many_reports_failures(tmp_path):
+    from idml2docbook.batch import convert_many
+
+    inputs = [str(TESTDATA / hubxml) for hubxml in HUBXML_FILES] + [str(tmp_path / "missing.xml")]
+    results = convert_many(inputs, str(tmp_path / "out"), jobs=2,
+        idml2hubxml_file=True, engine="lxml")
+
+    # Largest files first
+    assert results[0]["input"] == str(TESTDATA / "bollo/bollo.xml")
+    assert [result["input"] for result in results if result["error"]] == [str(tmp_path / "missing.xml")]
+    for result in results[:-1]:
+        assert Path(result["output"]).read_text() == idml2docbook(result["input"],
+            **(DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'engine': "lxml"}))
+
+def test_convert_many_refuses_files_of_the_same_name(tmp_path):
+    from idml2docbook.batch import convert_many
+
+    for folder in ["a", "b"]:
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "chapter.xml").write_bytes((TESTDATA / "hello_world/hello_world.xml").read_bytes())
+    inputs = [str(tmp_path / "a/chapter.xml"), str(tmp_path / "b/chapter.xml")]
+    with pytest.raises(ValueError, match="chapter.dbk"):
+        convert_many(inputs, str(tmp_path / "out"), jobs=1, idml2hubxml_file=True)
+    assert not (tmp_path / "out").exists()
+
+    # From a folder, the subfolders are kept
+    results = convert_many(str(tmp_path), str(tmp_path / "out"), jobs=1, idml2hubxml_file=True)
+    assert sorted(result["output"] for result in results) == [
+        str(tmp_path / "out/a/chapter.dbk"), str(tmp_path / "out/b/chapter.dbk")]
+
+def fake_idml2xml(input, **options):
+    """Stands for idml2xml.sh, without Java: copies the Hub XML fixture of the IDML file."""
+    import shutil
+    output = Path(options["idml2hubxml_output"]) / (Path(input).stem + ".xml")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(TESTDATA / "hello_world/hello_world.xml", output)
+    return str(output)
+
+def test_idml2hubxml_output_is_cached(tmp_path, monkeypatch):
+    import idml2hubxml
+    from idml2docbook.cache import GzipCache
+
+    idml = str(TESTDATA / "hello_world/hello_world.idml")
+    options = DEFAULT_OPTIONS | {
+        'idml2hubxml_output': str(tmp_path / "first"),
+        'idml2hubxml_cache': str(tmp_path / "cache"),
+    }
+    monkeypatch.setattr(idml2hubxml, "run_idml2xml", fake_idml2xml)
+    docbook = idml2docbook(idml, **options)
+    assert len(GzipCache(tmp_path / "cache").entries()) == 1
+    # The output of idml2xml is only written to the output folder when it is kept
+    assert not (tmp_path / "first").exists()
+
+    # The same package zipped again is found in the cache: idml2xml is not run
+    import zipfile
+    copy = tmp_path / "copy.idml"
+    with zipfile.ZipFile(idml) as source, zipfile.ZipFile(copy, "w", zipfile.ZIP_DEFLATED) as target:
+        for info in reversed(source.infolist()):
+            target.writestr(zipfile.ZipInfo(info.filename, (2030, 1, 1, 0, 0, 0)), source.read(info))
+    assert copy.read_bytes() != Path(idml).read_bytes()
+    def idml2xml_not_run(input, **options):
+        raise AssertionError("idml2xml run on a cached package")
+    monkeypatch.setattr(idml2hubxml, "run_idml2xml", idml2xml_not_run)
+    options['idml2hubxml_output'] = str(tmp_path / "second")
+    options['keep_idml2hubxml_output'] = True
+    assert idml2docbook(str(copy), **(options | {'typography': True})) == \
+        idml2docbook(str(TESTDATA / "hello_world/hello_world.xml"), **(DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'typography': True}))
+    assert (tmp_path / "second" / "copy.xml").exists()
+
+    # A changed story gives another key
+    from idml2docbook.cache import hash_idml
+    changed = tmp_path / "changed.idml"
+    with zipfile.ZipFile(idml) as source, zipfile.ZipFile(changed, "w") as target:
+        for info in source.infolist():
+            data = source.read(info)
+            target.writestr(info, data + b" " if info.filename.startswith("Stories/") else data)
+    assert hash_idml(str(copy)) == hash_idml(idml) != hash_idml(str(changed))
+
+def test_idml2hubxml_cache_evicts_least_recently_used(tmp_path, caplog):
+    import logging
+    import os
+    from idml2docbook.cache import GzipCache
+
+    hubxml = tmp_path / "hub.xml"
+    hubxml.write_bytes(os.urandom(300 * 1024)) # does not compress
+    cache = GzipCache(tmp_path / "cache", max_size=1)
+    cache.put("aa1", hubxml)
+    cache.put("bb2", hubxml)
+    os.utime(cache.path_of("aa1"), (0, 0))
+    os.utime(cache.path_of("bb2"), (1, 1))
+    assert cache.get("aa1") == hubxml.read_bytes() # aa1 is now the most recently used
+    cache.put("cc3", hubxml)
+    with caplog.at_level(logging.DEBUG):
+        cache.put("dd4", hubxml)
+
+    assert "Evicted from the cache " + str(tmp_path / "cache") + ": bb2.xml.gz" in caplog.messages
+    assert cache.get("bb2") is None
+    assert cache.get("aa1") is not None
+    assert cache.get("zz0") is None
+
+@pytest.mark.parametrize("engine", ["bs4", "lxml"])
+def test_conversion_resumes_from_checkpoints(engine, tmp_path):
+    from idml2docbook.cache import GzipCache
+
+    hubxml = str(TESTDATA / "package/test.xml")
+    options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'engine': engine}
+    checkpoints = GzipCache(tmp_path, suffix=".checkpoint.gz")
+
+    def convert(**other_options):
+        resumed = idml2docbook(hubxml, **(options | other_options | {'checkpoints': str(tmp_path)}))
+        assert resumed == idml2docbook(hubxml, **(options | other_options | {'checkpoints': False}))
+        return len(checkpoints.entries())
+
+    assert convert() == 2
+    assert convert(typography=True, linebreaks=True, raster="jpg") == 2 # resumed from "notes"
+    assert convert(ignore_overrides=True) == 3 # resumed from "roles"
+
+def test_checkpoints_are_opt_in(tmp_path, monkeypatch):
+    import subprocess
+    from idml2docbook import CHECKPOINTS_FOLDER
+    from idml2docbook.__main__ import load_env
+    monkeypatch.delenv("CHECKPOINTS", raising=False)
+    script = "from idml2docbook import DEFAULT_OPTIONS; print(DEFAULT_OPTIONS['checkpoints'])"
+    assert subprocess.run([sys.executable, "-c", script],
+        capture_output=True, text=True, check=True).stdout.strip() == "False"
+    assert load_env(["input.xml", "--checkpoints"])[0].checkpoints == CHECKPOINTS_FOLDER
+    assert load_env(["input.xml", "--checkpoints-folder", str(tmp_path)])[0].checkpoints == str(tmp_path)
+
+def test_enable_flags_do_not_take_the_input():
+    from idml2docbook.__main__ import load_env
+    for flag in ["--checkpoints", "--incremental", "--profile"]:
+        args = load_env([flag, "book.xml"])[0]
+        assert args.input == "book.xml"
+        assert getattr(args, flag[2:])
+    args = load_env(["--incremental-folder", "fragments", "--profile-file", "profile.json", "book.xml"])[0]
+    assert (args.input, args.incremental, args.profile) == ("book.xml", "fragments", "profile.json")
+
+def test_incremental_conversion_only_converts_changed_parts(tmp_path):
+    from idml2docbook.cache import GzipCache
+
+    options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'engine': "lxml", 'checkpoints': False}
+    fragments = GzipCache(tmp_path / "fragments", suffix=".fragment.gz")
+    hubxml = (TESTDATA / "package/test.xml").read_text(encoding="utf-8")
+
+    def convert(text):
+        path = tmp_path / "test.xml"
+        path.write_text(text, encoding="utf-8")
+        incremental = idml2docbook(str(path), **(options | {'incremental': str(tmp_path / "fragments")}))
+        assert incremental == idml2docbook(str(path), **options)
+        return len(fragments.entries())
+
+    count = convert(hubxml)
+    assert convert(hubxml) == count
+    assert convert(hubxml.replace("JPG picture that was not anchored", "JPEG picture that was not anchored", 1)) == count + 1
+    # The style resources changed: no part can be reused
+    assert convert(hubxml.replace('name="NormalParagraphStyle"', 'name="Normal"')) > count + 1
+
+def test_incremental_conversion_of_interacting_parts(tmp_path, caplog):
+    from idml2docbook.cache import GzipCache
+
+    options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'engine': "lxml", 'checkpoints': False}
+    path = tmp_path / "test.xml"
+    path.write_text((TESTDATA / "hello_world/hello_world.xml").read_text(encoding="utf-8").replace("</hub>",
+        '<phrase role="a">Bye</phrase>\n<phrase role="a">!</phrase>\n</hub>'), encoding="utf-8")
+
+    incremental = idml2docbook(str(path), **(options | {'incremental': str(tmp_path / "fragments")}))
+    # Converted as a whole, without the cache
+    assert incremental == idml2docbook(str(path), **options)
+    assert GzipCache(tmp_path / "fragments", suffix=".fragment.gz").entries() == []
+    assert any("<phrase> element directly in <hub>" in message for message in caplog.messages)
+
+def test_dispatcher_runs_handlers_in_one_walk():
+    from bs4 import BeautifulSoup
+    from idml2docbook.dispatch import Dispatcher
+
+    soup = BeautifulSoup(
+        '<article><info/><para/><phrase/><phrase role="a">b</phrase></article>', "xml")
+    visited = []
+
+    dispatcher = Dispatcher()
+    dispatcher.register(lambda tag: visited.append(tag.name), name="visit")
+    dispatcher.register(lambda tag: tag.decompose(), tags=["info"], name="remove_info")
+    dispatcher.register(lambda tag: visited.append("never"), tags=["info"], name="after_removal")
+    dispatcher.register(lambda tag: tag.unwrap(), tags=["phrase"], attrs={"role": "a"}, name="unwrap")
+    counts = dispatcher.run(soup)
+
+    assert visited == ["article", "info", "para", "phrase", "phrase"]
+    assert dict(counts) == {"visit": 5, "remove_info": 1, "unwrap": 1}
+    assert str(soup.article) == "<article><para/><phrase/>b</article>"
+
+@pytest.mark.parametrize("engine", ["bs4", "lxml"])
+def test_profile_reports_every_stage(engine, tmp_path):
+    import json
+
+    hubxml = str(TESTDATA / "hello_world/hello_world.xml")
+    options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'checkpoints': False, 'engine': engine}
+    report = tmp_path / "profile.json"
+
+    docbook = idml2docbook(hubxml, **(options | {'profile': str(report), 'profile_stage': "fix_role_names"}))
+
+    assert docbook == idml2docbook(hubxml, **options)
+    stages = {stage["name"]: stage for stage in json.loads(report.read_text())["stages"]}
+    for name in ["parse", "fix_role_names", "turn_overrides_into_roles", "cleanup",
+            "cleanup: remove_ns_attributes_of", "process_endnotes", "serialization"]:
+        assert stages[name]["calls"] >= 1
+    assert stages["parse"]["nodes"] > 0
+    assert "fix_role_names" in (tmp_path / "profile.txt").read_text()
+    assert (tmp_path / "profile.prof").exists()
+
+def test_bench_fails_on_regressions(tmp_path):
+    import json
+    from idml2docbook.bench import main
+
+    results = tmp_path / "results.json"
+    main([str(TESTDATA / "hello_world/hello_world.xml"), "-e", "lxml", "-n", "1", "--scale", "2", "-o", str(results)])
+    baseline = json.loads(results.read_text())
+    assert set(baseline["cases"]) == {"hello_world.xml [lxml]", "hello_world-x2.xml [lxml]"}
+    assert "fix_role_names" in baseline["cases"]["hello_world.xml [lxml]"]["stages"]
+
+    # The same code against a baseline ten times faster
+    for case in baseline["cases"].values():
+        case["total"] /= 10
+        case["stages"] = {name: seconds / 10 for name, seconds in case["stages"].items()}
+    (tmp_path / "baseline.json").write_text(json.dumps(baseline))
+    with pytest.raises(SystemExit) as exit:
+        main([str(TESTDATA / "hello_world/hello_world.xml"), "-e", "lxml", "-n", "1",
+            "--baseline", str(tmp_path / "baseline.json"), "--threshold", "2", "--min-seconds", "0"])
+    assert exit.value.code == 1
+
+def test_generated_hubxml_is_converted_by_both_engines(tmp_path):
+    from idml2docbook.generate import generate_hubxml
+
+    hubxml = tmp_path / "synthetic.xml"
+    densities = {'footnotes': 0.3, 'endnotes': 0.3, 'media': 0.2, 'tabs': 0.3, 'urls': 0.3, 'overrides': 0.3}
+    generate_hubxml(hubxml, paragraphs=200, seed=1, **densities)
+    (tmp_path / "again").mkdir()
+    generate_hubxml(tmp_path / "again" / "synthetic.xml", paragraphs=200, seed=1, **densities)
+    assert hubxml.read_bytes() == (tmp_path / "again" / "synthetic.xml").read_bytes()
+
+    xml = hubxml.read_text()
+    assert xml.count('remap="EndnoteRange"') == xml.count('role="hub:endnote"') > 0
+    assert "<br/>" in xml and "<footnote>" in xml and "<imagedata" in xml and 'css:font-' in xml
+
+    options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'checkpoints': False}
+    docbook = idml2docbook(str(hubxml), **(options | {'engine': "bs4"}))
+    assert docbook == idml2docbook(str(hubxml), **(options | {'engine': "lxml"}))
+    assert docbook.count('endnote="1"') == xml.count('remap="EndnoteRange"')
+    assert "<br" not in docbook
+    assert "https://www.example.org/" in docbook
+
+    generate_hubxml(tmp_path / "sized.xml", size=0.1)
+    assert 0.1 * 1024 * 1024 <= (tmp_path / "sized.xml").stat().st_size < 0.2 * 1024 * 1024
+
+ENDNOTES_HUBXML = """<?xml version="1.0" encoding="UTF-8"?>
+<hub xmlns="http://docbook.org/ns/docbook" xmlns:css="http://www.w3.org/1996/css" version="5.1-variant le-tex_Hub-1.2">
+   <para>One<link xml:id="a1" remap="EndnoteRange" linkend="en1">1</link>, again<link xml:id="a2" remap="EndnoteRange" linkend="en1">1</link>, missing<link xml:id="a3" remap="EndnoteRange" linkend="en9">9</link>.</para>
+   <para><anchor xml:id="en1" role="hub:endnote"/><phrase role="hub:identifier"><link remap="EndnoteMarker" linkend="a1">1</link></phrase><tab>\t</tab>First <emphasis>note</emphasis>.</para>
+   <para><anchor xml:id="en2" role="hub:endnote"/><phrase role="hub:identifier"><link remap="EndnoteMarker" linkend="a9">2</link></phrase>Orphan.</para>
+</hub>
+"""
+
+@pytest.mark.parametrize("engine", ["bs4", "lxml", "streaming"])
+def test_endnotes_referenced_twice_orphaned_or_missing(engine, tmp_path, caplog):
+    import io
+    import logging
+    from idml2docbook.core import idml2docbook_stream
+
+    hubxml = tmp_path / "endnotes.xml"
+    hubxml.write_text(ENDNOTES_HUBXML)
+    options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'checkpoints': False, 'engine': engine}
+
+    with caplog.at_level(logging.INFO):
+        if engine == "streaming":
+            output = io.StringIO()
+            idml2docbook_stream(str(hubxml), output, **options)
+            docbook = output.getvalue()
+        else:
+            docbook = idml2docbook(str(hubxml), **options)
+
+    note = '<footnote endnote="1"><para><phrase role="hub:identifier"/><phrase role="converted-tab"/>First <emphasis>note</emphasis>.</para></footnote>'
+    assert docbook.count(note) == 2
+    assert "Orphan" not in docbook and 'linkend="en9"' in docbook
+    summaries = [record for record in caplog.records if "endnotes, " in record.getMessage()]
+    assert len(summaries) == 1 and summaries[0].levelno == logging.WARNING
+    assert summaries[0].getMessage() == ("2 endnotes, 3 references."
+        "\n  1 endnotes are not referenced: en2"
+        "\n  1 references point to no endnote: en9"
+        "\n  1 endnotes are referenced more than once: en1")
+
+@pytest.mark.parametrize("same_attributes", [False, True])
+def test_merge_adjacent_phrases(same_attributes):
+    from bs4 import BeautifulSoup
+    from lxml import etree
+    from idml2docbook.core import merge_adjacent_phrases_with_same_role
+    from idml2docbook.lxml_engine import merge_adjacent_phrases_with_same_role as merge_lxml, serialize
+
+    xml = ('<para>' + '<phrase role="a">1</phrase>' * 3 + '<phrase role="b">2</phrase> '
+        + '<phrase remap="fr" role="b">3</phrase>' * 2 + '<phrase role="b">4</phrase></para>')
+    merged = '<phrase remap="fr" role="b">33</phrase>' if same_attributes else '<phrase remap="fr" role="b">3</phrase>' * 2
+    expected = '<para><phrase role="a">111</phrase><phrase role="b">2</phrase> ' + merged + '<phrase role="b">4</phrase></para>'
+
+    soup = BeautifulSoup(xml, "xml")
+    merge_adjacent_phrases_with_same_role(soup, same_attributes)
+    assert str(soup.para) == expected
+
+    root = etree.fromstring(xml)
+    merge_lxml(root, same_attributes)
+    assert serialize(root).split("\n", 1)[1] == expected
+
+# The regular expression the URL scanner replaces, exponential on some inputs
+URL_REGEX_WITH_BR = r"https?:\/\/([-A-zÀ-ÿ0-9]+\.)?([-A-zÀ-ÿ0-9@:%._\+~#=]+(<br/>)?)+\.[A-zÀ-ÿ0-9()]{1,6}(\b[-A-zÀ-ÿ0-9()@:%;_\+.~#?&//=]*(<br/>)?)*"
+
+def test_find_urls_matches_the_regular_expression():
+    import random
+    import re
+    from idml2docbook.core import find_urls
+
+    atoms = ["http://", "https://", "<br/>", ".", "a", "Z", "é", "1", "/", "-", "(", " ", "&amp;", "_", "#", "com", "www."]
+    generator = random.Random(0)
+    for _ in range(20000):
+        s = "".join(generator.choice(atoms) for _ in range(generator.randint(1, 12)))
+        assert find_urls(s) == [match.span() for match in re.finditer(URL_REGEX_WITH_BR, s)], s
+
+def test_find_next_matches_beautifulsoup():
+    from bs4 import BeautifulSoup
+    from lxml import etree
+    from idml2docbook.lxml_engine import find_next
+    xml = ("<hub><para><mediaobject id='1'><imagedata fileref='a'/></mediaobject>"
+        "<mediaobject id='2'/></para><para><phrase><imagedata fileref='b'/></phrase>"
+        "<mediaobject id='3'/></para></hub>")
+    soup = BeautifulSoup(xml, "xml")
+    root = etree.fromstring(xml)
+    def fileref(imagedata):
+        return imagedata.get("fileref") if imagedata is not None else None
+    found = [fileref(find_next(el, "imagedata")) for el in root.iter("mediaobject")]
+    assert found == [fileref(tag.find_next("imagedata")) for tag in soup.find_all("mediaobject")]
+    assert found == ["a", "b", None]
+
+@pytest.mark.parametrize("engine", ["bs4", "lxml"])
+def test_urls_with_linebreaks_in_linear_time(engine, tmp_path):
+    import time
+    from idml2docbook.core import find_urls
+
+    pathological = ["http://" + "a" * 200000 + "!", "http://" + "a<br/>" * 50000 + " ",
+        ("http://" + "a." * 100 + "(") * 1000, "https://" * 50000]
+    for s in pathological:
+        start = time.perf_counter()
+        find_urls(s)
+        assert time.perf_counter() - start < 2, s[:20]
+
+    hubxml = tmp_path / "urls.xml"
+    hubxml.write_text('<hub xmlns="http://docbook.org/ns/docbook"><para>See https://www.exam<br/>ple.org/some/pa<br/>th/ '
+        + "or http://" + "a" * 20000 + "<br/>!</para></hub>")
+    start = time.perf_counter()
+    docbook = idml2docbook(str(hubxml), **(DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'checkpoints': False, 'engine': engine}))
+    assert time.perf_counter() - start < 10
+    assert "https://www.example.org/some/path/ or" in docbook
+
+FRENCH_TYPOGRAPHY = [
+    # (input, output, output with thin_spaces)
+    ("Quoi ! Vraiment ? Oui ; 12 % et 3 €.", "Quoi ! Vraiment ? Oui ; 12 % et 3 €.", None),
+    ("Note : voir", "Note : voir", "Note : voir"),
+    ("1 000 000 habitants", "1 000 000 habitants", None), # the groups overlap, only the first is spaced
+    ("« Bonjour »", "« Bonjour »", None),
+    ("«»« »", "« »« »", None),
+    ("Il fait 20° dehors, un angle de 45 °", "Il fait 20° dehors, un angle de 45 ° ", None),
+    ("a°°b et° x", "a° °b et° x", None),
+    ("Et puis... enfin....", "Et puis… enfin….", None),
+    ("Rien à changer.", "Rien à changer.", None),
+]
+
+@pytest.mark.parametrize("text, output, thin_output", FRENCH_TYPOGRAPHY)
+def test_french_orthotypography(text, output, thin_output):
+    from idml2docbook.core import french_orthotypography, strip_orthotypography
+
+    assert french_orthotypography(text, False) == output
+    assert french_orthotypography(text, True) == (thin_output or output)
+    assert strip_orthotypography("co­opéra : 1 000　!") == "coopéra : 1 000 !"
+
+def test_output_written_atomically_and_gzipped(tmp_path):
+    import gzip
+    import io
+    from idml2docbook.core import idml2docbook_to
+
+    hubxml = str(TESTDATA / "hello_world/hello_world.xml")
+    options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'checkpoints': False}
+    docbook = idml2docbook(hubxml, **options)
+
+    stream = io.StringIO()
+    idml2docbook_to(hubxml, stream, **options)
+    assert stream.getvalue() == docbook
+
+    idml2docbook_to(hubxml, tmp_path / "out.dbk.gz", **options)
+    with gzip.open(tmp_path / "out.dbk.gz", "rt", encoding="utf-8") as f:
+        assert f.read() == docbook
+
+    # A failed conversion leaves the previous file as it was, and no temporary file
+    (tmp_path / "out.dbk").write_text("previous")
+    with pytest.raises(OSError):
+        idml2docbook_to(str(tmp_path / "missing.xml"), tmp_path / "out.dbk", **options)
+    assert (tmp_path / "out.dbk").read_text() == "previous"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["out.dbk", "out.dbk.gz"]
+
+def test_output_does_not_touch_the_umask(tmp_path, monkeypatch):
+    import os
+    from idml2docbook.core import idml2docbook_to
+    from idml2docbook.output import FILE_MODE
+
+    def umask(mask):
+        raise AssertionError("the umask is process-wide, it must not be set per output")
+
+    monkeypatch.setattr(os, "umask", umask)
+    options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'checkpoints': False}
+    idml2docbook_to(str(TESTDATA / "hello_world/hello_world.xml"), tmp_path / "out.dbk", **options)
+    assert (tmp_path / "out.dbk").stat().st_mode & 0o777 == FILE_MODE
+
+@pytest.mark.parametrize("engine", ["bs4", "lxml", "streaming"])
+def test_input_from_bytes_file_objects_and_mmaps(engine):
+    import io
+    import mmap
+
+    hubxml = TESTDATA / "hello_world/hello_world.xml"
+    options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'checkpoints': False,
+        'engine': "lxml" if engine == "streaming" else engine, 'streaming': engine == "streaming"}
+    docbook = idml2docbook(str(hubxml), **options)
+
+    assert idml2docbook(hubxml, **options) == docbook
+    assert idml2docbook(hubxml.read_bytes(), **options) == docbook
+    assert idml2docbook(io.BytesIO(hubxml.read_bytes()), **options) == docbook
+    with open(hubxml, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        assert idml2docbook(mapped, **options) == docbook
+
+def test_import_is_fast_and_does_not_load_pandas():
+    import subprocess
+    script = ("import sys, time; start = time.perf_counter(); import idml2docbook.core; "
+        "print(time.perf_counter() - start); print(' '.join(sorted(sys.modules)))")
+    seconds, modules = subprocess.run([sys.executable, "-c", script],
+        capture_output=True, text=True, check=True).stdout.splitlines()
+    modules = modules.split()
+    assert "pandas" not in modules and "natsort" not in modules
+    # About 0.1 s, 0.3 s with pandas: a generous budget, for slow machines
+    assert float(seconds) < 1.0
+
+def test_java_version_is_probed_once_per_binary(tmp_path, monkeypatch):
+    import os
+    from idml2docbook import install_dependencies
+    from idml2docbook.install_dependencies import cached_java_version
+
+    probes = tmp_path / "probes"
+    java = tmp_path / "bin" / "java"
+    java.parent.mkdir()
+    java.write_text(f"#!/bin/sh\necho probed >> {probes}\necho 'openjdk version \"17.0.2\"' >&2\n")
+    java.chmod(0o755)
+    monkeypatch.setenv("PATH", str(java.parent) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setattr(install_dependencies, "JAVA_VERSIONS", {})
+    cache_file = tmp_path / "toolchain.json"
+
+    assert cached_java_version(cache_file) == 17
+    assert cached_java_version(cache_file) == 17
+    assert probes.read_text().count("probed") == 1
+
+    # Saved across runs
+    install_dependencies.JAVA_VERSIONS.clear()
+    assert cached_java_version(cache_file) == 17
+    assert probes.read_text().count("probed") == 1
+
+    # Probed again once the binary changed
+    os.utime(java, ns=(0, 0))
+    assert cached_java_version(cache_file) == 17
+    assert probes.read_text().count("probed") == 2
+
+def test_logging_is_configurable(tmp_path):
+    import json
+    import logging
+    import os
+    from idml2docbook.logs import configure_logging
+
+    root = logging.getLogger()
+    level, handlers = root.level, list(root.handlers)
+    try:
+        configure_logging("info", str(tmp_path / "log-{pid}.json"), json_lines=True)
+        logging.debug("Hidden: %s", "debug")
+        logging.info("Shown: %s", "info")
+        configure_logging("off")
+        logging.error("Hidden")
+        records = [json.loads(line) for line in (tmp_path / f"log-{os.getpid()}.json").read_text().splitlines()]
+        assert [(record["level"], record["message"], record["pid"]) for record in records] == \
+            [("INFO", "Shown: info", os.getpid())]
+    finally:
+        configure_logging("off")
+        root.handlers[:] = handlers
+        root.setLevel(level)
+
+ROLES_RENAMED_TWICE = """<hub xmlns="http://docbook.org/ns/docbook" xmlns:css="http://www.w3.org/1996/css"><info><css:rules>
+<css:rule name="a" native-name="b" layout-type="para"/><css:rule name="b" native-name="c" layout-type="para"/>
+<css:rule name="d" native-name="d" layout-type="para"/><css:rule name="e_1" native-name="$ID/e 1" layout-type="inline"/>
+</css:rules></info><para role="a">1</para><para role="b">2</para><para role="d"><phrase role="e_1">3</phrase></para></hub>"""
+
+@pytest.mark.parametrize("engine", ["bs4", "lxml"])
+def test_roles_renamed_in_one_pass(engine):
+    # The roles used to be renamed one after the other: "a" became "b",
+    # then every "b" (the former "a" as well) became "c"
+    if engine == "bs4":
+        from bs4 import BeautifulSoup
+        from idml2docbook.map import fix_role_names
+        soup = BeautifulSoup(ROLES_RENAMED_TWICE, "xml")
+        fix_role_names(soup)
+        roles = [para.get("role") for para in soup.find_all(["para", "phrase"])]
+        names = [rule["name"] for rule in soup.find_all("css:rule")]
+    else:
+        from lxml import etree
+        from idml2docbook.lxml_engine import fix_role_names
+        root = etree.fromstring(ROLES_RENAMED_TWICE)
+        fix_role_names(root)
+        roles = [el.get("role") for el in root.iter("{*}para", "{*}phrase")]
+        names = [rule.get("name") for rule in root.iter("{*}rule")]
+    assert roles == ["c", "c", "d", "e_1"]
+    assert names == ["c", "c", "d", "e_1"]
+
+OVERRIDES_WITH_ANOTHER_PREFIX = """<hub xmlns="http://docbook.org/ns/docbook" xmlns:c="http://www.w3.org/1996/css">
+<para role="normal" c:font-size="12pt" c:hyphens="auto">See css:font-size</para>
+<para c:font-size="12pt">and <phrase role="b" c:font-style="italic" remap="x">css:</phrase></para></hub>"""
+
+@pytest.mark.parametrize("engine", ["bs4", "lxml"])
+def test_overrides_detected_by_namespace(engine):
+    if engine == "bs4":
+        from bs4 import BeautifulSoup
+        from idml2docbook.map import turn_overrides_into_roles
+        soup = BeautifulSoup(OVERRIDES_WITH_ANOTHER_PREFIX, "xml")
+        soup, paragraph_overrides, character_overrides = turn_overrides_into_roles(soup)
+        elements = [(el.get("role"), dict(el.attrs)) for el in soup.find_all(["para", "phrase"])]
+        text = soup.get_text()
+        assert [key for index, applied, key in paragraph_overrides] == [(("font-size", "12pt"),)]
+        assert [key for index, applied, key in character_overrides] == [(("font-style", "italic"), ("remap", "x"))]
+    else:
+        from lxml import etree
+        from idml2docbook.lxml_engine import turn_overrides_into_roles
+        root = etree.fromstring(OVERRIDES_WITH_ANOTHER_PREFIX)
+        turn_overrides_into_roles(root)
+        elements = [(el.get("role"), dict(el.attrib)) for el in root.iter("{*}para", "{*}phrase")]
+        text = "".join(root.itertext())
+    assert [role for role, attributes in elements] == \
+        ["normal paragraph-override-1", "paragraph-override-1", "b character-override-1"]
+    assert not any("font" in name or "hyphens" in name for role, attributes in elements for name in attributes)
+    assert text.count("css:") == 2
+
+def test_another_prefix_converted_as_css(tmp_path):
+    from idml2docbook.map import get_styles
+    hubxml = (TESTDATA / "hello_world/hello_world.xml").read_text(encoding="utf-8")
+    renamed = tmp_path / "renamed.xml"
+    renamed.write_text(hubxml.replace("xmlns:css=", "xmlns:c=").replace("css:", "c:"), encoding="utf-8")
+    assert "css:" not in renamed.read_text(encoding="utf-8")
+
+    assert get_styles(renamed.read_text(encoding="utf-8")) == get_styles(hubxml)
+    for engine in ["bs4", "lxml"]:
+        for ignore_overrides in [False, True]:
+            options = DEFAULT_OPTIONS | {'idml2hubxml_file': True, 'checkpoints': False,
+                'engine': engine, 'ignore_overrides': ignore_overrides}
+            docbook = idml2docbook(str(renamed), **options)
+            assert docbook == idml2docbook(str(TESTDATA / "hello_world/hello_world.xml"), **options)
+
+def test_styles_analysed_in_one_pass(tmp_path, capsys):
+    import json
+    import re
+    from idml2docbook.map import analyse_styles, generate_css_from_styles, main
+    hubxml = Path("tests/bollo/bollo.xml").read_bytes()
+    analysis = analyse_styles(hubxml)
+    # The couples the listing used to find in the serialized document
+    found = re.findall(r'<(\w+)[^>]*\brole="(.*?)"[^>]*>', str(analysis.soup).split("</info>")[1])
+    assert analysis.roles == {(role, tag) for tag, role in found if not role.startswith("hub")}
+    assert analysis.css() == generate_css_from_styles(*analysis.styles())
+    assert analysis.paragraph_styles and analysis.paragraph_styles_overrides
+
+    roles = [role for role, tag in analysis.relevant_roles()]
+    covered, uncovered = analysis.coverage({roles[0]: {"type": "para"}})
+    assert covered == [roles[0]] and len(uncovered) == len(roles) - 1
+    assert [tag for role, tag in uncovered] == sorted((tag for role, tag in uncovered), key=lambda tag: tag == "phrase")
+
+    input = tmp_path / "bollo.xml"
+    input.write_bytes(hubxml)
+    with pytest.raises(SystemExit):
+        main([str(input), "--to-css", "--to-json-template"])
+    assert (tmp_path / "bollo.css").read_text(encoding="utf-8") == analysis.css()
+    template = json.loads((tmp_path / "bollo_template.json").read_text(encoding="utf-8"))
+    assert len(template) == len({"." + ".".join(role.split()) for role in roles})
+    assert "- " + roles[0] in capsys.readouterr().out